@@ -0,0 +1,194 @@
+/*global window: true, module: true, XMLHttpRequest: true*/
+
+// Reference browser client: computes fingerprints as specified in
+// clients/FINGERPRINT.md and posts queued errors as NDJSON to /api/errors.
+
+(function(root) {
+	"use strict";
+
+	var FINGERPRINT_VERSION = 2;
+	var normalizeRe = /"(?:[^\n]*?[^\\\n])??"|'(?:[^\n]*?[^\\\n])??'|[0-9]+/g;
+
+	var utf8 = function(value) {
+		return unescape(encodeURIComponent(String(value)));
+	};
+
+	// md5 of a string of bytes (char codes 0-255) as lowercase hex
+	var md5 = (function() {
+		var S = [7, 12, 17, 22, 5, 9, 14, 20, 4, 11, 16, 23, 6, 10, 15, 21];
+		var K = [];
+		for (var i = 0; i < 64; i++) {
+			K[i] = Math.floor(Math.abs(Math.sin(i + 1)) * 4294967296) | 0;
+		}
+
+		var hex = function(word) {
+			var out = '';
+			for (var i = 0; i < 4; i++) {
+				out += ('0' + ((word >>> (i * 8)) & 0xff).toString(16)).slice(-2);
+			}
+			return out;
+		};
+
+		return function(bytes) {
+			var length = bytes.length;
+			var words = [];
+			var i;
+			for (i = 0; i < length; i++) {
+				words[i >> 2] |= bytes.charCodeAt(i) << ((i % 4) * 8);
+			}
+			words[length >> 2] |= 0x80 << ((length % 4) * 8);
+			var count = (((length + 8) >> 6) + 1) * 16;
+			for (i = (length >> 2) + 1; i < count; i++) {
+				words[i] = words[i] | 0;
+			}
+			words[count - 2] = length * 8;
+			words[count - 1] = Math.floor(length / 536870912);
+
+			var a0 = 0x67452301, b0 = 0xefcdab89 | 0, c0 = 0x98badcfe | 0, d0 = 0x10325476;
+
+			for (var block = 0; block < count; block += 16) {
+				var a = a0, b = b0, c = c0, d = d0;
+
+				for (var j = 0; j < 64; j++) {
+					var f, g;
+					if (j < 16) {
+						f = (b & c) | (~b & d);
+						g = j;
+					}
+					else if (j < 32) {
+						f = (d & b) | (~d & c);
+						g = (5 * j + 1) % 16;
+					}
+					else if (j < 48) {
+						f = b ^ c ^ d;
+						g = (3 * j + 5) % 16;
+					}
+					else {
+						f = c ^ (b | ~d);
+						g = (7 * j) % 16;
+					}
+
+					var shift = S[(j >> 4) * 4 + (j % 4)];
+					var sum = (a + f + K[j] + words[block + g]) | 0;
+					a = d;
+					d = c;
+					c = b;
+					b = (b + ((sum << shift) | (sum >>> (32 - shift)))) | 0;
+				}
+
+				a0 = (a0 + a) | 0;
+				b0 = (b0 + b) | 0;
+				c0 = (c0 + c) | 0;
+				d0 = (d0 + d) | 0;
+			}
+
+			return hex(a0) + hex(b0) + hex(c0) + hex(d0);
+		};
+	}());
+
+	var fingerprint = function(error) {
+		var fields = ['project', 'language', 'type', 'message'];
+		for (var i = 0; i < fields.length; i++) {
+			if (error[fields[i]] === undefined || error[fields[i]] === null) {
+				return null;
+			}
+		}
+
+		var identity = [
+			'v' + FINGERPRINT_VERSION,
+			error.project,
+			error.language,
+			error.type,
+			String(error.message).replace(normalizeRe, '')
+		].join('\u0000');
+
+		return 'v' + FINGERPRINT_VERSION + ':' + md5(utf8(identity));
+	};
+
+	// Queues errors and posts them in batches, at most `options.maxPending`
+	// are kept while the server is unreachable, newer ones are dropped.
+	var Client = function(url, token, options) {
+		options = options || {};
+		this.url = url;
+		this.token = token;
+		this.batchSize = options.batchSize || 50;
+		this.flushInterval = options.flushInterval || 2000;
+		this.maxPending = options.maxPending || 500;
+		this.pending = [];
+		this.sending = false;
+		this.timer = null;
+		this.dropped = 0;
+	};
+
+	Client.prototype.logError = function(error) {
+		if (this.pending.length >= this.maxPending) {
+			this.dropped++;
+			return;
+		}
+
+		error.project = this.token;
+		error.language = error.language || 'javascript';
+		error.timestamp = error.timestamp || new Date().getTime() / 1000;
+		error.fingerprint = fingerprint(error);
+		this.pending.push(error);
+
+		if (this.pending.length >= this.batchSize) {
+			this.flush();
+		}
+		else if (this.timer === null) {
+			var self = this;
+			this.timer = setTimeout(function() { self.flush(); }, this.flushInterval);
+		}
+	};
+
+	Client.prototype.flush = function() {
+		if (this.timer !== null) {
+			clearTimeout(this.timer);
+			this.timer = null;
+		}
+		if (this.sending || !this.pending.length) {
+			return;
+		}
+
+		var self = this;
+		var batch = this.pending.splice(0, this.batchSize);
+		var body = [];
+		for (var i = 0; i < batch.length; i++) {
+			body.push(JSON.stringify(batch[i]));
+		}
+
+		var xhr = new XMLHttpRequest();
+		xhr.open('POST', this.url, true);
+		xhr.setRequestHeader('Content-Type', 'application/x-ndjson');
+		xhr.setRequestHeader('X-Triage-Token', this.token);
+		xhr.onreadystatechange = function() {
+			if (xhr.readyState !== 4) {
+				return;
+			}
+			self.sending = false;
+			// put the batch back on a network or server error, unless the queue filled meanwhile
+			if (xhr.status === 0 || xhr.status >= 500) {
+				self.pending = batch.concat(self.pending).slice(0, self.maxPending);
+			}
+			if (self.pending.length && self.timer === null) {
+				self.timer = setTimeout(function() { self.flush(); }, self.flushInterval);
+			}
+		};
+		this.sending = true;
+		xhr.send(body.join('\n') + '\n');
+	};
+
+	var Triage = {
+		FINGERPRINT_VERSION: FINGERPRINT_VERSION,
+		fingerprint: fingerprint,
+		md5: md5,
+		Client: Client
+	};
+
+	if (typeof module !== 'undefined' && module.exports) {
+		module.exports = Triage;
+	}
+	else {
+		root.TriageClient = Triage;
+	}
+}(this));
@@ -1,15 +1,52 @@
+import re
 import zmq
+import atexit
 import msgpack
+import msgpackrpc
+from hashlib import md5
+from collections import deque, OrderedDict
+from threading import Thread, Condition
 from time import time
 
 
-class ZeroMQMessagePackClient:
+# zeromq 3 split the high water mark into one per direction
+SNDHWM = zmq.SNDHWM if hasattr(zmq, 'SNDHWM') else zmq.HWM
+
+# Fingerprint spec version 2, see clients/FINGERPRINT.md
+FINGERPRINT_VERSION = 2
+FINGERPRINT_FIELDS = ('project', 'language', 'type', 'message')
+normalize_re = re.compile(r'"(?:[^\n]*?[^\\\n])??"|\'(?:[^\n]*?[^\\\n])??\'|[0-9]+')
+
+
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
 
-    unpacker = msgpack.Unpacker()
-    packer = msgpack.Packer()
-    context = zmq.Context()
+def fingerprint(error):
+    """ The grouping hash the server would compute for `error`, as
+    'v<version>:<md5 hex>', or None if a field it needs is missing.
+    """
+    if not all(error.get(field) is not None for field in FINGERPRINT_FIELDS):
+        return None
+
+    identity = '\0'.join([
+        'v' + str(FINGERPRINT_VERSION),
+        _utf8(error['project']),
+        _utf8(error['language']),
+        _utf8(error['type']),
+        _utf8(normalize_re.sub('', error['message']))
+    ])
+    return 'v%d:%s' % (FINGERPRINT_VERSION, md5(identity).hexdigest())
+
+
+class ZeroMQMessagePackClient:
 
     def __init__(self, server_uri):
+        self.unpacker = msgpack.Unpacker()
+        self.packer = msgpack.Packer()
+        self.context = zmq.Context()
         self.socket = self.context.socket(zmq.PUB)
         self.socket.connect(server_uri)
 
@@ -27,6 +64,7 @@ class ZeroMQMessagePackClient:
 class TriageClient (ZeroMQMessagePackClient):
 
     def log_error(self, error):
+        error.setdefault('fingerprint', fingerprint(error))
         return self.send({
             'error': error,
             'time': time()
@@ -40,7 +78,178 @@ class TriageClient (ZeroMQMessagePackClient):
         })
 
 
-client = TriageClient("tcp://127.0.0.1:5001")
+class TriageRpcClient:
+    """ Sends errors to the msgpack-rpc server in batches, keeping up to
+    `window` batches in flight on the connection instead of waiting for
+    each response before sending the next.
+    """
+
+    def __init__(self, host, port, batch_size=100, window=8):
+        self.client = msgpackrpc.Client(msgpackrpc.Address(host, port))
+        self.batch_size = batch_size
+        self.window = window
+        self.batch = []
+        self.in_flight = deque()
+        self.failures = 0
+
+    def log_error(self, error):
+        self.batch.append(error)
+        if len(self.batch) >= self.batch_size:
+            self.send()
+
+    def send(self):
+        if self.batch:
+            for error in self.batch:
+                error.setdefault('fingerprint', fingerprint(error))
+            self.in_flight.append(self.client.call_async('errors', self.batch))
+            self.batch = []
+        while len(self.in_flight) > self.window:
+            self.collect()
+
+    def collect(self):
+        results = self.in_flight.popleft().get()
+        self.failures += len([r for r in results if not r['success']])
+
+    def flush(self):
+        self.send()
+        while self.in_flight:
+            self.collect()
+
+
+class BackgroundClient:
+    """ Queues errors in memory and sends them from a daemon thread, so
+    logging never blocks on the collector. Repeats of an error still in the
+    queue are coalesced into one message carrying a `count`. Up to
+    `batch_size` messages are packed into each frame. The queue holds at
+    most `max_pending` distinct errors, beyond which the oldest (policy
+    'drop-oldest') or the new one ('drop-newest') is dropped. Fingerprints
+    are computed on the sender thread too.
+    """
+
+    KEY = ('project', 'language', 'type', 'message', 'file', 'line')
+
+    def __init__(self, server_uri, batch_size=100, flush_interval=1.0, max_pending=10000, policy='drop-oldest', hwm=1000):
+        if policy not in ('drop-oldest', 'drop-newest'):
+            raise ValueError('Unknown policy: ' + policy)
+
+        self.server_uri = server_uri
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.policy = policy
+        self.hwm = hwm
+
+        self.pending = OrderedDict()
+        self.condition = Condition()
+        self.sending = False
+        self.flushing = 0
+        self.closed = False
+        self.dropped = 0
+        self.sent = 0
+
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def key(self, error):
+        return tuple(repr(error.get(field)) for field in self.KEY)
+
+    def log_error(self, error):
+        now = time()
+        key = self.key(error)
+
+        with self.condition:
+            queued = self.pending.get(key)
+            if queued is not None:
+                queued['count'] += 1
+                queued['timestamp'] = error.get('timestamp', now)
+                return
+
+            if len(self.pending) >= self.max_pending:
+                self.dropped += 1
+                if self.policy == 'drop-newest':
+                    return
+                self.pending.popitem(last=False)
+
+            error = dict(error)
+            error.setdefault('timestamp', now)
+            error['timefirst'] = error['timestamp']
+            error['count'] = 1
+            self.pending[key] = error
+
+            if len(self.pending) >= self.batch_size:
+                self.condition.notify_all()
+
+    def take(self):
+        batch = []
+        while self.pending and len(batch) < self.batch_size:
+            batch.append(self.pending.popitem(last=False)[1])
+        return batch
+
+    def run(self):
+        # zeromq sockets must only be used from the thread that created them
+        context = zmq.Context()
+        socket = context.socket(zmq.PUB)
+        socket.setsockopt(SNDHWM, self.hwm)
+        socket.connect(self.server_uri)
+        packer = msgpack.Packer()
+
+        while True:
+            with self.condition:
+                if not (self.closed or self.flushing) and len(self.pending) < self.batch_size:
+                    self.condition.wait(self.flush_interval)
+                batch = self.take()
+                self.sending = bool(batch)
+                closed = self.closed and not self.pending
+
+            if batch:
+                for error in batch:
+                    error['fingerprint'] = fingerprint(error)
+                frame = ''.join(packer.pack(error) for error in batch)
+                try:
+                    socket.send(frame, zmq.NOBLOCK)
+                    self.sent += len(batch)
+                except zmq.ZMQError:
+                    self.dropped += len(batch)
+
+                with self.condition:
+                    self.sending = False
+                    self.condition.notify_all()
+
+            if closed:
+                socket.setsockopt(zmq.LINGER, 1000)
+                socket.close()
+                context.term()
+                return
+
+    def flush(self, timeout=5.0):
+        """ Waits up to `timeout` seconds for the queue to be handed to zeromq.
+        """
+        deadline = time() + timeout
+        with self.condition:
+            self.flushing += 1
+            self.condition.notify_all()
+            try:
+                while (self.pending or self.sending) and self.thread.is_alive():
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+                # false if the sender thread is gone
+                return not (self.pending or self.sending)
+            finally:
+                self.flushing -= 1
+
+    def close(self, timeout=5.0):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join(timeout)
+
+
+if __name__ == '__main__':
+    client = TriageClient("tcp://127.0.0.1:5001")
 
-for i in xrange(0, 1000000):
-    client.log_message('warn', 'This is a warning')
+    for i in xrange(0, 1000000):
+        client.log_message('warn', 'This is a warning')
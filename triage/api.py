@@ -3,17 +3,32 @@ import msgpack
 import mongoengine
 import logging
 from sys import argv
+from time import time
 from pyramid.paster import get_appsettings
-from models import Error, ErrorHasher, ErrorInstance
+from triage.ingest import ErrorBatch, decode, prepare
+from triage.pool import WorkerPool
+from triage.journal import Journal
+from triage.stats import stats
 
 #logging
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(levelname)s %(message)s')
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
 
 
 # config
 logging.info('Loading configuration')
 ZMQ_URI = "tcp://0.0.0.0:5001"
 settings = get_appsettings(argv[1], 'triage')
+BATCH_SIZE = int(settings.get('ingest.batch_size', 1))
+BATCH_WINDOW = float(settings.get('ingest.batch_window', 0))
+WORKERS = int(settings.get('ingest.workers', 0))
+JOURNAL_PATH = settings.get('ingest.journal_path')
+JOURNAL_SYNC_INTERVAL = float(settings.get('ingest.journal_sync_interval', 1))
+
+# per message debug logging is costly under load, only enable it when needed
+logging.getLogger().setLevel(settings.get('ingest.log_level', 'INFO').upper())
+
+# stats
+stats.start_reporter('api', settings)
 
 # zero mq
 logging.info('Initializing zeromq socket at: ' + ZMQ_URI)
@@ -21,37 +36,75 @@ context = zmq.Context()
 socket = context.socket(zmq.SUB)
 socket.bind(ZMQ_URI)
 socket.setsockopt(zmq.SUBSCRIBE, '')
+poller = zmq.Poller()
+poller.register(socket, zmq.POLLIN)
+
+# messagepack
+unpacker = msgpack.Unpacker()
+
+# journal, triage/drainer.py replays it into mongo
+if JOURNAL_PATH:
+    logging.info('Journaling to ' + JOURNAL_PATH)
+    journal = Journal(JOURNAL_PATH)
+    last_sync = time()
+    logging.info('Serving!')
+    while True:
+        try:
+            if poller.poll(JOURNAL_SYNC_INTERVAL * 1000):
+                for msg in decode(unpacker, socket.recv()):
+                    try:
+                        journal.append(prepare(msg, settings))
+                        stats.incr('journaled')
+                    except Exception:
+                        stats.incr('failed')
+                        logging.exception('Failed to process error')
+                journal.flush()
+
+            if time() - last_sync >= JOURNAL_SYNC_INTERVAL:
+                with stats.timer('journal.sync'):
+                    journal.sync()
+                last_sync = time()
+        except Exception:
+            stats.incr('failed')
+            logging.exception('Failed to journal error')
+
+# worker pool, workers connect to mongo themselves so this process must not
+if WORKERS:
+    logging.info('Starting %d ingest workers', WORKERS)
+    pool = WorkerPool(settings, WORKERS, context)
+    pool.start()
+    logging.info('Serving!')
+    pool.serve(socket, unpacker)
 
 # mongo
 logging.info('Connecting to mongo at: mongodb://' + settings['mongodb.host'] + '/' + settings['mongodb.db_name'])
 mongoengine.connect(settings['mongodb.db_name'], host=settings['mongodb.host'])
 
-
-# messagepack
-unpacker = msgpack.Unpacker()
+# batching
+logging.info('Batching up to %d messages every %.3fs', BATCH_SIZE, BATCH_WINDOW)
+batch = ErrorBatch.from_settings(settings)
 
 # serve!
 logging.info('Serving!')
 while True:
     try:
-        data = socket.recv()
-        logging.debug('received data')
-        unpacker.feed(data)
-        logging.debug('fed data to unpacker')
-        for msg in unpacker:
-            logging.debug('found message in unpacker')
-            if type(msg) == dict:
+        if poller.poll(batch.timeout()):
+            for msg in decode(unpacker, socket.recv()):
                 logging.debug('found object in message')
+                try:
+                    batch.add(prepare(msg, settings))
+                except Exception:
+                    stats.incr('failed')
+                    logging.exception('Failed to process error')
 
-                msg['hash'] = ErrorHasher(msg).get_hash()
-                if 'timestamp' not in msg:
-                    msg['timestamp'] = int(time())
-
-                Error.validate_and_upsert(msg)
-                logging.debug('saved error')
+                if batch.due():
+                    batch.flush()
+                    logging.debug('saved batch')
 
-                ErrorInstance.from_raw(msg).save(safe=False)
-                logging.debug('saved instance')
+        if batch.due():
+            batch.flush()
+            logging.debug('saved batch')
 
     except Exception, a:
+        stats.incr('failed')
         logging.exception('Failed to process error')
@@ -0,0 +1,244 @@
+import json
+import base64
+import random
+import msgpack
+import mongoengine
+import logging
+from bisect import bisect
+from optparse import OptionParser
+from time import time
+from pyramid import testing
+from pyramid.paster import get_appsettings
+from triage.ingest import ErrorBatch, decode, prepare
+from triage.models import Error, ErrorInstance, Blob
+
+# Load test for the ingest paths. Drives the zeromq/msgpack pipeline of
+# triage/api.py, the msgpack-rpc LoggingServer.error and the HTTP api_log
+# view in-process with a reproducible synthetic workload, against a scratch
+# database on the configured mongod, and reports sustained messages/sec,
+# per-message latency and mongo operations per message.
+#
+#   python triage/bench.py development.ini --path zmq --messages 100000
+
+TYPES = ['E_NOTICE', 'E_WARNING', 'Exception', 'TypeError', 'KeyError', 'PDOException']
+WORDS = ['user', 'contest', 'design', 'payment', 'invoice', 'session', 'brief', 'entry', 'upload', 'message']
+OPCOUNTERS = ['insert', 'query', 'update', 'delete', 'getmore', 'command']
+
+
+def letters(number):
+    # numbers are normalized away by ErrorHasher, so distinct errors get names
+    name = ''
+    while True:
+        number, digit = divmod(number, 26)
+        name += chr(ord('a') + digit)
+        if not number:
+            return name
+
+
+class ErrorGenerator:
+    """ Produces messages for `errors` distinct errors, picked with a
+    Zipfian distribution so a few errors dominate as they do in production.
+    Numbers and quoted strings vary between occurrences of the same error.
+    """
+
+    def __init__(self, errors, seed, skew=1.1, project='bench'):
+        self.random = random.Random(seed)
+        self.project = project
+        self.templates = [self.template(i) for i in xrange(errors)]
+
+        total = 0
+        self.cumulative = []
+        for rank in xrange(1, errors + 1):
+            total += 1.0 / rank ** skew
+            self.cumulative.append(total)
+
+    def template(self, index):
+        r = self.random
+        words = [r.choice(WORDS) for i in xrange(max(1, int(r.lognormvariate(2, 0.8))))]
+        depth = min(80, int(r.expovariate(1 / 15.0)) + 1)
+        path = '/srv/app/src/' + '/'.join(r.choice(WORDS) for i in xrange(3)) + '.php'
+        return {
+            'type': r.choice(TYPES),
+            'message': ' '.join(words) + " %d failed for '%s' in " + letters(index),
+            'file': path,
+            'line': r.randint(1, 2000),
+            'backtrace': [{
+                'class': r.choice(WORDS).capitalize(),
+                'function': r.choice(WORDS),
+                'file': path,
+                'line': r.randint(1, 2000)
+            } for i in xrange(depth)]
+        }
+
+    def message(self):
+        r = self.random
+        template = self.templates[bisect(self.cumulative, r.random() * self.cumulative[-1])]
+        return {
+            'project': self.project,
+            'language': 'php',
+            'type': template['type'],
+            'message': template['message'] % (r.randint(0, 100000), r.choice(WORDS)),
+            'file': template['file'],
+            'line': template['line'],
+            'backtrace': template['backtrace'],
+            'context': {'request': '/' + r.choice(WORDS), 'user': r.randint(0, 10000)},
+            'commithash': 'c0ffee',
+            'timestamp': time()
+        }
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def opcount(db):
+    counters = db.command('serverStatus')['opcounters']
+    return sum(counters.get(name, 0) for name in OPCOUNTERS)
+
+
+def run_zmq(generator, count, settings, latencies):
+    unpacker = msgpack.Unpacker()
+    batch = ErrorBatch.from_settings(settings)
+    pending = []
+
+    def flush():
+        batch.flush()
+        now = time()
+        latencies.extend(now - start for start in pending)
+        del pending[:]
+
+    for i in xrange(count):
+        data = msgpack.packb(generator.message())
+        start = time()
+        for msg in decode(unpacker, data):
+            batch.add(prepare(msg, settings))
+            pending.append(start)
+            if batch.due():
+                flush()
+
+    if len(batch):
+        flush()
+
+    return 0
+
+
+def run_rpc(generator, count, settings, latencies):
+    from triage.mpserver import LoggingServer
+    server = LoggingServer(settings)
+    failed = 0
+
+    for i in xrange(count):
+        msg = generator.message()
+        start = time()
+        if not server.error(msg):
+            failed += 1
+        latencies.append(time() - start)
+
+    return failed
+
+
+def run_rpc_batch(generator, count, settings, latencies, size=100):
+    from triage.mpserver import LoggingServer
+    server = LoggingServer(settings)
+
+    failed = 0
+
+    for i in xrange(0, count, size):
+        msgs = [generator.message() for j in xrange(min(size, count - i))]
+        start = time()
+        results = server.errors(msgs)
+        latencies.extend([time() - start] * len(msgs))
+        failed += sum(1 for result in results if not result['success'])
+
+    return failed
+
+
+def run_http(generator, count, settings, latencies):
+    from triage.views.api import log
+
+    # dummy requests take their registry, and so the settings, from here
+    testing.setUp(settings=dict(settings))
+    failed = 0
+
+    try:
+        for i in xrange(count):
+            msg = generator.message()
+            # the HTTP API takes backtraces as a list of function names
+            msg['backtrace'] = [frame['function'] for frame in msg['backtrace']]
+            request = testing.DummyRequest(params={'data': base64.b64encode(json.dumps(msg))})
+            start = time()
+            if not log(request)['success']:
+                failed += 1
+            latencies.append(time() - start)
+    finally:
+        testing.tearDown()
+
+    return failed
+
+
+PATHS = {
+    'zmq': run_zmq,
+    'rpc': run_rpc,
+    'rpc-batch': run_rpc_batch,
+    'http': run_http
+}
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog config.ini [options]')
+    parser.add_option('--path', choices=PATHS.keys(), default='zmq', help='ingest path: ' + ', '.join(PATHS))
+    parser.add_option('--messages', type='int', default=100000)
+    parser.add_option('--errors', type='int', default=1000, help='distinct errors')
+    parser.add_option('--skew', type='float', default=1.1, help='zipf exponent')
+    parser.add_option('--seed', type='int', default=1)
+    parser.add_option('--db', default='triage_bench', help='scratch database, dropped first')
+    parser.add_option('--json', action='store_true', help='print the report as json')
+    options, args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARN)
+    settings = get_appsettings(args[0], 'triage')
+    mongoengine.connect(options.db, host=settings['mongodb.host'])
+
+    db = Error.objects._collection.database
+    for document in [Error, ErrorInstance, Blob]:
+        document.drop_collection()
+    # indexes are created on first queryset access, recreate them now as
+    # maintaining them is part of the cost being measured
+    for document in [Error, ErrorInstance]:
+        document.objects._collection
+
+    generator = ErrorGenerator(options.errors, options.seed, options.skew)
+    latencies = []
+
+    ops = opcount(db)
+    started = time()
+    failed = PATHS[options.path](generator, options.messages, settings, latencies)
+    elapsed = time() - started
+    # the second serverStatus is counted too
+    ops = opcount(db) - ops - 1
+
+    # a path that swallows its errors would otherwise look very fast
+    persisted = Error.objects.sum('count')
+    if failed or persisted != options.messages:
+        logging.error('%d messages failed and %d of %d were persisted, not reporting', failed, persisted, options.messages)
+        raise SystemExit(1)
+
+    report = {
+        'path': options.path,
+        'messages': options.messages,
+        'errors': Error.objects.count(),
+        'seconds': elapsed,
+        'messages_per_second': options.messages / elapsed,
+        'latency_p50_ms': percentile(latencies, 0.5) * 1000,
+        'latency_p99_ms': percentile(latencies, 0.99) * 1000,
+        'mongo_ops_per_message': float(ops) / options.messages
+    }
+
+    if options.json:
+        print json.dumps(report, sort_keys=True)
+    else:
+        for key in sorted(report):
+            print '%-24s %s' % (key, report[key])
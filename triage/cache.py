@@ -0,0 +1,78 @@
+from hashlib import md5
+from datetime import date
+from repoze.lru import LRUCache
+from pyramid.renderers import render
+
+from triage.models import ProjectCounters, ReadMarker
+
+# Rendered error list responses, kept per process. A response's ETag hashes
+# the project's ProjectCounters.version and the user's ReadMarker.version
+# together with everything else the page depends on, and entries are
+# looked up by that ETag. Changing the project or what the user has seen
+# bumps a version, so stale entries are never hit again and age out of the
+# LRU; nothing has to be invalidated explicitly.
+
+# jQuery's cache busting parameter
+IGNORED_PARAMS = ['_']
+
+
+class ResponseCache:
+
+    def __init__(self, size):
+        self.cache = LRUCache(size) if size else None
+
+    @classmethod
+    def shared(cls, settings):
+        if 'cache.response_cache' not in settings:
+            settings['cache.response_cache'] = cls(int(settings.get('cache.response_size', 0)))
+        return settings['cache.response_cache']
+
+    def etag(self, request, project, renderer):
+        params = sorted((key, value) for key, value in request.GET.items() if key not in IGNORED_PARAMS and value)
+        key = [
+            renderer,
+            request.host_url,
+            project,
+            ProjectCounters.version_of(project),
+            ReadMarker.version_of(request.user, project),
+            str(request.user.id),
+            request.user.name,
+            request.user.tzoffset,
+            # dates render as a time today and as a day otherwise
+            date.today().isoformat(),
+            params
+        ]
+        return md5(repr(key)).hexdigest()
+
+    def respond(self, request, project, renderer, build):
+        """ The response for `request`, a 304 if the client has the current
+        one. Otherwise the cached body, or `build()` rendered with
+        `renderer`. build returns the template values and any headers to
+        send with them.
+        """
+        etag = self.etag(request, project, renderer)
+        response = request.response
+        response.etag = etag
+        # the list rows and the whole page share a url
+        response.vary = ('X-Requested-With',)
+        # browsers must revalidate, and only keep their own user's pages
+        response.cache_control = 'private, no-cache'
+
+        if etag in request.if_none_match:
+            response.status_int = 304
+            return response
+
+        entry = self.cache.get(etag) if self.cache is not None else None
+        if entry is None:
+            values, headers = build()
+            body = render(renderer, values, request)
+            if isinstance(body, unicode):
+                body = body.encode('utf-8')
+            entry = (body, headers)
+            if self.cache is not None:
+                self.cache.put(etag, entry)
+
+        body, headers = entry
+        response.body = body
+        response.headers.update(headers)
+        return response
@@ -0,0 +1,37 @@
+import mongoengine
+import logging
+from sys import argv
+from time import sleep
+from pyramid.paster import get_appsettings
+from triage.models import Project, ProjectCounters
+
+# Recounts every project's ProjectCounters from its errors every
+# counters.reconcile_interval seconds, correcting drift from concurrent
+# triage actions or writes that bypass Error.save. With no interval it runs
+# once and exits.
+
+#logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+# config
+logging.info('Loading configuration')
+settings = get_appsettings(argv[1], 'triage')
+INTERVAL = float(settings.get('counters.reconcile_interval', 0))
+
+# mongo
+logging.info('Connecting to mongo at: mongodb://' + settings['mongodb.host'] + '/' + settings['mongodb.db_name'])
+mongoengine.connect(settings['mongodb.db_name'], host=settings['mongodb.host'])
+
+while True:
+    for project in Project.objects():
+        try:
+            before = ProjectCounters.objects(project=project.token).first()
+            after = ProjectCounters.reconcile(project.token)
+            if before and (before.open, before.resolved) != (after.open, after.resolved):
+                logging.warning('Counters for %s drifted: open %d -> %d, resolved %d -> %d', project.token, before.open, after.open, before.resolved, after.resolved)
+        except Exception:
+            logging.exception('Failed to reconcile counters for %s', project.token)
+
+    if not INTERVAL:
+        break
+    sleep(INTERVAL)
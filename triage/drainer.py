@@ -0,0 +1,64 @@
+import mongoengine
+import logging
+from sys import argv
+from time import sleep
+from pyramid.paster import get_appsettings
+from triage.ingest import DeadLetters, ErrorBatch
+from triage.journal import JournalReader
+from triage.stats import stats
+
+# Replays the ingest journal written by triage/api.py into mongo in batches,
+# checkpointing after every batch that is written. A failed write is retried
+# before reading on, so nothing journaled is lost while mongo is down, and
+# records that cannot be written or read are dead-lettered rather than
+# holding up the rest.
+
+POLL_INTERVAL = 0.1
+RETRY_DELAY = 1.0
+
+#logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+# config
+logging.info('Loading configuration')
+settings = get_appsettings(argv[1], 'triage')
+BATCH_SIZE = int(settings.get('ingest.batch_size', 1))
+logging.getLogger().setLevel(settings.get('ingest.log_level', 'INFO').upper())
+
+# stats
+stats.start_reporter('drainer', settings)
+
+# mongo
+logging.info('Connecting to mongo at: mongodb://' + settings['mongodb.host'] + '/' + settings['mongodb.db_name'])
+mongoengine.connect(settings['mongodb.db_name'], host=settings['mongodb.host'])
+
+# journal
+logging.info('Draining journal at ' + settings['ingest.journal_path'])
+reader = JournalReader(settings['ingest.journal_path'], DeadLetters.shared(settings))
+batch = ErrorBatch.from_settings(settings, window=0)
+position = None
+
+while True:
+    try:
+        # what failed last time is retried before anything more is read, the
+        # batch dead-letters records that keep failing so this moves on
+        if not len(batch):
+            msgs, position = reader.read(BATCH_SIZE)
+            if not msgs:
+                sleep(POLL_INTERVAL)
+                continue
+
+            for msg in msgs:
+                try:
+                    batch.add(msg)
+                except Exception, e:
+                    stats.incr('failed')
+                    batch.dead_letters.put([msg], 'invalid: %s' % e)
+
+        if len(batch):
+            batch.flush()
+        reader.commit(position)
+        stats.gauge('journal.lag_bytes', reader.lag())
+    except Exception:
+        logging.exception('Failed to drain journal, retrying')
+        sleep(RETRY_DELAY)
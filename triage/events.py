@@ -0,0 +1,159 @@
+import os
+import zmq
+import msgpack
+import logging
+from collections import deque
+from random import getrandbits
+from sys import argv
+from threading import Condition, Lock, Thread, local
+from time import time, sleep
+
+from triage.stats import stats
+
+# "Error changed" events. Ingest publishes one per upserted error after
+# each batch, running this module forwards them from every ingest process
+# to every web process, and each web process keeps the recent ones in an
+# EventHub that long-polling browsers wait on. Publishing never blocks,
+# events are dropped when nothing is listening.
+#
+#   python triage/events.py development.ini
+
+PUBLISH_URI = 'ipc:///tmp/triage-events-in'
+SUBSCRIBE_URI = 'ipc:///tmp/triage-events-out'
+KEEP = 1000
+POLL_INTERVAL = 0.1
+
+_local = local()
+_contexts = {}
+_hubs = {}
+_hubs_lock = Lock()
+
+
+def context():
+    # zeromq contexts do not survive a fork, pool workers and preforked web
+    # workers each need their own
+    pid = os.getpid()
+    if pid not in _contexts:
+        _contexts[pid] = zmq.Context()
+    return _contexts[pid]
+
+
+class Publisher:
+
+    def __init__(self, uri):
+        self.socket = context().socket(zmq.PUB)
+        # zeromq 3 split the high water mark into one per direction
+        self.socket.setsockopt(zmq.SNDHWM if hasattr(zmq, 'SNDHWM') else zmq.HWM, 10000)
+        self.socket.connect(uri)
+
+    @classmethod
+    def shared(cls, settings):
+        """ This thread's publisher, or None if events.publish_uri is unset.
+        """
+        uri = settings.get('events.publish_uri')
+        if not uri:
+            return None
+        if getattr(_local, 'pid', None) != os.getpid():
+            _local.publisher = cls(uri)
+            _local.pid = os.getpid()
+        return _local.publisher
+
+    def publish(self, project, events):
+        try:
+            self.socket.send_multipart([str(project), msgpack.packb(events)], zmq.NOBLOCK)
+            stats.incr('events.published', len(events))
+        except zmq.ZMQError:
+            stats.incr('events.dropped', len(events))
+
+
+class EventHub:
+    """ The last KEEP events received by this process, numbered in arrival
+    order. Waiting browsers share one Condition, so an event costs a single
+    notify however many tabs are open.
+    """
+
+    def __init__(self, uri):
+        self.uri = uri
+        # numbers restart with the process, clients holding another id resync
+        self.id = '%x' % getrandbits(32)
+        self.seq = 0
+        self.events = deque(maxlen=KEEP)
+        self.condition = Condition()
+
+        thread = Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+
+    @classmethod
+    def shared(cls, settings):
+        """ This process' hub, or None if events.subscribe_uri is unset.
+        """
+        uri = settings.get('events.subscribe_uri')
+        if not uri:
+            return None
+        with _hubs_lock:
+            if os.getpid() not in _hubs:
+                _hubs[os.getpid()] = cls(uri)
+            return _hubs[os.getpid()]
+
+    def run(self):
+        socket = context().socket(zmq.SUB)
+        socket.setsockopt(zmq.SUBSCRIBE, '')
+        socket.connect(self.uri)
+
+        while True:
+            try:
+                project, data = socket.recv_multipart(zmq.NOBLOCK)
+            except zmq.ZMQError:
+                # sleep rather than block in zeromq, so this also works in
+                # web workers where threads are green
+                sleep(POLL_INTERVAL)
+                continue
+
+            try:
+                self.add(project, msgpack.unpackb(data))
+            except Exception:
+                logging.exception('Failed to process events')
+
+    def add(self, project, events):
+        with self.condition:
+            for event in events:
+                self.seq += 1
+                self.events.append((self.seq, project, event))
+            self.condition.notify_all()
+
+    def wait(self, project, since, timeout):
+        """ The events for `project` numbered after `since`, waiting up to
+        `timeout` seconds for one. Returns the latest number and the events,
+        None instead of the events if some were already discarded.
+        """
+        deadline = time() + timeout
+        with self.condition:
+            if since is None or since > self.seq:
+                since = self.seq
+
+            while True:
+                if self.events and since < self.events[0][0] - 1:
+                    return self.seq, None
+
+                events = [event for seq, name, event in self.events if seq > since and name == project]
+                remaining = deadline - time()
+                if events or remaining <= 0:
+                    return self.seq, events
+                self.condition.wait(remaining)
+
+
+if __name__ == '__main__':
+    from pyramid.paster import get_appsettings
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    settings = get_appsettings(argv[1], 'triage')
+
+    frontend = context().socket(zmq.SUB)
+    frontend.setsockopt(zmq.SUBSCRIBE, '')
+    frontend.bind(settings.get('events.publish_uri', PUBLISH_URI))
+    backend = context().socket(zmq.PUB)
+    backend.bind(settings.get('events.subscribe_uri', SUBSCRIBE_URI))
+
+    logging.info('Forwarding events from %s to %s', settings.get('events.publish_uri', PUBLISH_URI), settings.get('events.subscribe_uri', SUBSCRIBE_URI))
+    zmq.device(zmq.FORWARDER, frontend, backend)
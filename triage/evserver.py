@@ -0,0 +1,260 @@
+import os
+import zmq
+import msgpack
+import msgpackrpc
+import mongoengine
+import logging
+from Queue import Queue, Full, Empty
+from threading import Thread
+from time import sleep
+from sys import argv
+from zmq.eventloop import ioloop, zmqstream
+from pyramid.paster import get_appsettings
+from triage.ingest import ErrorBatch, decode, prepare
+from triage.pool import shard
+from triage.stats import stats
+
+
+# Single event loop ingest server: the zeromq SUB socket and the msgpack-rpc
+# server share one IOLoop and hand prepared messages to a bounded queue per
+# writer thread. The number of writers bounds the Mongo operations in flight.
+
+POLICIES = ['block', 'drop', 'spill']
+RETRY_DELAY = 1.0
+
+
+class Spill:
+    """ Overflow file for the 'spill' policy. Messages are appended to
+    `path` and read back once the queues have room again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.draining = path + '.draining'
+        self.out = None
+        self.input = None
+        self.unpacker = None
+        self.held = None
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, msg):
+        if self.out is None:
+            self.out = open(self.path, 'ab')
+        self.out.write(msgpack.packb(msg))
+        self.count += 1
+
+    def peek(self):
+        if self.held is None:
+            self.held = self.next()
+        return self.held
+
+    def pop(self):
+        msg = self.peek()
+        self.held = None
+        self.count = max(0, self.count - 1)
+        return msg
+
+    def next(self):
+        while True:
+            if self.unpacker is None:
+                if not os.path.exists(self.draining):
+                    if self.out is None and not os.path.exists(self.path):
+                        return None
+                    if self.out is not None:
+                        self.out.close()
+                        self.out = None
+                    os.rename(self.path, self.draining)
+                self.input = open(self.draining, 'rb')
+                self.unpacker = msgpack.Unpacker(self.input)
+
+            for msg in self.unpacker:
+                return msg
+
+            self.input.close()
+            self.unpacker = None
+            os.remove(self.draining)
+            if self.out is None and not os.path.exists(self.path):
+                return None
+
+
+class Writer(Thread):
+
+    def __init__(self, queue, batch):
+        Thread.__init__(self)
+        self.daemon = True
+        self.queue = queue
+        self.batch = batch
+
+    def run(self):
+        while True:
+            timeout = self.batch.timeout()
+            try:
+                msg = self.queue.get(True, None if timeout is None else timeout / 1000.0)
+                try:
+                    self.batch.add(msg)
+                except Exception:
+                    stats.incr('failed')
+                    logging.exception('Failed to process error')
+            except Empty:
+                pass
+
+            if self.batch.due():
+                self.flush()
+
+    def flush(self):
+        # retry before taking more, the queue filling up is what pushes back
+        # on ingest. The batch keeps only what failed and dead-letters what
+        # fails ingest.max_attempts times, so only an unreachable database
+        # holds this up for longer.
+        while True:
+            try:
+                self.batch.flush()
+                return
+            except Exception:
+                stats.incr('failed')
+                logging.exception('Failed to save batch, retrying')
+                sleep(RETRY_DELAY)
+
+
+class IngestQueue:
+
+    def __init__(self, writers, size, policy, spill_path):
+        if policy not in POLICIES:
+            raise ValueError('Unknown queue policy: ' + policy)
+
+        self.policy = policy
+        self.queues = [Queue(max(1, size / writers)) for i in xrange(writers)]
+        self.spill = Spill(spill_path) if policy == 'spill' else None
+        self.dropped = 0
+        self.settings = None
+
+    def start(self, settings):
+        self.settings = settings
+        for queue in self.queues:
+            Writer(queue, ErrorBatch.from_settings(settings)).start()
+
+    def put(self, msg):
+        msg = prepare(msg, self.settings)
+        queue = self.queues[shard(msg, len(self.queues))]
+        stats.gauge('queue.depth', sum(q.qsize() for q in self.queues))
+
+        # blocking stalls the whole loop, so zeromq and msgpack-rpc both stop reading
+        if self.policy == 'block':
+            queue.put(msg)
+            return True
+
+        # keep spilled messages in order, they go to disk until the spill is drained
+        if self.spill is not None and len(self.spill):
+            self.spill.append(msg)
+            stats.incr('spilled')
+            return True
+
+        try:
+            queue.put_nowait(msg)
+            return True
+        except Full:
+            if self.spill is not None:
+                self.spill.append(msg)
+                stats.incr('spilled')
+                return True
+
+            stats.incr('dropped')
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logging.warning('Ingest queue full, %d messages dropped so far', self.dropped)
+            return False
+
+    def drain_spill(self):
+        while self.spill.peek() is not None:
+            msg = self.spill.peek()
+            try:
+                self.queues[shard(msg, len(self.queues))].put_nowait(msg)
+            except Full:
+                return
+            self.spill.pop()
+            stats.gauge('spill.pending', len(self.spill))
+
+
+class LoggingServer:
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def error(self, msg):
+        stats.incr('received')
+        try:
+            return self.queue.put(msg)
+        except Exception:
+            stats.incr('failed')
+            logging.exception('Failed to process error')
+            return False
+
+    def errors(self, msgs):
+        return [{'success': self.error(msg) is True} for msg in msgs]
+
+
+if __name__ == '__main__':
+    #logging
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+    # config
+    logging.info('Loading configuration')
+    ZMQ_URI = "tcp://0.0.0.0:5001"
+    settings = get_appsettings(argv[1], 'triage')
+    QUEUE_SIZE = int(settings.get('ingest.queue_size', 10000))
+    QUEUE_POLICY = settings.get('ingest.queue_policy', 'block')
+    WRITERS = int(settings.get('ingest.max_inflight', 4))
+    logging.getLogger().setLevel(settings.get('ingest.log_level', 'INFO').upper())
+
+    # stats
+    stats.start_reporter('evserver', settings)
+
+    # mongo
+    logging.info('Connecting to mongo at: mongodb://' + settings['mongodb.host'] + '/' + settings['mongodb.db_name'])
+    mongoengine.connect(settings['mongodb.db_name'], host=settings['mongodb.host'])
+
+    # queue
+    logging.info('Queueing up to %d messages (%s) for %d writers', QUEUE_SIZE, QUEUE_POLICY, WRITERS)
+    queue = IngestQueue(WRITERS, QUEUE_SIZE, QUEUE_POLICY, settings.get('ingest.spill_path', '/tmp/triage-spill'))
+    queue.start(settings)
+
+    # event loop, shared with tornado so msgpack-rpc runs on it as well
+    ioloop.install()
+    loop = ioloop.IOLoop.instance()
+
+    # zero mq, the high water mark bounds what zeromq buffers while we are blocked
+    logging.info('Initializing zeromq socket at: ' + ZMQ_URI)
+    context = zmq.Context()
+    socket = context.socket(zmq.SUB)
+    # zeromq 3 split it into one per direction
+    socket.setsockopt(zmq.RCVHWM if hasattr(zmq, 'RCVHWM') else zmq.HWM, QUEUE_SIZE)
+    socket.bind(ZMQ_URI)
+    socket.setsockopt(zmq.SUBSCRIBE, '')
+
+    unpacker = msgpack.Unpacker()
+
+    def on_recv(frames):
+        for data in frames:
+            for msg in decode(unpacker, data):
+                try:
+                    queue.put(msg)
+                except Exception:
+                    stats.incr('failed')
+                    logging.exception('Failed to process error')
+
+    stream = zmqstream.ZMQStream(socket, loop)
+    stream.on_recv(on_recv)
+
+    if queue.spill is not None:
+        ioloop.PeriodicCallback(queue.drain_spill, 100, loop).start()
+
+    # msgpack-rpc
+    logging.info('Creating server at ' + settings['errorserver.host'] + ':' + settings['errorserver.port'])
+    server = msgpackrpc.Server(LoggingServer(queue), loop=msgpackrpc.Loop(loop))
+    server.listen(msgpackrpc.Address(settings['errorserver.host'], int(settings['errorserver.port'])))
+
+    logging.info('Serving!')
+    loop.start()
@@ -0,0 +1,167 @@
+import pymongo
+import mongoengine
+import logging
+from optparse import OptionParser
+from time import time
+from pyramid.paster import get_appsettings
+from bson.objectid import ObjectId
+from triage.models import Error, ErrorInstance, Project, ReadMarker, SEARCH_CANDIDATES, SeenOverride, User
+from triage.views.error import ORDER_MAP, filter_errors
+
+# Index advisor: explains every canonical error list, search and unseen
+# count query against the configured database and reports the ones that
+# scan the whole collection, sort in memory, or examine far more documents
+# than they return. Exits non-zero if any query is flagged, so it can gate
+# deploys.
+#
+#   python triage/indexes.py production.ini --project <token>
+#
+# mongoengine 0.5.2 builds an index missing from a document's meta in the
+# foreground the first time the collection is used, which blocks the
+# database for as long as the build takes. After changing any meta indexes
+# build them in the background before deploying:
+#
+#   python triage/indexes.py production.ini --build
+
+INDEXED = [Error, ErrorInstance, SeenOverride, ReadMarker]
+
+PAGE_SIZE = 20
+
+
+def walk(stage):
+    yield stage
+    for child in [stage.get('inputStage')] + stage.get('inputStages', []):
+        if child:
+            for descendant in walk(child):
+                yield descendant
+
+
+def summarize(plan):
+    """ Normalizes the explain output of mongod 2.x and 3.x+.
+    """
+    if 'queryPlanner' in plan:
+        stages = list(walk(plan['queryPlanner']['winningPlan']))
+        execution = plan.get('executionStats', {})
+        return {
+            'index': ','.join(s['indexName'] for s in stages if 'indexName' in s) or None,
+            'collscan': any(s['stage'] == 'COLLSCAN' for s in stages),
+            'sort': any(s['stage'] == 'SORT' for s in stages),
+            'keys': execution.get('totalKeysExamined', 0),
+            'examined': execution.get('totalDocsExamined', 0),
+            'returned': execution.get('nReturned', 0)
+        }
+
+    return {
+        'index': plan['cursor'] if plan['cursor'].startswith('BtreeCursor') else None,
+        'collscan': plan['cursor'].startswith('BasicCursor'),
+        'sort': plan.get('scanAndOrder', False),
+        'keys': plan.get('nscanned', 0),
+        'examined': plan.get('nscannedObjects', 0),
+        'returned': plan.get('n', 0)
+    }
+
+
+def index_specs(document):
+    """ The indexes a document declares, as pymongo key lists and whether
+    they are unique.
+    """
+    for spec in document._meta.get('indexes', []):
+        if isinstance(spec, dict):
+            yield spec['fields'], spec.get('unique', False)
+            continue
+        if isinstance(spec, basestring):
+            spec = (spec,)
+        keys = []
+        for field in spec:
+            name = field.lstrip('+-')
+            keys.append(('_id' if name == 'id' else name, pymongo.DESCENDING if field.startswith('-') else pymongo.ASCENDING))
+        yield keys, False
+
+    for name, field in document._fields.items():
+        if field.unique:
+            others = field.unique_with or []
+            if isinstance(others, basestring):
+                others = [others]
+            yield [(field.db_field, pymongo.ASCENDING)] + [(other, pymongo.ASCENDING) for other in others], True
+
+
+def build(db):
+    for document in INDEXED:
+        collection = db[document._meta['collection']]
+        for keys, unique in index_specs(document):
+            logging.info('Building %s index %s', collection.name, keys)
+            collection.ensure_index(keys, unique=unique, background=True)
+
+
+def canonical_queries(project, user):
+    """ The query shapes issued by error_list, search and the unseen
+    counts, named for the report.
+    """
+    now = time()
+
+    for show in ['open', 'resolved', 'mine']:
+        for order_by, field in sorted(ORDER_MAP.items()):
+            errors = filter_errors(project, show, user).filter(timelatest__lte=now)
+            yield 'list %s by %s' % (show, order_by), errors.order_by('-' + field, '-id').limit(PAGE_SIZE + 1)
+
+    for search in ['error', 'err*', 'error OR warning']:
+        errors = filter_errors(project, 'open', user, search).filter(timelatest__lte=now)
+        yield 'search %s' % search, errors.order_by('-timelatest').limit(SEARCH_CANDIDATES)
+
+    for name, exists in [('open', False), ('resolved', True)]:
+        yield 'unseen %s' % name, project.errors().filter(timelatest__gt=now - 86400, hiddenby__exists=exists)
+
+    yield 'seen overrides', SeenOverride.objects(user=user, project=project.token)
+
+
+def check(summary, ratio):
+    problems = []
+    if summary['collscan']:
+        problems.append('COLLSCAN')
+    if summary['sort']:
+        problems.append('in-memory sort')
+    if summary['examined'] > ratio * max(summary['returned'], PAGE_SIZE):
+        problems.append('examined %d for %d' % (summary['examined'], summary['returned']))
+    return problems
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog config.ini [options]')
+    parser.add_option('--project', action='append', help='project token, all projects by default')
+    parser.add_option('--ratio', type='float', default=10, help='flag queries examining this many times more documents than a page')
+    parser.add_option('--build', action='store_true', help='build the declared indexes in the background and exit')
+    options, args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    settings = get_appsettings(args[0], 'triage')
+
+    if options.build:
+        # straight through pymongo, mongoengine would build them in the foreground first
+        build(pymongo.Connection(settings['mongodb.host'])[settings['mongodb.db_name']])
+        raise SystemExit(0)
+
+    mongoengine.connect(settings['mongodb.db_name'], host=settings['mongodb.host'])
+
+    projects = Project.objects(token__in=options.project) if options.project else Project.objects()
+    user = User.objects.first()
+    user = user.id if user else ObjectId()
+
+    flagged = 0
+    for project in projects:
+        print '%s (%s)' % (project.name, project.token)
+        for name, queryset in canonical_queries(project, user):
+            summary = summarize(queryset.explain())
+            problems = check(summary, options.ratio)
+            flagged += bool(problems)
+
+            print '  %-4s %-32s keys %-8d docs %-8d returned %-8d %s' % (
+                'FLAG' if problems else 'ok',
+                name,
+                summary['keys'],
+                summary['examined'],
+                summary['returned'],
+                ', '.join(problems) or summary['index']
+            )
+
+    print '%d queries flagged' % flagged
+    raise SystemExit(1 if flagged else 0)
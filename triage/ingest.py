@@ -0,0 +1,435 @@
+import os
+import msgpack
+import logging
+from random import random
+from time import time
+from repoze.lru import LRUCache
+from pymongo.errors import ConnectionFailure
+
+from triage.models import Error, ErrorHasher, ErrorInstance, ProjectCounters, share_payload, without_shared_payload, upsert_delta
+from triage.stats import stats
+from triage.events import Publisher
+
+
+# flushes an error may fail before it is dead-lettered, and the pause
+# before a batch that failed is due again
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 1.0
+
+
+def decode(unpacker, data):
+    """ Feeds a received frame to the unpacker and returns the complete
+    messages it yields, skipping anything that is not an object.
+    """
+    stats.incr('received')
+    stats.incr('received.bytes', len(data))
+    stats.observe('frame.bytes', len(data))
+
+    with stats.timer('decode'):
+        unpacker.feed(data)
+        msgs = [msg for msg in unpacker if type(msg) == dict]
+
+    stats.incr('decoded', len(msgs))
+    return msgs
+
+
+def ingest(msg, settings):
+    """ Persists a single raw message: the hash is computed once, the error
+    is upserted in one round trip and the instance is written. Every ingest
+    front-end goes through prepare() and ErrorBatch the same way.
+    """
+    batch = ErrorBatch.from_settings(settings, size=1, window=0)
+    batch.add(prepare(msg, settings))
+    try:
+        batch.flush()
+    except FlushError, e:
+        # counted already if only the instance is left, a retry would count it again
+        if batch.settle(str(e)):
+            raise
+
+
+def prepare(msg, settings=None):
+    fingerprints = Fingerprints.shared(settings) if settings is not None else None
+    with stats.timer('hash'):
+        if fingerprints is not None:
+            msg['hash'] = fingerprints.hash(msg)
+        else:
+            msg.pop('fingerprint', None)
+            msg['hash'] = ErrorHasher(msg).get_hash()
+    stats.incr('hashed')
+    if 'timestamp' not in msg:
+        msg['timestamp'] = int(time())
+    msg['timelatest'] = msg['timestamp']
+    # clients that coalesce repeats send the first occurrence and a count
+    if 'timefirst' not in msg:
+        msg['timefirst'] = msg['timestamp']
+    return msg
+
+
+class Fingerprints:
+    """ Per project policy for fingerprints computed by clients. Projects
+    listed in `trust` have a fingerprint of the current version used as the
+    hash as is, projects in `verify` have it checked against the hash
+    computed here, and everything else is hashed here. '*' matches every
+    project.
+    """
+
+    def __init__(self, trust=(), verify=()):
+        self.trust = set(trust)
+        self.verify = set(verify)
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.get('ingest.fingerprint_trust', '').split(), settings.get('ingest.fingerprint_verify', '').split())
+
+    @classmethod
+    def shared(cls, settings):
+        if 'ingest.fingerprints' not in settings:
+            settings['ingest.fingerprints'] = cls.from_settings(settings)
+        return settings['ingest.fingerprints']
+
+    def mode(self, project):
+        for mode, projects in (('trust', self.trust), ('verify', self.verify)):
+            if project in projects or '*' in projects:
+                return mode
+        return None
+
+    def hash(self, msg):
+        fingerprint = msg.pop('fingerprint', None)
+        mode = self.mode(msg.get('project'))
+        if fingerprint is None or mode is None:
+            return ErrorHasher(msg).get_hash()
+
+        hash = ErrorHasher.parse_fingerprint(fingerprint)
+        if hash is None:
+            stats.incr('fingerprint.stale')
+            return ErrorHasher(msg).get_hash()
+
+        if mode == 'trust':
+            stats.incr('fingerprint.trusted')
+            return hash
+
+        computed = ErrorHasher(msg).get_hash()
+        if computed != hash:
+            stats.incr('fingerprint.mismatch')
+            logging.warning('Fingerprint %s from project %s does not match hash %s', fingerprint, msg.get('project'), computed)
+        else:
+            stats.incr('fingerprint.verified')
+        return computed
+
+
+class Sampler:
+    """ Decides which occurrences of an error get an ErrorInstance stored.
+    Per hash, the first `first` occurrences in every `window` seconds are
+    kept, and after that the n-th one is kept with probability
+    `reservoir / n`. An occurrence from a commit not recently seen for the
+    hash is always kept.
+    """
+    COMMITS = 16
+
+    def __init__(self, first, window, reservoir, size=10000):
+        self.first = first
+        self.window = window
+        self.reservoir = reservoir
+        self.states = LRUCache(size)
+
+    @classmethod
+    def from_settings(cls, settings):
+        first = int(settings.get('ingest.sample_first', 0))
+        if not first:
+            return None
+        return cls(first, float(settings.get('ingest.sample_window', 60)), int(settings.get('ingest.sample_reservoir', 10)))
+
+    @classmethod
+    def shared(cls, settings):
+        """ The process wide sampler for `settings`, so per hash state
+        survives across batches created for single messages.
+        """
+        if 'ingest.sampler' not in settings:
+            settings['ingest.sampler'] = cls.from_settings(settings)
+        return settings['ingest.sampler']
+
+    def keep(self, msg):
+        state = self.states.get(msg['hash'])
+        if state is None or msg['timestamp'] - state['start'] >= self.window:
+            state = {
+                'start': msg['timestamp'],
+                'seen': 0,
+                'commits': state['commits'] if state else []
+            }
+            self.states.put(msg['hash'], state)
+
+        state['seen'] += 1
+
+        commit = msg.get('commithash')
+        if commit not in state['commits']:
+            state['commits'] = state['commits'][1 - self.COMMITS:] + [commit]
+            return True
+
+        if state['seen'] <= self.first:
+            return True
+
+        return random() * (state['seen'] - self.first) < self.reservoir
+
+
+class FlushError(Exception):
+    pass
+
+
+class DeadLetters:
+    """ Messages that could not be written, kept out of the way so they do
+    not hold up everything behind them. They are counted and logged, and
+    with ingest.dead_letter_path appended to a msgpack file per process
+    from which they can be inspected or replayed.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(settings.get('ingest.dead_letter_path') or None)
+
+    @classmethod
+    def shared(cls, settings):
+        if 'ingest.dead_letters' not in settings:
+            settings['ingest.dead_letters'] = cls.from_settings(settings)
+        return settings['ingest.dead_letters']
+
+    def put(self, msgs, reason):
+        stats.incr('dead_lettered', len(msgs))
+        logging.error('Dead-lettering %d messages: %s', len(msgs), reason)
+
+        if self.path is not None:
+            try:
+                if not os.path.isdir(self.path):
+                    os.makedirs(self.path)
+                out = open(os.path.join(self.path, 'dead-%d.msgpack' % os.getpid()), 'ab')
+                try:
+                    for msg in msgs:
+                        out.write(msgpack.packb(msg))
+                finally:
+                    out.close()
+                return
+            except Exception:
+                logging.exception('Failed to write dead letters to %s', self.path)
+
+        for msg in msgs:
+            logging.error('Dead letter: %r', msg)
+
+
+class ErrorBatch:
+    """ Collects prepared messages and coalesces them by hash so that a
+    flush costs one upsert per distinct error plus a single bulk insert
+    for all the instances. With a sampler, occurrences it rejects still
+    count towards the error but store no instance. Payload kinds listed in
+    `shared` ('backtrace', 'context') are stored once as blobs and
+    referenced from the error and its instances. Each written error is
+    announced through `publisher`, see triage/events.py.
+
+    Whatever a flush fails to write stays in the batch for the next one,
+    which picks up where it failed so nothing is counted twice. An error or
+    group of instances that fails `attempts` flushes for any reason but an
+    unreachable database goes to `dead_letters` instead.
+    """
+
+    def __init__(self, size=1, window=0, sampler=None, shared=(), publisher=None, attempts=MAX_ATTEMPTS, dead_letters=None):
+        self.size = size
+        self.window = window
+        self.sampler = sampler
+        self.shared = shared
+        self.publisher = publisher
+        self.attempts = attempts
+        self.dead_letters = dead_letters or DeadLetters()
+        self.deadline = None
+        self.backoff = None
+        self.counters = {}
+        self.reset()
+
+    @classmethod
+    def from_settings(cls, settings, size=None, window=None):
+        if size is None:
+            size = int(settings.get('ingest.batch_size', 1))
+        if window is None:
+            window = float(settings.get('ingest.batch_window', 0))
+        shared = settings.get('ingest.shared_payload', 'backtrace').split()
+        attempts = int(settings.get('ingest.max_attempts', MAX_ATTEMPTS))
+        return cls(size, window, Sampler.shared(settings), shared, Publisher.shared(settings), attempts, DeadLetters.shared(settings))
+
+    def settle(self, reason):
+        """ Ends a batch that will not be flushed again. The instances of
+        errors already upserted are dead-lettered, since their occurrences
+        are counted and must not be sent again. Returns the messages whose
+        error was not written, for the caller to report as failed.
+        """
+        for group in self.instances:
+            self.dead_letters.put(group['messages'], 'instances not written: ' + reason)
+        failed = [msg for entry in self.errors.itervalues() for msg in entry['messages']]
+        self.reset()
+        return failed
+
+    def reset(self):
+        """ Forgets everything not yet written.
+        """
+        # errors waiting for their upsert, by hash
+        self.errors = {}
+        # instances of upserted errors waiting for their insert
+        self.instances = []
+
+    def __len__(self):
+        return sum(len(entry['messages']) for entry in self.errors.itervalues()) + \
+            sum(len(group['messages']) for group in self.instances)
+
+    @property
+    def messages(self):
+        return [msg for entry in self.errors.itervalues() for msg in entry['messages']] + \
+            [msg for group in self.instances for msg in group['messages']]
+
+    def timeout(self):
+        """ Milliseconds until the batch is due, or None while it is empty.
+        """
+        if not self.errors and not self.instances:
+            return None
+        return max(0, max(self.deadline, self.backoff or 0) - time()) * 1000
+
+    def due(self):
+        if not self.errors and not self.instances:
+            return False
+        if self.backoff is not None and time() < self.backoff:
+            return False
+        return len(self) >= self.size or time() >= self.deadline
+
+    def add(self, msg):
+        try:
+            Error.create_from_msg(msg).validate()
+        except Exception:
+            stats.incr('failed.validate')
+            raise
+
+        if not self.errors and not self.instances:
+            self.deadline = time() + self.window
+
+        # a hash only identifies an error within its project
+        key = (msg['project'], msg['hash'])
+        entry = self.errors.get(key)
+        if entry is None:
+            entry = self.errors[key] = {
+                'first': msg,
+                'latest': msg,
+                'count': 0,
+                'sampled': 0,
+                'keywords': set(),
+                'messages': [],
+                'instances': [],
+                'attempts': 0
+            }
+
+        if msg['timefirst'] < entry['first']['timefirst']:
+            entry['first'] = msg
+        if msg['timelatest'] >= entry['latest']['timelatest']:
+            entry['latest'] = msg
+        occurrences = max(1, int(msg.get('count', 1)))
+        entry['count'] += occurrences
+        entry['keywords'].update(Error.keywords_from_msg(msg))
+
+        # a coalesced message stores at most one instance for all its occurrences
+        entry['messages'].append(msg)
+        if self.sampler is None or self.sampler.keep(msg):
+            entry['instances'].append(msg)
+            entry['sampled'] += occurrences - 1
+        else:
+            entry['sampled'] += occurrences
+
+    def failed(self, item, error):
+        """ Records a failed write of an error entry or instance group,
+        returns True if it was given up on.
+        """
+        logging.warning('Failed to write %d messages: %s', len(item['messages']), error)
+        if isinstance(error, ConnectionFailure):
+            # not the data's fault, retry for as long as it takes
+            return False
+
+        item['attempts'] += 1
+        if item['attempts'] < self.attempts:
+            return False
+
+        self.dead_letters.put(item['messages'], 'failed %d writes, last with %s' % (item['attempts'], error))
+        return True
+
+    def flush(self):
+        """ Writes what the batch holds and returns how many messages were
+        written, raises FlushError if some are left to retry.
+        """
+        errors = len(self.errors)
+        written = 0
+        events = {}
+
+        with stats.timer('mongo.write'):
+            for key, entry in self.errors.items():
+                try:
+                    if self.shared:
+                        share_payload(entry['latest'], self.shared)
+                        instances = [without_shared_payload(share_payload(msg, self.shared)) for msg in entry['instances']]
+                    else:
+                        instances = entry['instances']
+                    docs = ErrorInstance.documents(instances)
+                    before = Error.upsert(entry['first'], entry['latest'], entry['count'], list(entry['keywords']), entry['sampled'])
+                except Exception, e:
+                    stats.incr('failed.write', len(entry['messages']))
+                    if self.failed(entry, e):
+                        del self.errors[key]
+                    continue
+
+                del self.errors[key]
+                stats.incr('sampled', len(entry['messages']) - len(entry['instances']))
+                latest = entry['latest']
+                delta = self.counters.setdefault(latest['project'], {})
+                for key, value in upsert_delta(before).iteritems():
+                    delta[key] = delta.get(key, 0) + value
+                events.setdefault(latest['project'], []).append({
+                    'hash': latest['hash'],
+                    'timelatest': latest['timelatest'],
+                    'count': entry['count'],
+                    'new': not before
+                })
+                self.instances.append({'docs': docs, 'messages': entry['messages'], 'attempts': 0})
+
+            groups, self.instances = self.instances, []
+            try:
+                ErrorInstance.insert_documents([doc for group in groups for doc in group['docs']])
+                written += sum(len(group['messages']) for group in groups)
+            except Exception:
+                # find the groups at fault, inserting a document twice is harmless
+                for group in groups:
+                    try:
+                        ErrorInstance.insert_documents(group['docs'])
+                        written += len(group['messages'])
+                    except Exception, e:
+                        stats.incr('failed.write', len(group['messages']))
+                        if not self.failed(group, e):
+                            self.instances.append(group)
+
+            for project, delta in self.counters.items():
+                try:
+                    ProjectCounters.add(project, delta)
+                    del self.counters[project]
+                except Exception:
+                    # retried with the next flush, and reconciled should the process die first
+                    logging.exception('Failed to update counters of %s', project)
+
+        if self.publisher is not None:
+            for project, project_events in events.iteritems():
+                self.publisher.publish(project, project_events)
+
+        stats.incr('upserted', sum(len(project_events) for project_events in events.itervalues()))
+        stats.incr('persisted', written)
+        stats.observe('batch.messages', written)
+        stats.observe('batch.errors', errors)
+
+        if self.errors or self.instances:
+            self.backoff = time() + RETRY_DELAY
+            raise FlushError('%d messages left to retry' % len(self))
+
+        self.backoff = None
+        logging.debug('flushed %d messages as %d errors', written, errors)
+        return written
@@ -0,0 +1,196 @@
+import os
+import mmap
+import struct
+import logging
+import msgpack
+from zlib import crc32 as _crc32
+
+
+# Append-only, segment rotated journal. Each record is a (length, crc32)
+# header followed by the msgpack encoded message. Segments are named after
+# their sequence number and removed once a reader has checkpointed past them.
+
+HEADER = struct.Struct('>II')
+SEGMENT_SIZE = 64 * 1024 * 1024
+CHECKPOINT = 'checkpoint'
+
+
+def crc32(data):
+    return _crc32(data) & 0xffffffff
+
+
+def segment_name(number):
+    return '%020d.log' % number
+
+
+def list_segments(path):
+    return sorted(int(name[:-4]) for name in os.listdir(path) if name.endswith('.log'))
+
+
+def valid_length(filename):
+    """ Length of the run of complete, intact records at the start of a segment.
+    """
+    f = open(filename, 'rb')
+    try:
+        offset = 0
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return offset
+            length, checksum = HEADER.unpack(header)
+            record = f.read(length)
+            if len(record) < length or crc32(record) != checksum:
+                return offset
+            offset += HEADER.size + length
+    finally:
+        f.close()
+
+
+class Journal:
+
+    def __init__(self, path, segment_size=SEGMENT_SIZE):
+        self.path = path
+        self.segment_size = segment_size
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        segments = list_segments(path)
+        if segments:
+            self.recover(segments[-1])
+        self.open(segments[-1] if segments else 0)
+
+    def recover(self, number):
+        # drop a record torn by a crash so appends resume on a record boundary
+        filename = os.path.join(self.path, segment_name(number))
+        length = valid_length(filename)
+        if length < os.path.getsize(filename):
+            f = open(filename, 'r+b')
+            f.truncate(length)
+            f.close()
+
+    def open(self, number):
+        self.number = number
+        self.out = open(os.path.join(self.path, segment_name(number)), 'ab')
+        self.size = self.out.tell()
+
+    def append(self, msg):
+        data = msgpack.packb(msg)
+        self.out.write(HEADER.pack(len(data), crc32(data)))
+        self.out.write(data)
+        self.size += HEADER.size + len(data)
+
+        if self.size >= self.segment_size:
+            self.rotate()
+
+    def rotate(self):
+        self.sync()
+        self.out.close()
+        self.open(self.number + 1)
+
+    def flush(self):
+        """ Hands buffered records to the OS, enough to survive a process crash.
+        """
+        self.out.flush()
+
+    def sync(self):
+        self.out.flush()
+        os.fsync(self.out.fileno())
+
+
+class JournalReader:
+    """ Reads records from memory mapped segments starting at the last
+    checkpoint. Call commit() with the returned position once the records
+    are safely persisted. Records that fail their checksum or do not decode
+    are skipped, their raw bytes handed to `dead_letters` if given.
+    """
+
+    def __init__(self, path, dead_letters=None):
+        self.path = path
+        self.dead_letters = dead_letters
+        self.number, self.offset = self.load_checkpoint()
+
+    def load_checkpoint(self):
+        try:
+            number, offset = open(os.path.join(self.path, CHECKPOINT)).read().split()
+            return int(number), int(offset)
+        except (IOError, ValueError):
+            segments = list_segments(self.path)
+            return (segments[0] if segments else 0), 0
+
+    def read(self, limit):
+        msgs = []
+        number, offset = self.number, self.offset
+
+        while len(msgs) < limit:
+            filename = os.path.join(self.path, segment_name(number))
+            if not os.path.exists(filename):
+                break
+
+            records, offset = self.read_segment(filename, offset, limit - len(msgs))
+            msgs.extend(records)
+
+            # move on only once the writer has started the next segment
+            if len(msgs) < limit and os.path.exists(os.path.join(self.path, segment_name(number + 1))):
+                number, offset = number + 1, 0
+            else:
+                break
+
+        return msgs, (number, offset)
+
+    def read_segment(self, filename, offset, limit):
+        msgs = []
+        f = open(filename, 'rb')
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if size <= offset:
+                return msgs, offset
+
+            data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+            try:
+                while len(msgs) < limit and offset + HEADER.size <= size:
+                    length, checksum = HEADER.unpack_from(data, offset)
+                    end = offset + HEADER.size + length
+                    if end > size:
+                        # partially written record, the writer will finish it
+                        break
+
+                    record = data[offset + HEADER.size:end]
+                    try:
+                        if crc32(record) != checksum:
+                            raise ValueError('checksum mismatch')
+                        msgs.append(msgpack.unpackb(record))
+                    except Exception, e:
+                        self.skip(filename, offset, record, e)
+                    offset = end
+            finally:
+                data.close()
+        finally:
+            f.close()
+
+        return msgs, offset
+
+    def skip(self, filename, offset, record, error):
+        logging.error('Skipping corrupt journal record in %s at %d: %s', filename, offset, error)
+        if self.dead_letters is not None:
+            self.dead_letters.put([{'journal': filename, 'offset': offset, 'record': record}], 'corrupt journal record')
+
+    def commit(self, position):
+        number, offset = position
+        filename = os.path.join(self.path, CHECKPOINT)
+        f = open(filename + '.tmp', 'w')
+        f.write('%d %d' % (number, offset))
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(filename + '.tmp', filename)
+
+        for segment in list_segments(self.path):
+            if segment < number:
+                os.remove(os.path.join(self.path, segment_name(segment)))
+
+        self.number, self.offset = number, offset
+
+    def lag(self):
+        segments = [s for s in list_segments(self.path) if s >= self.number]
+        total = sum(os.path.getsize(os.path.join(self.path, segment_name(s))) for s in segments)
+        return total - self.offset
@@ -0,0 +1,79 @@
+import mongoengine
+import logging
+from sys import argv
+from pyramid.paster import get_appsettings
+from triage.models import Error, ErrorInstance, ReadMarker, SeenOverride
+
+# Backfills fields that newer code keeps up to date as errors change, for
+# errors last written before those fields existed. Safe to run repeatedly.
+
+#logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+# config
+logging.info('Loading configuration')
+settings = get_appsettings(argv[1], 'triage')
+
+# mongo
+logging.info('Connecting to mongo at: mongodb://' + settings['mongodb.host'] + '/' + settings['mongodb.db_name'])
+mongoengine.connect(settings['mongodb.db_name'], host=settings['mongodb.host'])
+
+errors = Error.objects._collection
+instances = ErrorInstance.objects._collection
+overrides = SeenOverride.objects._collection
+
+
+def backfill_activity():
+    # the error list orders 'activity' by this comment count
+    updated = 0
+    for doc in errors.find({'activity': {'$exists': False}}, fields=['comments']):
+        errors.update({'_id': doc['_id']}, {'$set': {'activity': len(doc.get('comments', []))}}, safe=True)
+        updated += 1
+    logging.info('Set activity on %d errors', updated)
+
+
+def migrate_seenby():
+    # the seenby arrays become per user overrides, see ReadMarker
+    migrated = 0
+    for doc in errors.find({'seenby': {'$exists': True}}, fields=['project', 'seenby', 'timelatest']):
+        for user in doc['seenby']:
+            overrides.update(
+                {'user': getattr(user, 'id', user), 'project': doc['project'], 'error': doc['_id']},
+                {'$set': {'seen': True, 'timelatest': doc.get('timelatest')}},
+                upsert=True
+            )
+        errors.update({'_id': doc['_id']}, {'$unset': {'seenby': 1}}, safe=True)
+        migrated += 1
+    logging.info('Moved seenby of %d errors to seen overrides', migrated)
+
+    # most users had seen most errors, which the read marker says at once
+    remaining = 0
+    for user in overrides.distinct('user'):
+        for project in overrides.find({'user': user}).distinct('project'):
+            remaining += ReadMarker.compact(user, project)
+    logging.info('Compacted seen overrides to %d', remaining)
+
+
+def backfill_terms():
+    # search filters on the terms index, see Error.terms_for
+    updated = 0
+    for doc in errors.find({'terms': {'$exists': False}}, fields=['keywords', 'type', 'file', 'tags']):
+        errors.update({'_id': doc['_id']}, {'$set': {'terms': Error.terms_for(doc)}}, safe=True)
+        updated += 1
+    logging.info('Set search terms on %d errors', updated)
+
+
+def drop_hash_indexes():
+    # hashes are unique per project now, see Error.upsert
+    dropped = 0
+    for collection in (errors, instances):
+        if 'hash_1' in collection.index_information():
+            collection.drop_index('hash_1')
+            dropped += 1
+    logging.info('Dropped %d indexes on hash alone', dropped)
+
+
+backfill_activity()
+drop_hash_indexes()
+migrate_seenby()
+backfill_terms()
@@ -1,4 +1,6 @@
 import re
+import json
+import base64
 
 try:
     from hashlib import md5
@@ -6,28 +8,73 @@ except:
     from md5 import new as md5
 
 from time import time
+from random import random
+from urllib import quote, unquote
 from mongoengine import *
 from mongoengine.queryset import DoesNotExist, QuerySet
 from passlib.apps import custom_app_context as pwd_context
+from repoze.lru import LRUCache
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError
 
 
 class ErrorHasher:
-    digit_re = re.compile('\d+')
-    string_re = re.compile(r'".*?(?<!\\)"|\'.*?(?<!\\)\'')
+    """ Groups errors by project, language, type and message with quoted
+    strings and numbers removed. Clients may send the hash precomputed, see
+    clients/FINGERPRINT.md, which must be updated along with this class.
+    Bump VERSION whenever the identity changes and run triage/rehash.py to
+    migrate existing errors.
+    """
+    VERSION = 2
+
+    # written without lookbehind or '.' so it means the same in javascript
+    PATTERN = r'"(?:[^\n]*?[^\\\n])??"|\'(?:[^\n]*?[^\\\n])??\'|[0-9]+'
+    normalize_re = re.compile(PATTERN)
+    fingerprint_re = re.compile(r'[0-9a-fA-F]{32}\Z')
+    cache = LRUCache(10000)
 
     def __init__(self, error):
         self.error = error
 
+    def get_key(self):
+        return (self.error['project'], self.error['language'], self.error['type'], self.error['message'])
+
     def get_hash(self):
-        return md5(str(self.get_identity())).hexdigest()
+        key = self.get_key()
+        hash = self.cache.get(key)
+        if hash is None:
+            hash = md5(self.get_identity()).hexdigest()
+            self.cache.put(key, hash)
+        return hash
 
     def get_identity(self):
-        return {
-            'project': self.error['project'],
-            'language': self.error['language'],
-            'type': self.error['type'],
-            'message': self.digit_re.sub('', self.string_re.sub('', self.error['message']))
-        }
+        return '\0'.join([
+            'v' + str(self.VERSION),
+            _utf8(self.error['project']),
+            _utf8(self.error['language']),
+            _utf8(self.error['type']),
+            _utf8(self.normalize(self.error['message']))
+        ])
+
+    @classmethod
+    def normalize(cls, message):
+        return cls.normalize_re.sub('', message)
+
+    @classmethod
+    def parse_fingerprint(cls, fingerprint):
+        """ The hash in a client fingerprint ('v<VERSION>:<md5 hex>'), or
+        None if it was computed with another version of the spec.
+        """
+        version, _, hash = str(fingerprint).partition(':')
+        if version != 'v' + str(cls.VERSION) or not cls.fingerprint_re.match(hash):
+            return None
+        return hash.lower()
+
+
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
 
 
 class Project(Document):
@@ -83,8 +130,13 @@ class User(Document):
 
 
 class Tag(Document):
+    """ How often each tag is in use across all projects. Per project
+    counts are kept by ProjectCounters.
+    """
     meta = {
-        'ordering': ['-count']
+        'allow_inheritance': False,
+        'ordering': ['-count'],
+        'indexes': ['tag']
     }
 
     tag = StringField(required=True)
@@ -93,21 +145,15 @@ class Tag(Document):
 
     @classmethod
     def create(cls, value):
-        try:
-            tag = cls.objects.get(tag=value)
-            tag.count = tag.count + 1
-        except DoesNotExist:
-            tag = cls.create_from_tag(value)
-        return tag
+        cls.objects._collection.update(
+            {'tag': value},
+            {'$inc': {'count': 1}, '$setOnInsert': {'created': int(time())}},
+            upsert=True
+        )
 
     @classmethod
     def removeOne(cls, value):
-        try:
-            tag = cls.objects.get(tag=value)
-            tag.count = tag.count - 1
-            tag.save()
-        except DoesNotExist:
-            pass
+        cls.objects._collection.update({'tag': value}, {'$inc': {'count': -1}})
 
     @classmethod
     def create_from_tag(cls, value):
@@ -124,13 +170,88 @@ class Comment(EmbeddedDocument):
     created = IntField(required=True)
 
 
+class Blob(Document):
+    """ Backtraces and contexts shared by errors and their instances, stored
+    once and keyed by a digest of their content.
+    """
+    meta = {
+        'allow_inheritance': False
+    }
+
+    KINDS = ['backtrace', 'context']
+
+    digest = StringField(primary_key=True)
+    backtrace = ListField(DictField())
+    context = DictField()
+
+    written = LRUCache(10000)
+
+    @classmethod
+    def digest_of(cls, kind, value):
+        # latin-1 never fails to decode, so arbitrary byte strings still digest
+        data = json.dumps(value, sort_keys=True, separators=(',', ':'), encoding='latin-1')
+        return md5(kind + ':' + data).hexdigest()
+
+    @classmethod
+    def store(cls, kind, value):
+        digest = cls.digest_of(kind, value)
+        if cls.written.get(digest) is None:
+            # errors drop their inline copy once they reference the blob, so
+            # it must be stored before anything points at it
+            cls.objects._collection.update({'_id': digest}, {'$set': {kind: value}}, upsert=True, safe=True)
+            cls.written.put(digest, True)
+        return digest
+
+    @classmethod
+    def resolve(cls, documents):
+        """ Fills in the backtrace and context of every document that stores
+        them by reference, fetching all the blobs in one query.
+        """
+        refs = set()
+        for document in documents:
+            for kind in cls.KINDS:
+                if document[kind + 'ref']:
+                    refs.add(document[kind + 'ref'])
+
+        if not refs:
+            return documents
+
+        blobs = dict((blob.digest, blob) for blob in cls.objects(digest__in=list(refs)))
+        for document in documents:
+            for kind in cls.KINDS:
+                blob = blobs.get(document[kind + 'ref'])
+                if blob is not None:
+                    document[kind] = blob[kind]
+
+        return documents
+
+
+def share_payload(msg, kinds):
+    """ Stores the given kinds of payload of a prepared message as blobs,
+    recording the references on the message itself.
+    """
+    for kind in kinds:
+        if msg.get(kind) and kind + 'ref' not in msg:
+            msg[kind + 'ref'] = Blob.store(kind, msg[kind])
+    return msg
+
+
+def without_shared_payload(msg):
+    return dict((k, v) for k, v in msg.iteritems() if k not in Blob.KINDS or k + 'ref' not in msg)
+
+
 class ErrorInstance(Document):
     meta = {
         'allow_inheritance': False,
         'ordering': ['-timestamp'],
-        'indexes': ['hash', 'timestamp', ('hash', '-timestamp')]
+        'indexes': ['timestamp', ('project', 'hash', '-timestamp', '-id')]
     }
 
+    # what the error view lists of each instance
+    SUMMARY_FIELDS = ['timestamp', 'message']
+
+    # declared for the meta indexes, like Error.id
+    id = ObjectIdField(primary_key=True, default=ObjectId)
     hash = StringField(required=True)
     project = StringField(required=True)
     language = StringField(required=True)
@@ -140,23 +261,165 @@ class ErrorInstance(Document):
     file = StringField()
     context = DictField()
     backtrace = ListField(DictField())
+    contextref = StringField()
+    backtraceref = StringField()
     timestamp = FloatField()
 
     @classmethod
     def from_raw(cls, raw):
         return cls(**raw)
 
+    @classmethod
+    def documents(cls, raws):
+        """ The documents to insert for raw messages, with their ids set here
+        so that inserting them again is recognised.
+        """
+        docs = [cls.from_raw(raw).to_mongo() for raw in raws]
+        for doc in docs:
+            doc.setdefault('_id', ObjectId())
+        return docs
 
-class ErrorQuerySet(QuerySet):
+    @classmethod
+    def insert_documents(cls, docs):
+        if not docs:
+            return
 
-    def search(self, search_keywords):
-        search_keywords = re.split("\s+", search_keywords)
+        try:
+            cls.objects._collection.insert(docs, safe=True)
+        except DuplicateKeyError:
+            # a retry of an insert that got partway, the rest one at a time
+            for doc in docs:
+                try:
+                    cls.objects._collection.insert(doc, safe=True)
+                except DuplicateKeyError:
+                    pass
 
-        qObjects = Q()
-        for keyword in search_keywords:
-            qObjects = qObjects | Q(keywords__icontains=keyword) | Q(type__icontains=keyword) | Q(tags__icontains=keyword)
+    @classmethod
+    def summaries(cls, project, hash, size=10):
+        """ The latest instances of an error as raw documents holding only
+        their SUMMARY_FIELDS.
+        """
+        docs = cls.objects._collection.find({'project': project, 'hash': hash}, fields=cls.SUMMARY_FIELDS)
+        return list(docs.sort([('timestamp', -1), ('_id', -1)]).limit(size))
 
-        return self.filter(qObjects)
+    @classmethod
+    def page(cls, project, hash, after=None, size=5):
+        """ Whole instances of an error with their shared payloads, newest
+        first, following the `after` cursor. Returns them and the cursor of
+        the next page, None if there is none.
+        """
+        instances = cls.objects(project=project, hash=hash)
+        if after is not None:
+            value, id = decode_cursor(after)
+            instances.filter(keyset_query('timestamp', value, id, True))
+
+        instances = list(instances.order_by('-timestamp', '-id').limit(size + 1))
+        more = len(instances) > size
+        instances = Blob.resolve(instances[:size])
+
+        next = make_cursor(instances[-1].timestamp, instances[-1].id) if more else None
+        return instances, next
+
+
+SEARCH_CANDIDATES = 500
+
+# how much a query term matching each field counts towards relevance,
+# exact matches count double
+SEARCH_WEIGHTS = [('tags', 4), ('type', 3), ('file', 2), ('message', 1)]
+
+
+def parse_search(text):
+    """ 'a b OR c*' is [['a', 'b'], ['c*']]: groups are ORed, terms in a
+    group ANDed, and a trailing * makes a term match as a prefix.
+    """
+    groups = [[]]
+    for term in text.lower().split():
+        if term == 'or':
+            groups.append([])
+        elif term.rstrip('*'):
+            groups[-1].append(term)
+    return [group for group in groups if group]
+
+
+def term_pattern(term):
+    if term.endswith('*'):
+        # anchored, so the terms index is scanned as a range
+        return re.compile('^' + re.escape(term.rstrip('*')))
+    return term
+
+
+def relevance(doc, groups):
+    score = 0
+    fields = {
+        'tags': set(tag.lower() for tag in doc.get('tags') or []),
+        'type': tokens(doc.get('type')),
+        'file': tokens(doc.get('file')),
+        'message': tokens(doc.get('message'))
+    }
+
+    for term in set(term for group in groups for term in group):
+        prefix = term.rstrip('*')
+        for field, weight in SEARCH_WEIGHTS:
+            if prefix in fields[field]:
+                score += 2 * weight
+            elif term.endswith('*') and any(token.startswith(prefix) for token in fields[field]):
+                score += weight
+    return score
+
+
+class ErrorQuerySet(QuerySet):
+
+    def search(self, text):
+        """ Filters on the terms index, see parse_search for the syntax.
+        """
+        query = None
+        for group in parse_search(text):
+            clause = Q(terms__all=[term_pattern(term) for term in group])
+            query = clause if query is None else query | clause
+
+        if query is None:
+            return self
+        return self.filter(query)
+
+    def ranked(self, text, after=None, size=20):
+        """ Like page() but ordered by relevance to the search `text`, scored
+        over the SEARCH_CANDIDATES most recent errors matching the filter.
+        """
+        groups = parse_search(text)
+        fields = ['message', 'type', 'file', 'tags']
+        candidates = self._collection.find(self._query, fields=fields).sort('timelatest', -1).limit(SEARCH_CANDIDATES)
+
+        scored = sorted(((relevance(doc, groups), doc['_id']) for doc in candidates), reverse=True)
+        if after is not None:
+            cursor = decode_cursor(after)
+            scored = [key for key in scored if key < cursor]
+
+        more = len(scored) > size
+        scored = scored[:size]
+        docs = self._collection.find({'_id': {'$in': [id for score, id in scored]}}, fields=ErrorSummary.FIELDS)
+        errors = dict((error.id, error) for error in ErrorSummary.from_docs(docs))
+        errors = [errors[id] for score, id in scored if id in errors]
+
+        next = make_cursor(*scored[-1]) if more else None
+        return errors, next, None
+
+    def apply(self, action, user, after=None, size=None):
+        """ Applies a mass action to the next `size` errors of the filter,
+        newest first, following the `after` cursor. Returns how many errors
+        it changed, how many it went through and the cursor to continue
+        from, None once all are done.
+        """
+        size = size or MASS_CHUNK
+        if after is not None:
+            value, id = decode_cursor(after)
+            self.filter(keyset_query('timelatest', value, id, True))
+
+        fields = COUNTED_FIELDS + ['project', 'timelatest']
+        docs = list(self._collection.find(self._query, fields=fields).sort([('timelatest', -1), ('_id', -1)]).limit(size))
+        affected = Error.mass_update(docs, action, user)
+
+        next = make_cursor(docs[-1].get('timelatest'), docs[-1]['_id']) if len(docs) == size else None
+        return affected, len(docs), next
 
     def resolved(self):
         return self.filter(hiddenby__exists=True)
@@ -164,8 +427,146 @@ class ErrorQuerySet(QuerySet):
     def active(self):
         return self.filter(hiddenby__exists=False)
 
+    def page(self, field, direction='desc', after=None, before=None, size=20):
+        """ Keyset pagination on `field` then id: returns the `size` errors
+        following the `after` cursor (or preceding the `before` cursor) and
+        the cursors of the next and previous pages, None where there are none.
+        """
+        backwards = before is not None
+        cursor = before if backwards else after
+        descending = (direction == 'desc') != backwards
+
+        if cursor is not None:
+            value, id = decode_cursor(cursor)
+            self.filter(keyset_query(field, value, id, descending))
+
+        order = -1 if descending else 1
+        docs = self._collection.find(self._query, fields=ErrorSummary.FIELDS)
+        docs = list(docs.sort([(field, order), ('_id', order)]).limit(size + 1))
+        more = len(docs) > size
+        errors = ErrorSummary.from_docs(docs[:size])
+        if backwards:
+            errors.reverse()
+
+        has_next = more if not backwards else True
+        has_prev = more if backwards else cursor is not None
+        next = encode_cursor(errors[-1], field) if errors and has_next else None
+        prev = encode_cursor(errors[0], field) if errors and has_prev else None
+        return errors, next, prev
+
+
+def keyset_query(field, value, id, descending):
+    """ Matches what sorts after (value, id). Missing values sort as null,
+    below every number.
+    """
+    op = 'lt' if descending else 'gt'
+
+    # comparisons with null are raw, number fields cannot convert None
+    if value is None:
+        query = Q(__raw__={field: None, '_id': {'$' + op: id}})
+        if not descending:
+            query = query | Q(__raw__={field: {'$ne': None}})
+        return query
+
+    query = Q(**{field + '__' + op: value}) | Q(**{field: value, 'id__' + op: id})
+    if descending:
+        query = query | Q(__raw__={field: None})
+    return query
+
+
+def encode_cursor(error, field):
+    return make_cursor(error[field], error.id)
+
+
+def make_cursor(value, id):
+    return base64.urlsafe_b64encode(json.dumps([value, str(id)]))
+
+
+def decode_cursor(cursor):
+    """ Raises ValueError for anything encode_cursor did not produce.
+    """
+    try:
+        value, id = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        return value, ObjectId(id)
+    except Exception:
+        raise ValueError('Invalid cursor: %r' % cursor)
+
 
 keyword_re = re.compile(r'\w+')
+keyword_cache = LRUCache(10000)
+
+
+def tokens(text):
+    """ Lowercased words of `text` as a set, the unit of search terms.
+    """
+    if not text:
+        return set()
+    words = keyword_cache.get(text)
+    if words is None:
+        words = frozenset(keyword_re.findall(text.lower()))
+        keyword_cache.put(text, words)
+    return words
+
+
+def _ref_id(value):
+    # raw DBRef, dereferenced document or plain id
+    return getattr(value, 'id', value)
+
+
+COUNTED_FIELDS = ['hiddenby', 'claimedby', 'tags']
+
+
+def _counted_state(value):
+    # hashable form of a counted field, tags match as the array they are
+    return tuple(value) if isinstance(value, list) else _ref_id(value)
+
+
+# the field each mass action sets to the user, or unsets
+MASS_ACTIONS = {
+    'claim': ('claimedby', True),
+    'unclaim': ('claimedby', False),
+    'resolve': ('hiddenby', True),
+    'unresolve': ('hiddenby', False)
+}
+MASS_CHUNK = 500
+
+
+def counter_keys(doc):
+    """ The ProjectCounters fields one error adds 1 to, from a raw document
+    or an Error's _data.
+    """
+    active = doc.get('hiddenby') is None
+    keys = set(['open' if active else 'resolved'])
+
+    if active and doc.get('claimedby') is not None:
+        keys.add('claimed.%s' % _ref_id(doc['claimedby']))
+
+    for tag in set(doc.get('tags') or []):
+        keys.add('tags.%s.%s' % ('open' if active else 'resolved', tag_key(tag)))
+
+    return keys
+
+
+def tag_key(tag):
+    # tags are free text, keep dots and dollars out of field names. quote
+    # never escapes '.', a dotted tag would become a nested path
+    return quote(_utf8(tag), safe='').replace('.', '%2E')
+
+
+def counter_delta(before, after):
+    delta = dict((key, 1) for key in after - before)
+    delta.update((key, -1) for key in before - after)
+    return delta
+
+
+def upsert_delta(before):
+    """ Counter changes made by an Error.upsert that returned `before`:
+    a new error is open, and an occurrence reopens a resolved one.
+    """
+    if before and before.get('hiddenby') is None:
+        return {}
+    after = dict(before or {}, hiddenby=None)
+    return counter_delta(counter_keys(before) if before else set(), counter_keys(after))
 
 
 class Error(Document):
@@ -173,10 +574,29 @@ class Error(Document):
         'queryset_class': ErrorQuerySet,
         'allow_inheritance': False,
         'ordering': ['-timelatest'],
-        'indexes': ['count', 'timelatest', 'comments', 'hash', 'keywords']
+        # list queries are: project equality, the sort field and id, then
+        # filters on hiddenby and the timelatest snapshot, which the index
+        # answers without touching documents and without breaking the sort.
+        # Searches on one term walk its terms entries newest first.
+        # Sidebar counts come from ProjectCounters. Check them against real
+        # data with triage/indexes.py, which also builds them in the
+        # background
+        'indexes': [
+            ('project', '-timelatest', '-id', 'hiddenby'),
+            ('project', '-timefirst', '-id', 'hiddenby', 'timelatest'),
+            ('project', '-count', '-id', 'hiddenby', 'timelatest'),
+            ('project', '-activity', '-id', 'hiddenby', 'timelatest'),
+            ('project', 'claimedby', '-timelatest', '-id'),
+            ('project', 'terms', '-timelatest')
+        ]
     }
 
-    hash = StringField(required=True, unique=True)
+    # declared so that the meta indexes can name it, mongoengine 0.5.2 only
+    # adds the implicit id after building them. A declared primary key is
+    # required, so new errors get their id up front
+    id = ObjectIdField(primary_key=True, default=ObjectId)
+    # clients may send the hash, so it is only unique within a project
+    hash = StringField(required=True, unique_with='project')
     project = StringField(required=True)
     language = StringField(required=True)
     message = StringField(required=True)
@@ -185,16 +605,20 @@ class Error(Document):
     file = StringField()
     context = DictField()
     backtrace = ListField(DictField())
+    contextref = StringField()
+    backtraceref = StringField()
     timelatest = FloatField()
     timefirst = FloatField()
     firstcommit = StringField()
     lastcommit = StringField()
     count = IntField()
+    sampled = IntField()
     claimedby = ReferenceField(User)
     keywords = ListField(StringField())
+    terms = ListField(StringField())
     tags = ListField(StringField(max_length=30))
     comments = ListField(EmbeddedDocumentField(Comment))
-    seenby = ListField(ReferenceField(User))
+    activity = IntField()
     hiddenby = ReferenceField(User)
 
     @classmethod
@@ -204,66 +628,132 @@ class Error(Document):
         error = cls.create_from_msg(msg)
         error.validate()
 
-        keywords = list(set(keyword_re.findall(msg['message'].lower())))
-
-        insert_doc = {
-                'hash': msg['hash'],
-                'project': msg['project'],
-                'language': msg['language'],
-                'message': msg['message'],
-                'type': msg['type'],
-                'line': msg['line'],
-                'file': msg['file'],
-                'context': msg['context'],
-                'backtrace': msg['backtrace'],
-                'timelatest': msg['timelatest'],
-                'timefirst': msg['timelatest'],
-                'firstcommit': msg['commithash'],
-                'lastcommit': msg['commithash'],
-                'keywords': keywords,
-                'count': 1
-        }
+        cls.upsert(msg, msg, 1, cls.keywords_from_msg(msg))
+
+    @classmethod
+    def keywords_from_msg(cls, msg):
+        return list(tokens(msg['message']))
+
+    @classmethod
+    def terms_for(cls, doc):
+        """ The search terms of an error: all its message keywords plus the
+        words of its type and file, and its tags whole.
+        """
+        terms = set(doc.get('keywords') or []) | tokens(doc.get('type')) | tokens(doc.get('file'))
+        terms.update(tag.lower() for tag in doc.get('tags') or [])
+        return sorted(terms)
+
+    def add_tag(self, tag):
+        self.tags.append(tag)
+        if tag.lower() not in self.terms:
+            self.terms.append(tag.lower())
+
+    def remove_tag(self, tag):
+        self.tags.remove(tag)
+        # the tag may also be a word of the message
+        self.terms = self.terms_for(self._data)
 
+    @classmethod
+    def mass_update(cls, docs, action, user):
+        """ Applies `action` to the raw `docs`, which need their project,
+        timelatest and COUNTED_FIELDS. Errors sharing their counted fields
+        are updated together, matching on those fields so that each update
+        reports exactly how many errors went from one state to the other,
+        and the counters move by that much. Returns how many changed.
+        """
+        if action in ('markseen', 'markunseen'):
+            return ReadMarker.mark_many(user, docs, action == 'markseen')
+        if action not in MASS_ACTIONS:
+            raise ValueError('Unknown action: ' + action)
+
+        field, assign = MASS_ACTIONS[action]
+        value = cls._fields[field].to_mongo(user) if assign else None
+        update = {'$set': {field: value}} if assign else {'$unset': {field: 1}}
+
+        groups = {}
+        for doc in docs:
+            if _ref_id(doc.get(field)) == _ref_id(value):
+                continue
+            key = (doc['project'],) + tuple(_counted_state(doc.get(name)) for name in COUNTED_FIELDS)
+            groups.setdefault(key, (doc, []))[1].append(doc['_id'])
+
+        affected = 0
+        counters = {}
+        for doc, ids in groups.itervalues():
+            before = dict((name, doc.get(name)) for name in COUNTED_FIELDS)
+            query = dict(before, _id={'$in': ids})
+            changed = cls.objects._collection.update(query, update, multi=True, safe=True)['n']
+
+            after = dict(before)
+            after[field] = value
+            delta = counters.setdefault(doc['project'], {})
+            for key, step in counter_delta(counter_keys(before), counter_keys(after)).iteritems():
+                delta[key] = delta.get(key, 0) + step * changed
+            affected += changed
+
+        for project in set(doc['project'] for doc in docs):
+            ProjectCounters.add(project, counters.get(project, {}))
+        return affected
+
+    @classmethod
+    def upsert(cls, first, latest, count, keywords, sampled=0):
+        """ Upserts the error identified by latest['project'] and
+        latest['hash'] in one round trip, counting `count` occurrences of
+        which `sampled` stored no instance. `first` and `latest` are the
+        oldest and newest messages seen for the hash. Fields that cannot change for a hash are only set on insert.
+        Returns the COUNTED_FIELDS of the error as it was, None if it is new.
+        """
         update_doc = {
             '$set': {
-                'hash': msg['hash'],
-                'project': msg['project'],
-                'language': msg['language'],
-                'message': msg['message'],
-                'type': msg['type'],
-                'line': msg['line'],
-                'file': msg['file'],
-                'context': msg['context'],
-                'backtrace': msg['backtrace'],
-                'timelatest': msg['timelatest'],
-                'lastcommit': msg['commithash']
+                'message': latest['message'],
+                'line': latest.get('line'),
+                'file': latest.get('file'),
+                'context': latest.get('context', {}),
+                'backtrace': latest.get('backtrace', []),
+                'timelatest': latest['timelatest'],
+                'lastcommit': latest.get('commithash')
+            },
+            '$setOnInsert': {
+                'project': latest['project'],
+                'language': latest['language'],
+                'type': latest['type'],
+                'timefirst': first.get('timefirst', first['timelatest']),
+                'firstcommit': first.get('commithash'),
+                'activity': 0
             },
             '$unset': {
                 'hiddenby': 1
             },
             '$inc': {
-                'count': 1
+                'count': count,
+                'sampled': sampled
             },
             '$addToSet': {
                 'keywords': {
                     '$each': keywords
+                },
+                'terms': {
+                    '$each': list(set(keywords) | tokens(latest['type']) | tokens(latest.get('file')))
                 }
             }
         }
 
-        collection = cls.objects._collection  # probs a hack
+        for kind in Blob.KINDS:
+            if kind + 'ref' in latest:
+                del update_doc['$set'][kind]
+                update_doc['$set'][kind + 'ref'] = latest[kind + 'ref']
+                update_doc['$unset'][kind] = 1
 
-        # Update fails if document not found
-        collection.update({'hash': msg['hash']}, update_doc)
-        # insert fails if unique index violated
-        collection.insert(insert_doc)
+        # the previous state tells whether the error was new or reopened
+        collection = cls.objects._collection  # probs a hack
+        return collection.find_and_modify({'project': latest['project'], 'hash': latest['hash']}, update_doc, upsert=True, new=False, fields=dict.fromkeys(COUNTED_FIELDS, 1))
 
     @classmethod
     def from_msg(cls, msg):
         hash = ErrorHasher(msg).get_hash()
         msg['hash'] = hash
         try:
-            error = cls.objects.get(hash=hash)
+            error = cls.objects.get(project=msg['project'], hash=hash)
             error.update_from_msg(msg)
         except DoesNotExist:
             error = cls.create_from_msg(msg)
@@ -292,13 +782,10 @@ class Error(Document):
         self.hiddenby = None
 
     def mark_seen(self, user):
-
-        if user not in self.seenby:
-            self.seenby.append(user)
+        ReadMarker.mark(user, self, True)
 
     def mark_unseen(self, user):
-        if user in self.seenby:
-            self.seenby.remove(user)  # does it work?
+        ReadMarker.mark(user, self, False)
 
     def update_from_msg(self, msg):
         self.message = msg['message']
@@ -306,10 +793,361 @@ class Error(Document):
         self.count = self.count + 1
         self.hiddenby = None
 
+    def __init__(self, *args, **kwargs):
+        super(Error, self).__init__(*args, **kwargs)
+        # only errors loaded from the database come with an id
+        self._counted = counter_keys(self._data) if kwargs.get('id') else set()
+
+    def save(self, *args, **kwargs):
+        """ Saves and moves the project's counters by whatever changed since
+        the error was loaded or last saved.
+        """
+        result = super(Error, self).save(*args, **kwargs)
+        counted = counter_keys(self._data)
+        ProjectCounters.add(self.project, counter_delta(self._counted, counted))
+        self._counted = counted
+        return result
+
+
+class ErrorSummary(object):
+    """ The fields of an Error that the list rows show, built straight from
+    a projected document instead of hydrating the whole Error. Claimers and
+    commenters are loaded for a whole page at once.
+    """
+    FIELDS = {
+        'message': 1, 'type': 1, 'file': 1, 'line': 1, 'language': 1, 'tags': 1,
+        'count': 1, 'timefirst': 1, 'timelatest': 1, 'activity': 1,
+        'claimedby': 1, 'hiddenby': 1, 'project': 1,
+        'comments': {'$slice': -1}
+    }
+
+    def __init__(self, doc, users):
+        self.id = doc['_id']
+        self.project = doc.get('project')
+        self.message = doc.get('message')
+        self.type = doc.get('type')
+        self.file = doc.get('file')
+        self.line = doc.get('line')
+        self.language = doc.get('language')
+        self.tags = doc.get('tags') or []
+        self.count = doc.get('count')
+        self.timefirst = doc.get('timefirst')
+        self.timelatest = doc.get('timelatest')
+        self.hiddenby = _ref_id(doc.get('hiddenby'))
+        self.claimedby = users.get(_ref_id(doc.get('claimedby')))
+
+        comments = doc.get('comments') or []
+        self.activity = doc.get('activity') or len(comments)
+        self.last_commenter = users.get(_ref_id(comments[-1].get('author'))) if comments else None
+        # set by ReadMarker.annotate
+        self.seen = False
+
+    @classmethod
+    def from_docs(cls, docs):
+        docs = list(docs)
+        ids = set(_ref_id(doc.get('claimedby')) for doc in docs)
+        ids.update(_ref_id(doc['comments'][-1].get('author')) for doc in docs if doc.get('comments'))
+        ids.discard(None)
+
+        users = dict((user.id, user) for user in User.objects(id__in=list(ids))) if ids else {}
+        return [cls(doc, users) for doc in docs]
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
     def get_row_classes(self, user):
         classes = []
-        user not in self.seenby and classes.append('unseen')
-        user in self.seenby and classes.append('seen')
+        classes.append('seen' if self.seen else 'unseen')
         self.hiddenby and classes.append('hidden')
         self.claimedby == user and classes.append('mine')
         return ' '.join(classes)
+
+
+class ProjectCounters(Document):
+    """ Sidebar counts for a project, moved by $inc as errors are ingested and
+    triaged, so the error page reads one document instead of counting. Per
+    user counts are keyed by user id, tag counts by open or resolved and
+    then tag_key(tag). reconcile() recounts from the errors,
+    triage/counters.py does so periodically to correct any drift.
+
+    `version` goes up with every change to the project's errors, cached
+    pages are validated against it along with ReadMarker.version.
+    """
+    meta = {
+        'allow_inheritance': False
+    }
+
+    project = StringField(primary_key=True)
+    open = IntField(default=0)
+    resolved = IntField(default=0)
+    claimed = DictField()
+    tags = DictField()
+    reconciled = FloatField()
+    version = IntField(default=0)
+
+    @classmethod
+    def add(cls, project, delta):
+        delta = dict((key, value) for key, value in delta.iteritems() if value)
+        delta['version'] = 1
+        # acknowledged, so a failure leaves the delta with the batch to retry
+        cls.objects._collection.update({'_id': project}, {'$inc': delta}, upsert=True, safe=True)
+
+    @classmethod
+    def bump(cls, project):
+        cls.add(project, {})
+
+    @classmethod
+    def version_of(cls, project):
+        doc = cls.objects._collection.find_one({'_id': project}, fields=['version'])
+        return doc.get('version', 0) if doc else 0
+
+    @classmethod
+    def get_or_reconcile(cls, project):
+        try:
+            counters = cls.objects.get(project=project)
+        except DoesNotExist:
+            return cls.reconcile(project)
+
+        # created by an $inc, so it only counts changes since then
+        if counters.reconciled is None:
+            return cls.reconcile(project)
+        return counters
+
+    @classmethod
+    def reconcile(cls, project):
+        totals = {}
+        for doc in Error.objects._collection.find({'project': project}, fields=COUNTED_FIELDS):
+            for key in counter_keys(doc):
+                totals[key] = totals.get(key, 0) + 1
+
+        counts = {'open': totals.pop('open', 0), 'resolved': totals.pop('resolved', 0), 'claimed': {}, 'tags': {}, 'reconciled': time()}
+        for key, count in totals.iteritems():
+            path = key.split('.')
+            parent = counts
+            for name in path[:-1]:
+                parent = parent.setdefault(name, {})
+            parent[path[-1]] = count
+
+        # an update rather than a save, which would reset the version
+        cls.objects._collection.update({'_id': project}, {'$set': counts, '$inc': {'version': 1}}, upsert=True)
+        return cls.objects.get(project=project)
+
+    def counts(self, user):
+        counts = {
+            'open': self.open,
+            'resolved': self.resolved,
+            'mine': self.claimed.get(str(user.id), 0)
+        }
+        counts.update(ReadMarker.unseen_counts(user, self.project))
+        return counts
+
+    def facets(self, show):
+        """ The tags of the project's open or resolved errors as (tag, count)
+        pairs, most used first.
+        """
+        counts = self.tags.get('resolved' if show == 'resolved' else 'open', {})
+        facets = [(unquote(str(key)).decode('utf-8'), count) for key, count in counts.iteritems() if count > 0]
+        return sorted(facets, key=lambda facet: (-facet[1], facet[0]))
+
+
+# overrides kept per user and project once compacted, the oldest go first
+MAX_OVERRIDES = 1000
+# viewing an error marks it seen, one in this many views compacts as well
+COMPACT_EVERY = 50
+
+
+class SeenOverride(Document):
+    """ A user marking one error seen or unseen, regardless of their
+    ReadMarker. It holds until the error occurs again after `timelatest`.
+    """
+    meta = {
+        'allow_inheritance': False,
+        'indexes': [('user', 'project', 'error'), ('user', 'project', 'timelatest')]
+    }
+
+    user = ObjectIdField(required=True)
+    project = StringField(required=True)
+    error = ObjectIdField(required=True)
+    seen = BooleanField(required=True)
+    timelatest = FloatField()
+
+    def applies_to(self, doc):
+        return self.timelatest >= doc['timelatest']
+
+
+class ReadMarker(Document):
+    """ What a user has seen of a project: every error that last occurred
+    at or before `timestamp`, adjusted by their SeenOverrides. Both are
+    compared against Error.timelatest, so a recurring error shows as unseen
+    again and unseen counts are range queries on the list indexes.
+
+    `version` goes up whenever what the user has seen changes, so marking
+    errors only invalidates that user's cached pages.
+    """
+    meta = {
+        'allow_inheritance': False,
+        'indexes': [('user', 'project')]
+    }
+
+    user = ObjectIdField(required=True)
+    project = StringField(required=True)
+    timestamp = FloatField(default=0)
+    version = IntField(default=0)
+
+    @classmethod
+    def timestamp_for(cls, user, project):
+        doc = cls.objects._collection.find_one({'user': user.id, 'project': project}, fields=['timestamp'])
+        return doc.get('timestamp', 0) if doc else 0
+
+    @classmethod
+    def version_of(cls, user, project):
+        doc = cls.objects._collection.find_one({'user': user.id, 'project': project}, fields=['version'])
+        return doc.get('version', 0) if doc else 0
+
+    @classmethod
+    def bump(cls, user, project):
+        cls.objects._collection.update({'user': user, 'project': project}, {'$inc': {'version': 1}}, upsert=True)
+
+    @classmethod
+    def mark(cls, user, error, seen):
+        SeenOverride.objects._collection.update(
+            {'user': user.id, 'project': error.project, 'error': error.id},
+            {'$set': {'seen': seen, 'timelatest': error.timelatest}},
+            upsert=True
+        )
+        # compacting costs several round trips, too many for every view
+        if seen and random() * COMPACT_EVERY < 1:
+            cls.compact(user.id, error.project)
+        cls.bump(user.id, error.project)
+
+    @classmethod
+    def mark_many(cls, user, docs, seen):
+        """ mark() for raw error documents with their project and
+        timelatest, in two round trips.
+        """
+        if not docs:
+            return 0
+
+        projects = set(doc['project'] for doc in docs)
+        overrides = SeenOverride.objects._collection
+        overrides.remove({'user': user.id, 'project': {'$in': list(projects)}, 'error': {'$in': [doc['_id'] for doc in docs]}})
+        overrides.insert([{
+            'user': user.id,
+            'project': doc['project'],
+            'error': doc['_id'],
+            'seen': seen,
+            'timelatest': doc.get('timelatest')
+        } for doc in docs], safe=True)
+
+        for project in projects:
+            cls.compact(user.id, project)
+            cls.bump(user.id, project)
+        return len(docs)
+
+    @classmethod
+    def compact(cls, user, project):
+        """ Drops the overrides of `user` (an id) that no longer change
+        anything, moves the marker over the errors the rest have marked
+        seen in a row, and caps what is left at MAX_OVERRIDES. Returns how
+        many overrides remain.
+        """
+        doc = cls.objects._collection.find_one({'user': user, 'project': project}, fields=['timestamp'])
+        timestamp = doc.get('timestamp', 0) if doc else 0
+        overrides = dict((override.error, override) for override in SeenOverride.objects(user=user, project=project))
+        errors = Error.objects._collection
+        latest = dict((doc['_id'], doc['timelatest']) for doc in errors.find({'_id': {'$in': overrides.keys()}}, fields=['timelatest']))
+
+        # gone, recurred since, or saying what the marker already does
+        useless = [id for id, override in overrides.iteritems()
+                   if id not in latest or not override.applies_to({'timelatest': latest[id]}) or override.seen == (latest[id] <= timestamp)]
+        for id in useless:
+            del overrides[id]
+
+        # the marker covers every error up to a time, so it only moves over
+        # whole runs of seen errors with the same timelatest
+        seen = set(id for id, override in overrides.iteritems() if override.seen)
+        marker = timestamp
+        if seen:
+            group = None
+            for doc in errors.find({'project': project, 'timelatest': {'$gt': timestamp}}, fields=['timelatest']).sort('timelatest', 1).limit(len(seen) + 1):
+                if doc['timelatest'] != group:
+                    if group is not None:
+                        marker = group
+                    group = doc['timelatest']
+                if doc['_id'] not in seen:
+                    group = None
+                    break
+            else:
+                if group is not None:
+                    marker = group
+
+        if marker > timestamp:
+            cls.objects._collection.update({'user': user, 'project': project}, {'$set': {'timestamp': marker}}, upsert=True)
+            for id in seen:
+                if latest[id] <= marker:
+                    useless.append(id)
+                    del overrides[id]
+
+        # past the cap the oldest fall back to the marker
+        if len(overrides) > MAX_OVERRIDES:
+            oldest = sorted(overrides, key=lambda id: latest[id])[:len(overrides) - MAX_OVERRIDES]
+            useless.extend(oldest)
+            for id in oldest:
+                del overrides[id]
+
+        if useless:
+            SeenOverride.objects._collection.remove({'user': user, 'project': project, 'error': {'$in': useless}})
+        return len(overrides)
+
+    @classmethod
+    def mark_all_seen(cls, user, project, timestamp=None):
+        """ Moves the marker to `timestamp`, dropping the overrides it covers.
+        """
+        timestamp = timestamp or time()
+        cls.objects._collection.update({'user': user.id, 'project': project}, {'$set': {'timestamp': timestamp}}, upsert=True)
+        SeenOverride.objects._collection.remove({'user': user.id, 'project': project, 'timelatest': {'$lte': timestamp}})
+        cls.bump(user.id, project)
+
+    @classmethod
+    def overrides(cls, user, project, errors=None):
+        overrides = SeenOverride.objects(user=user.id, project=project)
+        if errors is not None:
+            overrides.filter(error__in=[error.id for error in errors])
+        return dict((override.error, override) for override in overrides)
+
+    @classmethod
+    def annotate(cls, user, project, errors):
+        """ Sets `seen` on each of the errors, with two queries in all.
+        """
+        timestamp = cls.timestamp_for(user, project)
+        overrides = cls.overrides(user, project, errors)
+
+        for error in errors:
+            override = overrides.get(error.id)
+            if override is not None and override.applies_to(error):
+                error.seen = override.seen
+            else:
+                error.seen = error.timelatest <= timestamp
+        return errors
+
+    @classmethod
+    def unseen_counts(cls, user, project):
+        timestamp = cls.timestamp_for(user, project)
+        errors = Error.objects._collection
+        unseen = {
+            'openUnseen': errors.find({'project': project, 'timelatest': {'$gt': timestamp}, 'hiddenby': {'$exists': False}}).count(),
+            'resolvedUnseen': errors.find({'project': project, 'timelatest': {'$gt': timestamp}, 'hiddenby': {'$exists': True}}).count()
+        }
+
+        # overrides are few, compact and mark_all_seen clear the ones that
+        # do not change anything and cap the rest
+        overrides = cls.overrides(user, project)
+        if overrides:
+            for doc in errors.find({'_id': {'$in': overrides.keys()}}, fields=['timelatest', 'hiddenby']):
+                override = overrides[doc['_id']]
+                if not override.applies_to(doc) or override.seen == (doc['timelatest'] <= timestamp):
+                    continue
+                key = 'openUnseen' if doc.get('hiddenby') is None else 'resolvedUnseen'
+                unseen[key] += -1 if override.seen else 1
+
+        return unseen
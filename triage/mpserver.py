@@ -4,31 +4,74 @@ import logging
 
 from sys import argv
 from pyramid.paster import get_appsettings
-from models import Error
-
-#logging
-logging.basicConfig(level=logging.DEBUG)
-
-# config
-logging.info('Loading configuration')
-settings = get_appsettings(argv[1], 'triage')
-
-# mongo
-logging.info('Connecting to mongo at: mongodb://' + settings['mongodb.host'] + '/' + settings['mongodb.db_name'])
-mongoengine.connect(settings['mongodb.db_name'], host=settings['mongodb.host'])
+from triage.ingest import ErrorBatch, ingest, prepare
+from triage.stats import stats
 
 
 class LoggingServer:
+    def __init__(self, settings=None):
+        self.settings = settings or {}
+
     def error(self, msg):
+        stats.incr('received')
         try:
-            error = Error.create_from_msg(msg)
-            error.save()
+            ingest(msg, self.settings)
+            return True
         except Exception:
+            stats.incr('failed')
             logging.exception('Failed to process error')
+            return False
+
+    def errors(self, msgs):
+        """ Persists a list of errors with one bulk upsert per distinct error,
+        returning a {'success': ...} result for every item.
+        """
+        stats.incr('received', len(msgs))
+        batch = ErrorBatch.from_settings(self.settings, size=len(msgs))
+        results = []
+
+        for msg in msgs:
+            try:
+                batch.add(prepare(msg, self.settings))
+                results.append({'success': True})
+            except Exception, e:
+                stats.incr('failed')
+                results.append({'success': False, 'reason': str(e)})
+
+        try:
+            if len(batch):
+                batch.flush()
+        except Exception, e:
+            logging.exception('Failed to process errors')
+            # prepare() returns the message it was given, only those whose
+            # error was not written failed, the others must not be resent
+            failed = set(id(msg) for msg in batch.settle(str(e)))
+            for msg, result in zip(msgs, results):
+                if result['success'] and id(msg) in failed:
+                    result['success'] = False
+                    result['reason'] = str(e)
+
+        return results
+
+
+if __name__ == '__main__':
+    #logging
+    logging.basicConfig(level=logging.INFO)
+
+    # config
+    logging.info('Loading configuration')
+    settings = get_appsettings(argv[1], 'triage')
+    logging.getLogger().setLevel(settings.get('ingest.log_level', 'INFO').upper())
+
+    # stats
+    stats.start_reporter('mpserver', settings)
 
+    # mongo
+    logging.info('Connecting to mongo at: mongodb://' + settings['mongodb.host'] + '/' + settings['mongodb.db_name'])
+    mongoengine.connect(settings['mongodb.db_name'], host=settings['mongodb.host'])
 
-logging.info('Creating server at ' + settings['errorserver.host'] + ':' + settings['errorserver.port'])
-server = msgpackrpc.Server(LoggingServer())
-server.listen(msgpackrpc.Address(settings['errorserver.host'], settings['errorserver.port']))
-logging.info('Serving!')
-server.start()
+    logging.info('Creating server at ' + settings['errorserver.host'] + ':' + settings['errorserver.port'])
+    server = msgpackrpc.Server(LoggingServer(settings))
+    server.listen(msgpackrpc.Address(settings['errorserver.host'], settings['errorserver.port']))
+    logging.info('Serving!')
+    server.start()
@@ -0,0 +1,198 @@
+import zmq
+import msgpack
+import mongoengine
+import logging
+from collections import deque
+from multiprocessing import Process
+from time import time
+
+from triage.ingest import DeadLetters, ErrorBatch, decode, prepare
+from triage.stats import stats
+
+
+WORKER_URI = 'ipc:///tmp/triage-ingest'
+RESTART_DELAY = 1.0
+# a message replayed this often keeps killing its worker
+MAX_REPLAYS = 3
+MAX_PENDING = 100000
+
+
+def worker_uri(settings, index):
+    return settings.get('ingest.worker_uri', WORKER_URI) + '-' + str(index)
+
+
+def ack_uri(settings):
+    return settings.get('ingest.worker_uri', WORKER_URI) + '-ack'
+
+
+def shard(msg, size):
+    return int(msg['hash'][:8], 16) % size
+
+
+def run_worker(settings, index):
+    """ Persists the messages routed to worker `index`, acknowledging the
+    sequence number of the last message of every batch once it is written.
+    """
+    # each worker needs its own connection, mongoengine keys them by process
+    mongoengine.connect(settings['mongodb.db_name'], host=settings['mongodb.host'])
+
+    # the forked copy of the front's stats would be misleading
+    stats.reset()
+    stats.start_reporter('worker-%d' % index, settings)
+
+    context = zmq.Context()
+    inbox = context.socket(zmq.PULL)
+    inbox.bind(worker_uri(settings, index))
+    acks = context.socket(zmq.PUSH)
+    acks.connect(ack_uri(settings))
+    poller = zmq.Poller()
+    poller.register(inbox, zmq.POLLIN)
+
+    batch = ErrorBatch.from_settings(settings)
+    last_seq = None
+
+    logging.info('Worker %d serving', index)
+    while True:
+        if poller.poll(batch.timeout()):
+            seq, data = inbox.recv_multipart()
+            last_seq = seq
+            try:
+                batch.add(msgpack.unpackb(data))
+            except Exception:
+                stats.incr('failed')
+                logging.exception('Failed to process error')
+                # nothing to persist, but the message must still be acknowledged
+                if not len(batch):
+                    acks.send_multipart([str(index), last_seq])
+
+        if batch.due():
+            # the batch keeps what failed and dead-letters what keeps failing,
+            # everything up to last_seq is done once it is empty
+            try:
+                batch.flush()
+            except Exception:
+                stats.incr('failed')
+                logging.exception('Failed to save batch, retrying')
+            if not len(batch):
+                acks.send_multipart([str(index), last_seq])
+
+
+class WorkerPool:
+    """ Fans prepared messages out to `size` worker processes by hash, so all
+    writes to a given error come from a single process. Messages are kept
+    until the worker acknowledges them and are replayed to its replacement
+    if it dies. A message replayed MAX_REPLAYS times without being
+    acknowledged is dead-lettered rather than replayed again, and so is a
+    message that would take a worker past `max_pending` unacknowledged.
+    """
+
+    def __init__(self, settings, size, context):
+        self.settings = settings
+        self.size = size
+        self.context = context
+        self.max_pending = int(settings.get('ingest.max_pending', MAX_PENDING))
+        self.dead_letters = DeadLetters.shared(settings)
+        self.processes = [None] * size
+        self.sockets = [None] * size
+        self.pending = [deque() for i in xrange(size)]
+        self.seq = [0] * size
+        self.started = [0] * size
+
+        self.acks = context.socket(zmq.PULL)
+        self.acks.bind(ack_uri(settings))
+
+    def start(self):
+        for index in xrange(self.size):
+            self.spawn(index)
+
+    def spawn(self, index):
+        if self.sockets[index] is not None:
+            # drop whatever was queued for the dead worker, pending holds a copy
+            self.sockets[index].setsockopt(zmq.LINGER, 0)
+            self.sockets[index].close()
+
+        if self.processes[index] is not None:
+            stats.incr('pool.restarts')
+
+        process = Process(target=run_worker, args=(self.settings, index))
+        process.daemon = True
+        process.start()
+        self.processes[index] = process
+        self.started[index] = time()
+
+        socket = self.context.socket(zmq.PUSH)
+        socket.connect(worker_uri(self.settings, index))
+        self.sockets[index] = socket
+
+        pending = self.pending[index]
+        for i in xrange(len(pending)):
+            seq, data, replays = pending.popleft()
+            if replays >= MAX_REPLAYS:
+                stats.incr('pool.poisoned')
+                self.dead_letters.put([msgpack.unpackb(data)], 'replayed %d times to worker %d' % (replays, index))
+                continue
+            pending.append((seq, data, replays + 1))
+            socket.send_multipart([str(seq), data])
+
+        logging.info('Started worker %d (pid %d), replaying %d messages', index, process.pid, len(self.pending[index]))
+
+    def dispatch(self, msg):
+        index = shard(msg, self.size)
+        if len(self.pending[index]) >= self.max_pending:
+            # the worker is stuck, holding more would only exhaust memory
+            stats.incr('pool.overflow')
+            self.dead_letters.put([msg], 'worker %d has %d messages pending' % (index, len(self.pending[index])))
+            return
+
+        self.seq[index] += 1
+        data = msgpack.packb(msg)
+        self.pending[index].append((self.seq[index], data, 0))
+        self.sockets[index].send_multipart([str(self.seq[index]), data])
+        stats.incr('dispatched')
+
+    def collect_acks(self):
+        while True:
+            try:
+                index, seq = self.acks.recv_multipart(zmq.NOBLOCK)
+            except zmq.ZMQError:
+                return
+
+            pending = self.pending[int(index)]
+            while pending and pending[0][0] <= int(seq):
+                pending.popleft()
+
+            stats.gauge('pool.pending', sum(len(pending) for pending in self.pending))
+
+    def check_workers(self):
+        for index, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+            if time() - self.started[index] < RESTART_DELAY:
+                continue
+            logging.error('Worker %d exited with code %s', index, process.exitcode)
+            self.spawn(index)
+
+    def serve(self, socket, unpacker):
+        poller = zmq.Poller()
+        poller.register(socket, zmq.POLLIN)
+        poller.register(self.acks, zmq.POLLIN)
+
+        while True:
+            try:
+                events = dict(poller.poll(RESTART_DELAY * 1000))
+
+                if socket in events:
+                    for msg in decode(unpacker, socket.recv()):
+                        try:
+                            self.dispatch(prepare(msg, self.settings))
+                        except Exception:
+                            stats.incr('failed')
+                            logging.exception('Failed to process error')
+
+                if self.acks in events:
+                    self.collect_acks()
+
+                self.check_workers()
+            except Exception:
+                stats.incr('failed')
+                logging.exception('Failed to process error')
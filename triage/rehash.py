@@ -0,0 +1,78 @@
+import mongoengine
+import logging
+from sys import argv
+from pyramid.paster import get_appsettings
+from triage.models import Error, ErrorHasher, ErrorInstance, ProjectCounters
+
+# Recomputes every error's hash with the current ErrorHasher. Errors whose
+# new hash already exists (for example ones created by ingest since the
+# hasher changed) are merged into the existing error. Safe to run repeatedly.
+
+#logging
+logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+# config
+logging.info('Loading configuration')
+settings = get_appsettings(argv[1], 'triage')
+
+# mongo
+logging.info('Connecting to mongo at: mongodb://' + settings['mongodb.host'] + '/' + settings['mongodb.db_name'])
+mongoengine.connect(settings['mongodb.db_name'], host=settings['mongodb.host'])
+
+errors = Error.objects._collection
+instances = ErrorInstance.objects._collection
+
+
+def merge(doc, existing):
+    update = {
+        '$inc': {
+            'count': doc.get('count') or 0,
+            'sampled': doc.get('sampled') or 0,
+            'activity': doc.get('activity') or len(doc.get('comments', []))
+        },
+        '$addToSet': {
+            'keywords': {'$each': doc.get('keywords', [])},
+            'terms': {'$each': doc.get('terms', [])},
+            'tags': {'$each': doc.get('tags', [])}
+        },
+        '$pushAll': {'comments': doc.get('comments', [])},
+        '$set': {}
+    }
+
+    if doc.get('timefirst') and doc['timefirst'] < existing.get('timefirst'):
+        update['$set']['timefirst'] = doc['timefirst']
+        update['$set']['firstcommit'] = doc.get('firstcommit')
+    if doc.get('timelatest') > existing.get('timelatest'):
+        update['$set']['timelatest'] = doc['timelatest']
+        update['$set']['lastcommit'] = doc.get('lastcommit')
+    if not update['$set']:
+        del update['$set']
+
+    errors.update({'_id': existing['_id']}, update, safe=True)
+    errors.remove({'_id': doc['_id']}, safe=True)
+
+
+logging.info('Rehashing errors with hasher version %d', ErrorHasher.VERSION)
+rehashed = merged = 0
+projects = set()
+for doc in errors.find({}, fields=['hash', 'project', 'language', 'type', 'message']):
+    hash = ErrorHasher(doc).get_hash()
+    if hash == doc['hash']:
+        continue
+
+    existing = errors.find_one({'project': doc['project'], 'hash': hash})
+    if existing:
+        merge(errors.find_one({'_id': doc['_id']}), existing)
+        projects.add(doc['project'])
+        merged += 1
+    else:
+        errors.update({'_id': doc['_id']}, {'$set': {'hash': hash}}, safe=True)
+        rehashed += 1
+
+    instances.update({'project': doc['project'], 'hash': doc['hash']}, {'$set': {'hash': hash}}, multi=True, safe=True)
+
+# merging drops errors and unions their tags, recount rather than track it
+for project in projects:
+    ProjectCounters.reconcile(project)
+
+logging.info('Rehashed %d errors, merged %d duplicates', rehashed, merged)
@@ -3,16 +3,19 @@ def routes(config):
     config.add_route('index', '/')
     # Errors
     config.add_route('error_list', '/projects/{project}')
-    config.add_route('error_list_changes', '/projects/{project}/changes')
+    config.add_route('error_list_events', '/projects/{project}/events')
     config.add_route('error_view', '/projects/{project}/error/{id}')
+    config.add_route('error_instances', '/projects/{project}/error/{id}/instances')
     config.add_route('error_toggle_claim', '/projects/{project}/error/{id}/toggle/claim')
     config.add_route('error_toggle_resolve', '/projects/{project}/error/{id}/toggle/resolve')
     config.add_route('error_tag_add', '/projects/{project}/error/{id}/tag/add/{tag}')
     config.add_route('error_tag_remove', '/projects/{project}/error/{id}/tag/remove/{tag}')
     config.add_route('error_comment_add', '/projects/{project}/error/{id}/comment/add')
-    config.add_route('error_mass', '/projects/{project}/errors/{ids}/mass/{action}')
+    config.add_route('error_mark_all_seen', '/projects/{project}/errors/markallseen')
+    config.add_route('error_mass', '/projects/{project}/errors/mass/{action}')
     # REST API
     config.add_route('api_log', 'api/log')
+    config.add_route('api_errors', 'api/errors')
     config.add_route('api_version', 'api/version')
     # Auth
     config.add_route('user_login', 'user/login')
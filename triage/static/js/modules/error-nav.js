@@ -6,44 +6,59 @@ Triage.modules.errorNav = (function($, app) {
 	var show = 'open';
 	var orderBy = 'date';
 	var direction = 'desc';
-	var rowsLoaded = 0;
+	var nextCursor = null;
 	var search;
+	var tags = [];
 	var lastLoaded;
-	var updateCount = 0;
+	var changed = {};
+	var changedCount = 0;
+	var eventHub = null;
+	var eventSeq = null;
 
-	var buildUrl = function() {
+	var buildUrl = function(cursor) {
 
 		var params = {
 			show: show,
 			order_by: orderBy,
-			direction: direction,
-			timelatest: lastLoaded
+			direction: direction
 		};
 
 		if (search) {
 			params['search'] = search;
 		}
 
-		if (rowsLoaded) {
-			params['start'] = rowsLoaded; // start is 0 indexed
+		if (tags.length) {
+			params['tags'] = tags;
 		}
 
-		return '//' + window.location.host + window.location.pathname + '?' + $.param(params);
+		// the first page is as of now, which keeps it cacheable, later
+		// ones stay on the same snapshot
+		if (cursor) {
+			params['after'] = cursor;
+			params['timelatest'] = lastLoaded;
+		}
+
+		return '//' + window.location.host + window.location.pathname + '?' + $.param(params, true);
 	};
 
-	var reloadList = function() {
-		rowsLoaded = 0;
+	var updateCursor = function(xhr) {
+		nextCursor = xhr.getResponseHeader('X-Next-Cursor') || null;
+		$('#loadmore').attr('disabled', !nextCursor);
+	};
 
+	var reloadList = function() {
 		lastLoaded = Math.floor(Date.now() / 1000);
 		app.trigger('nav.reloading', lastLoaded);
 
 		$.ajax({
 			url: buildUrl(),
 			dataType: 'html',
-			success: function(data){
+			success: function(data, status, xhr){
 				$('.error-list tbody').html(data);
 				$('.changes-info').hide();
-				rowsLoaded = $('.error-list tbody tr').length;
+				changed = {};
+				changedCount = 0;
+				updateCursor(xhr);
 				app.trigger('nav.reloaded', lastLoaded);
 			}
 		});
@@ -52,16 +67,20 @@ Triage.modules.errorNav = (function($, app) {
 	var loadNextPage = function() {
 		var button = $(this);
 
-		rowsLoaded = $('.error-list tbody tr').length;
+		if (!nextCursor) {
+			return;
+		}
 		button.attr('disabled', true);
 
 		$.ajax({
-			url: buildUrl(),
+			url: buildUrl(nextCursor),
 			dataType: 'html',
-			success: function(data){
-				button.attr('disabled', false);
+			success: function(data, status, xhr){
 				$('.error-list tbody').append(data);
-				rowsLoaded = $('.error-list tbody tr').length;
+				updateCursor(xhr);
+			},
+			error: function() {
+				button.attr('disabled', false);
 			}
 		});
 	};
@@ -102,49 +121,152 @@ Triage.modules.errorNav = (function($, app) {
 		reloadList();
 	};
 
-	var checkForUpdates = function() {
-		var params = {
-			show: show,
-			timelatest: lastLoaded
-		};
-		if (search) {
-			params['search'] = search;
+	// long-polls for errors written since the list was loaded, the server
+	// answers from memory so open tabs cost no queries
+	var waitForEvents = function() {
+		var params = {};
+		if (eventHub !== null) {
+			params = {hub: eventHub, since: eventSeq};
 		}
 
-		var url = window.location.origin + window.location.pathname + '/changes?' + $.param(params);
-
 		$.ajax({
-			url: url,
+			url: '//' + window.location.host + window.location.pathname + '/events?' + $.param(params),
 			dataType: 'json',
-			success: function(data){
-				if (data && data != updateCount) {
-					updateCount = data;
-					app.trigger('nav.newchanges', updateCount);
+			global: false,
+			success: function(data) {
+				if (data.hub === null) {
+					return;
+				}
+				if (eventHub !== null && data.hub == eventHub) {
+					countChanges(data.events);
+				}
+				else if (eventHub !== null) {
+					// another worker answered, what this one missed is unknown
+					countChanges(null);
 				}
+				eventHub = data.hub;
+				eventSeq = data.seq;
+				window.setTimeout(waitForEvents, data.retry);
+			},
+			error: function() {
+				window.setTimeout(waitForEvents, 5000);
 			}
 		});
 	};
 
+	var countChanges = function(events) {
+		if (events === null) {
+			// too many to tell which
+			changedCount = '?';
+		}
+		else if (changedCount !== '?') {
+			for (var i = 0; i < events.length; i++) {
+				if (events[i].timelatest > lastLoaded && !changed[events[i].hash]) {
+					changed[events[i].hash] = true;
+					changedCount++;
+				}
+			}
+		}
+
+		if (changedCount) {
+			app.trigger('nav.newchanges', changedCount);
+		}
+	};
+
 	var processSelection = function(indicator, action) {
-		var ids = [];
-		$('.multiselect:checked').each(function(){
-			ids.push($(this).val());
-		});
+		var url = '//' + window.location.host + window.location.pathname + '/errors/mass/' + action;
+		var params;
+
+		if ($('#select-all-matching').hasClass('active')) {
+			// the server works through the filter a chunk per request
+			params = {
+				all: 1,
+				show: show,
+				timelatest: lastLoaded
+			};
+			if (search) {
+				params['search'] = search;
+			}
+			if (tags.length) {
+				params['tags'] = tags;
+			}
+		}
+		else {
+			params = {ids: []};
+			$('.multiselect:checked').each(function(){
+				params.ids.push($(this).val());
+			});
+
+			if (!params.ids.length) {
+				return;
+			}
+		}
+
+		var progress = $('#mass-progress');
+		var affected = 0;
+		var processed = 0;
+		var total = null;
 
-		if(ids.length > 0 ) {
-			var url = '//' + window.location.host + window.location.pathname + '/errors/' + ids.join(',') + '/mass/' + action;
+		var step = function(cursor) {
+			if (cursor) {
+				params['cursor'] = cursor;
+			}
 
-			indicator.addClass('loading');
 			$.ajax({
 				url: url,
-				success: function() {
-					reloadList();
+				type: 'POST',
+				data: $.param(params, true),
+				dataType: 'json',
+				success: function(data) {
+					if (data.type != 'success') {
+						progress.text('Failed: ' + data.reason);
+						indicator.removeClass('loading');
+						return;
+					}
+
+					affected += data.affected;
+					processed += data.processed;
+					if (data.total !== null) {
+						total = data.total;
+					}
+
+					if (data.cursor) {
+						progress.text(processed + ' of ' + total + ' errors');
+						step(data.cursor);
+					}
+					else {
+						progress.text(affected + ' errors changed');
+						indicator.removeClass('loading');
+						$('#select-all-matching').removeClass('active');
+						reloadList();
+					}
 				},
-				complete: function() {
+				error: function() {
+					progress.text('Failed after ' + affected + ' errors changed');
 					indicator.removeClass('loading');
 				}
 			});
-		}
+		};
+
+		indicator.addClass('loading');
+		progress.text('');
+		step(null);
+	};
+
+	var markAllSeen = function(indicator) {
+		var url = '//' + window.location.host + window.location.pathname + '/errors/markallseen';
+
+		indicator.addClass('loading');
+		$.ajax({
+			url: url,
+			success: function() {
+				$('#error-tabs .unseen').text(0);
+				reloadList();
+			},
+			complete: function() {
+				indicator.removeClass('loading');
+			}
+		});
 	};
 
 	return {
@@ -161,6 +283,14 @@ Triage.modules.errorNav = (function($, app) {
 
 			$('#errorlist-search').on('submit', function() {
 				search = $(this).find('.searchfield').val();
+
+				// results come best match first until another order is picked
+				if (search) {
+					orderBy = 'relevance';
+					$('#order-items th').removeClass('active').addClass('inactive');
+				} else if (orderBy == 'relevance') {
+					orderBy = 'date';
+				}
 				reloadList();
 				return false;
 			});
@@ -170,7 +300,18 @@ Triage.modules.errorNav = (function($, app) {
 				return false;
 			});
 
-			$('#aggregate-action-container a').on('click', function() {
+			$('#mark-all-seen').on('click', function() {
+				markAllSeen($(this));
+				return false;
+			});
+
+			$('#select-all-matching').on('click', function() {
+				$(this).toggleClass('active');
+				$('.multiselect').attr('disabled', $(this).hasClass('active'));
+				return false;
+			});
+
+			$('#aggregate-action-container a[data-action]').on('click', function() {
 				var link = $(this);
 				processSelection(link, link.data('action'));
 				return false;
@@ -201,8 +342,12 @@ Triage.modules.errorNav = (function($, app) {
 				app.trigger('system.activecountchanged', parseInt(count.text(), 10));
 
 				lastLoaded = parseInt($('.error-list tbody tr:first-child').data('timelatest'), 10);
+				nextCursor = $('#loadmore').data('cursor') || null;
+				$('#tag-facets li.active').each(function() {
+					tags.push(String($(this).data('tag')));
+				});
 
-				window.setInterval(checkForUpdates, 600000);
+				waitForEvents();
 			});
 
 
@@ -182,6 +182,38 @@ Triage.modules.pane = (function($, app) {
 				});
 			});
 
+			// the summaries are replaced by whole instances, a page at a time
+			$(document).on('click', '.load-instances', function(e) {
+				e.preventDefault();
+				var button = $(this);
+				var cursor = button.data('cursor');
+				if (button.attr('disabled')) return;
+
+				button.attr('disabled', true);
+				$.ajax({
+					url: button.data('url') + (cursor ? '?' + $.param({after: cursor}) : ''),
+					dataType: 'html',
+					success: function(data, status, xhr) {
+						var table = button.siblings('.related-errors');
+						if (!cursor) {
+							table.empty();
+						}
+						table.append(data);
+
+						var next = xhr.getResponseHeader('X-Next-Cursor');
+						if (next) {
+							button.data('cursor', next).text('Load more').attr('disabled', false);
+						}
+						else {
+							button.remove();
+						}
+					},
+					error: function() {
+						button.attr('disabled', false);
+					}
+				});
+			});
+
 			$(document).on('submit', '.comment-form', function(e) {
 				e.preventDefault();
 				var form = $(this);
@@ -0,0 +1,153 @@
+import os
+import json
+import math
+import logging
+from threading import Lock, Thread
+from time import time, sleep
+
+
+# In-process counters, gauges and histograms for the ingest processes. A
+# reporter thread logs a snapshot every interval and optionally writes it as
+# JSON to a stats directory, one file per process, for local tooling to read.
+
+GROWTH = 1.1
+
+
+class Histogram:
+    """ Log-bucketed histogram, percentiles are accurate to within GROWTH.
+    """
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0
+
+    def observe(self, value):
+        index = int(math.ceil(math.log(value, GROWTH))) if value > 0 else None
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        target = self.count * p
+        seen = 0
+        for index in sorted(self.buckets, key=lambda i: -1e9 if i is None else i):
+            seen += self.buckets[index]
+            if seen >= target:
+                return 0 if index is None else min(GROWTH ** index, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'max': self.max
+        }
+
+
+class Timer:
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.start = time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stats.observe(self.name, (time() - self.start) * 1000)
+
+
+class Stats:
+
+    def __init__(self):
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.previous = {}
+            self.gauges = {}
+            self.histograms = {}
+            self.since = time()
+
+    def incr(self, name, count=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def timer(self, name):
+        """ Context manager recording the elapsed milliseconds under `name`.
+        """
+        return Timer(self, name)
+
+    def snapshot(self):
+        """ Counters with their rate since the last snapshot, gauges, and the
+        histograms observed since the last snapshot.
+        """
+        with self.lock:
+            now = time()
+            elapsed = max(now - self.since, 1e-9)
+            counters = dict(self.counters)
+            histograms, self.histograms = self.histograms, {}
+            previous, self.previous = self.previous, counters
+            self.since = now
+
+        return {
+            'time': now,
+            'counters': counters,
+            'rates': dict((k, (v - previous.get(k, 0)) / elapsed) for k, v in counters.iteritems()),
+            'gauges': dict(self.gauges),
+            'histograms': dict((k, h.summary()) for k, h in histograms.iteritems())
+        }
+
+    def dump(self, name, path=None):
+        snapshot = self.snapshot()
+        logging.info('stats %s', json.dumps(snapshot, sort_keys=True))
+
+        if path:
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            filename = os.path.join(path, '%s-%d.json' % (name, os.getpid()))
+            f = open(filename + '.tmp', 'w')
+            json.dump(snapshot, f, sort_keys=True)
+            f.close()
+            os.rename(filename + '.tmp', filename)
+
+    def start_reporter(self, name, settings):
+        interval = float(settings.get('ingest.stats_interval', 0))
+        if not interval:
+            return
+
+        path = settings.get('ingest.stats_dir')
+
+        def report():
+            while True:
+                sleep(interval)
+                try:
+                    self.dump(name, path)
+                except Exception:
+                    logging.exception('Failed to report stats')
+
+        reporter = Thread(target=report)
+        reporter.daemon = True
+        reporter.start()
+
+
+stats = Stats()
@@ -10,8 +10,1240 @@ class ViewTests(unittest.TestCase):
     def tearDown(self):
         testing.tearDown()
 
-    def test_my_view(self):
-        from triage.views import my_view
-        request = testing.DummyRequest()
-        info = my_view(request)
-        self.assertEqual(info['project'], 'triage')
+    def test_index(self):
+        from triage.views import index
+        self.config.add_route('error_list', '/projects/{project}')
+        self.config.registry.settings['default_project'] = 'triage'
+        response = index(testing.DummyRequest())
+        self.assertEqual(response.location, 'http://example.com/projects/triage')
+
+
+class TagKeyTests(unittest.TestCase):
+
+    def test_escapes_field_separators(self):
+        from triage.models import tag_key
+        self.assertEqual(tag_key('v1.2$'), 'v1%2E2%24')
+
+    def test_round_trips(self):
+        from urllib import unquote
+        from triage.models import tag_key
+        for tag in [u'v1.2.3', u'$set', u'caf\xe9.fr', u'a b/c']:
+            self.assertEqual(unquote(tag_key(tag)).decode('utf-8'), tag)
+
+    def test_dotted_tags_are_one_field(self):
+        from triage.models import counter_keys
+        keys = counter_keys({'tags': ['v1', 'v1.2', 'v1.2.3']})
+        tags = [key.split('.') for key in keys if key.startswith('tags.')]
+        self.assertEqual(len(tags), 3)
+        self.assertTrue(all(len(path) == 3 for path in tags))
+
+
+class CursorTests(unittest.TestCase):
+
+    def test_round_trip(self):
+        from bson.objectid import ObjectId
+        from triage.models import decode_cursor, make_cursor
+        id = ObjectId()
+        for value in [1339412345.5, 0, None, u'caf\xe9']:
+            self.assertEqual(decode_cursor(make_cursor(value, id)), (value, id))
+
+    def test_invalid(self):
+        from triage.models import decode_cursor, make_cursor
+        for cursor in ['', 'not a cursor', make_cursor(1, 'not an id'), u'\xe9']:
+            self.assertRaises(ValueError, decode_cursor, cursor)
+
+    def test_keyset_query(self):
+        from bson.objectid import ObjectId
+        from triage.models import Error, keyset_query
+        id = ObjectId()
+        self.assertEqual(keyset_query('count', 5, id, True).to_query(Error), {'$or': [
+            {'count': {'$lt': 5}},
+            {'count': 5, '_id': {'$lt': id}},
+            {'count': None}
+        ]})
+        self.assertEqual(keyset_query('count', 5, id, False).to_query(Error), {'$or': [
+            {'count': {'$gt': 5}},
+            {'count': 5, '_id': {'$gt': id}}
+        ]})
+        # missing values sort first, ascending they are followed by all others
+        self.assertEqual(keyset_query('timelatest', None, id, False).to_query(Error), {'$or': [
+            {'timelatest': None, '_id': {'$gt': id}},
+            {'timelatest': {'$ne': None}}
+        ]})
+        self.assertEqual(keyset_query('timelatest', None, id, True).to_query(Error), {'timelatest': None, '_id': {'$lt': id}})
+
+
+class FingerprintTests(unittest.TestCase):
+    # the test vectors of clients/FINGERPRINT.md
+    VECTORS = [
+        ('contests', 'php', 'E_NOTICE', 'Undefined index: user_id', 'v2:044a71d871c6f507e9a4d0b214d060c8'),
+        ('contests', 'php', 'PDOException', "SQLSTATE[23000]: Duplicate entry '1234-5' for key 'PRIMARY'", 'v2:2360a2cf845320921a61d218769124c1'),
+        ('frontend', 'javascript', 'TypeError', 'Cannot read property "name" of undefined at line 42', 'v2:bfd0b046918af1cd84d1b1080bc402d0'),
+        ('commerce', 'python', 'KeyError', u"'caf\xe9' not in session 7", 'v2:82989b3c66adfca6331934cd22a05c72'),
+        ('commerce', 'php', 'Exception', 'Escaped "quote \\" inside" and "" empty', 'v2:0d2cdd76ca3e30e264818a69a1e548d3'),
+        ('contests', 'php', 'E_WARNING', "Unclosed 'quote spans\nlines' 99", 'v2:51c77997c0f716e90caf77c3d0eddf0d')
+    ]
+
+    def error(self, project='contests', fingerprint=None):
+        error = {'project': project, 'language': 'php', 'type': 'E_NOTICE', 'message': 'Undefined index: user_id'}
+        if fingerprint is not None:
+            error['fingerprint'] = fingerprint
+        return error
+
+    def test_vectors(self):
+        from triage.models import ErrorHasher
+        for project, language, type, message, fingerprint in self.VECTORS:
+            error = {'project': project, 'language': language, 'type': type, 'message': message}
+            self.assertEqual('v2:' + ErrorHasher(error).get_hash(), fingerprint)
+
+    def test_parse_fingerprint(self):
+        from triage.models import ErrorHasher
+        self.assertEqual(ErrorHasher.parse_fingerprint('v2:044A71D871C6F507E9A4D0B214D060C8'), '044a71d871c6f507e9a4d0b214d060c8')
+        self.assertEqual(ErrorHasher.parse_fingerprint('v1:044a71d871c6f507e9a4d0b214d060c8'), None)
+        self.assertEqual(ErrorHasher.parse_fingerprint('v2:' + 'z' * 32), None)
+        self.assertEqual(ErrorHasher.parse_fingerprint('v2:044a71d8'), None)
+        self.assertEqual(ErrorHasher.parse_fingerprint('v2:' + 'a' * 32 + '\n'), None)
+
+    def test_policy(self):
+        from triage.ingest import Fingerprints
+        from triage.models import ErrorHasher
+        fingerprints = Fingerprints(trust=['trusted'], verify=['*'])
+        computed = '044a71d871c6f507e9a4d0b214d060c8'
+        other = 'v2:' + 'b' * 32
+
+        self.assertEqual(fingerprints.hash(self.error('trusted', other)), 'b' * 32)
+        # what cannot be a hash is ignored, even when trusted
+        self.assertEqual(fingerprints.hash(self.error('trusted', 'v2:' + 'b' * 32 + '\n')), ErrorHasher(self.error('trusted')).get_hash())
+        self.assertEqual(fingerprints.hash(self.error('contests', other)), computed)
+        self.assertEqual(fingerprints.hash(self.error('contests')), computed)
+        self.assertEqual(Fingerprints().hash(self.error('contests', other)), computed)
+
+    def test_batch_scopes_hash_by_project(self):
+        from triage.ingest import ErrorBatch
+        batch = ErrorBatch(100, 0, None, [], None)
+        for project in ['trusted', 'victim']:
+            msg = self.error(project)
+            msg.update(hash='b' * 32, timestamp=1, timefirst=1, timelatest=1)
+            batch.add(msg)
+        self.assertEqual(sorted(batch.errors), [('trusted', 'b' * 32), ('victim', 'b' * 32)])
+
+
+class FakeDeadLetters:
+
+    def __init__(self):
+        self.msgs = []
+
+    def put(self, msgs, reason):
+        self.msgs.extend(msgs)
+
+
+class FakeStore:
+    """ Stands in for the writes ErrorBatch makes. `failures` lists the
+    exceptions the next upserts, instance inserts or counter updates raise,
+    None for one that goes through.
+    """
+
+    def __init__(self):
+        self.errors = {}
+        self.instances = []
+        self.counters = {}
+        self.failures = {'upsert': [], 'insert': [], 'counters': []}
+
+    def fail(self, write):
+        failure = self.failures[write].pop(0) if self.failures[write] else None
+        if failure is not None:
+            raise failure
+
+    def upsert(self, first, latest, count, keywords, sampled=0):
+        self.fail('upsert')
+        key = (latest['project'], latest['hash'])
+        before = self.errors.get(key)
+        self.errors[key] = (before or 0) + count
+        return {'hiddenby': None} if before else None
+
+    def insert_documents(self, docs):
+        self.fail('insert')
+        self.instances.extend(docs)
+
+    def add(self, project, delta):
+        self.fail('counters')
+        for key, value in delta.iteritems():
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def install(self):
+        from triage.models import Error, ErrorInstance, ProjectCounters
+        self.originals = [(Error, 'upsert'), (ErrorInstance, 'insert_documents'), (ProjectCounters, 'add')]
+        self.originals = [(cls, name, cls.__dict__[name]) for cls, name in self.originals]
+        Error.upsert = classmethod(lambda cls, *args: self.upsert(*args))
+        ErrorInstance.insert_documents = classmethod(lambda cls, docs: self.insert_documents(docs))
+        ProjectCounters.add = classmethod(lambda cls, project, delta: self.add(project, delta))
+
+    def uninstall(self):
+        for cls, name, original in self.originals:
+            setattr(cls, name, original)
+
+
+def error_msg(project='project', message='Undefined index: user_id', **fields):
+    msg = {'project': project, 'language': 'php', 'type': 'E_NOTICE', 'message': message, 'timestamp': 1000}
+    msg.update(fields)
+    return msg
+
+
+class IngestTests(unittest.TestCase):
+
+    def setUp(self):
+        self.store = FakeStore()
+        self.store.install()
+        self.dead_letters = FakeDeadLetters()
+        self.settings = {'ingest.dead_letters': self.dead_letters, 'ingest.shared_payload': ''}
+
+    def tearDown(self):
+        self.store.uninstall()
+
+    def test_ingest(self):
+        from triage.ingest import ingest
+        ingest(error_msg(), self.settings)
+        self.assertEqual(self.store.errors.values(), [1])
+        self.assertEqual(len(self.store.instances), 1)
+
+    def test_failed_upsert_raises(self):
+        from pymongo.errors import OperationFailure
+        from triage.ingest import FlushError, ingest
+        self.store.failures['upsert'].append(OperationFailure('down'))
+        self.assertRaises(FlushError, ingest, error_msg(), self.settings)
+        self.assertEqual(self.store.errors, {})
+        self.assertEqual(self.dead_letters.msgs, [])
+
+    def test_failed_instance_is_accepted(self):
+        from pymongo.errors import OperationFailure
+        from triage.ingest import ingest
+        # the bulk insert and the retry of its one group
+        self.store.failures['insert'] = [OperationFailure('too large')] * 2
+        ingest(error_msg(), self.settings)
+        self.assertEqual(self.store.errors.values(), [1])
+        self.assertEqual([msg['message'] for msg in self.dead_letters.msgs], ['Undefined index: user_id'])
+
+
+class LoggingServerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.store = FakeStore()
+        self.store.install()
+        self.settings = {'ingest.dead_letters': FakeDeadLetters(), 'ingest.shared_payload': ''}
+
+    def tearDown(self):
+        self.store.uninstall()
+
+    def test_errors(self):
+        from triage.mpserver import LoggingServer
+        results = LoggingServer(self.settings).errors([error_msg(), {'project': 'project'}, error_msg(message='other')])
+        self.assertEqual([result['success'] for result in results], [True, False, True])
+        self.assertEqual(sorted(self.store.errors.values()), [1, 1])
+
+    def test_reports_only_unwritten_errors(self):
+        from pymongo.errors import OperationFailure
+        from triage.mpserver import LoggingServer
+        # the first upsert goes through, the second fails
+        self.store.failures['upsert'] = [None, OperationFailure('down')]
+        results = LoggingServer(self.settings).errors([error_msg(message='a'), error_msg(message='a'), error_msg(message='b')])
+
+        written = self.store.errors.keys()[0]
+        failed = [result['success'] for result in results].count(False)
+        self.assertEqual(len(self.store.errors), 1)
+        self.assertEqual(failed, 3 - self.store.errors[written])
+
+
+MISSING = object()
+
+
+def get_path(doc, path):
+    for name in path.split('.'):
+        if not isinstance(doc, dict) or name not in doc:
+            return MISSING
+        doc = doc[name]
+    return doc
+
+
+def set_path(doc, path, value):
+    names = path.split('.')
+    for name in names[:-1]:
+        doc = doc.setdefault(name, {})
+    doc[names[-1]] = value
+
+
+def unset_path(doc, path):
+    names = path.split('.')
+    for name in names[:-1]:
+        doc = doc.get(name, {})
+    doc.pop(names[-1], None)
+
+
+def equals(value, expected):
+    if hasattr(expected, 'match'):
+        values = value if isinstance(value, list) else [value]
+        return any(isinstance(v, basestring) and expected.match(v) for v in values)
+    if expected is None:
+        return value is MISSING or value is None
+    if isinstance(value, list) and not isinstance(expected, list):
+        return expected in value
+    return value == expected
+
+
+def compare(value, op, arg):
+    if value is MISSING or value is None:
+        return False
+    return {'$gt': value > arg, '$gte': value >= arg, '$lt': value < arg, '$lte': value <= arg}[op]
+
+
+def matches(doc, spec):
+    """ The subset of MongoDB queries the models issue.
+    """
+    for key, condition in spec.iteritems():
+        if key == '$or':
+            if not any(matches(doc, clause) for clause in condition):
+                return False
+            continue
+
+        value = get_path(doc, key)
+        if isinstance(condition, dict) and condition and all(op.startswith('$') for op in condition):
+            for op, arg in condition.iteritems():
+                if op == '$in':
+                    ok = any(equals(value, item) for item in arg)
+                elif op == '$nin':
+                    ok = not any(equals(value, item) for item in arg)
+                elif op == '$ne':
+                    ok = not equals(value, arg)
+                elif op == '$exists':
+                    ok = (value is not MISSING) == bool(arg)
+                elif op == '$all':
+                    ok = all(equals(value, item) for item in arg)
+                else:
+                    ok = compare(value, op, arg)
+                if not ok:
+                    return False
+        elif not equals(value, condition):
+            return False
+    return True
+
+
+def sort_key(value):
+    # null and missing sort below every number
+    return (0, None) if value is MISSING or value is None else (1, value)
+
+
+class FakeCursor:
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.position = 0
+
+    def sort(self, key, direction=None):
+        keys = [(key, direction or 1)] if isinstance(key, basestring) else key
+        for key, direction in reversed(keys):
+            self.docs.sort(key=lambda doc: sort_key(get_path(doc, key)), reverse=direction < 0)
+        return self
+
+    def limit(self, size):
+        if size:
+            self.docs = self.docs[:size]
+        return self
+
+    def skip(self, count):
+        self.docs = self.docs[count:]
+        return self
+
+    def count(self, *args, **kwargs):
+        return len(self.docs)
+
+    def distinct(self, key):
+        values = []
+        for doc in self.docs:
+            value = get_path(doc, key)
+            if value is not MISSING and value not in values:
+                values.append(value)
+        return values
+
+    def __iter__(self):
+        return iter(list(self.docs))
+
+    def next(self):
+        if self.position >= len(self.docs):
+            raise StopIteration
+        self.position += 1
+        return self.docs[self.position - 1]
+
+    def rewind(self):
+        self.position = 0
+
+    def __getitem__(self, index):
+        return self.docs[index]
+
+
+class FakeCollection:
+    """ An in-memory collection answering the pymongo 2.0 calls the models
+    make, for tests that have no MongoDB to talk to.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.docs = []
+
+    def ensure_index(self, *args, **kwargs):
+        pass
+
+    def index_information(self):
+        return {}
+
+    def project(self, doc, fields):
+        import copy
+        if fields is None:
+            return copy.deepcopy(doc)
+        names = fields.keys() if isinstance(fields, dict) else fields
+        projected = dict((name, copy.deepcopy(doc[name])) for name in names if name in doc)
+        projected['_id'] = doc['_id']
+        return projected
+
+    def find(self, spec=None, fields=None, **kwargs):
+        return FakeCursor([self.project(doc, fields) for doc in self.docs if matches(doc, spec or {})])
+
+    def find_one(self, spec=None, fields=None, **kwargs):
+        if spec is not None and not isinstance(spec, dict):
+            spec = {'_id': spec}
+        for doc in self.find(spec, fields):
+            return doc
+        return None
+
+    def distinct(self, key):
+        return self.find().distinct(key)
+
+    def insert(self, docs, safe=False, **kwargs):
+        import copy
+        from bson.objectid import ObjectId
+        single = isinstance(docs, dict)
+        for doc in [docs] if single else docs:
+            doc.setdefault('_id', ObjectId())
+            self.docs.append(copy.deepcopy(doc))
+        return docs['_id'] if single else [doc['_id'] for doc in docs]
+
+    def save(self, doc, safe=False, **kwargs):
+        self.remove({'_id': doc.get('_id')})
+        return self.insert(doc)
+
+    def apply(self, doc, update, inserting):
+        if not any(key.startswith('$') for key in update):
+            update = {'$set': update}
+        for op, changes in update.iteritems():
+            for path, value in changes.iteritems():
+                if op == '$set' or (op == '$setOnInsert' and inserting):
+                    set_path(doc, path, value)
+                elif op == '$unset':
+                    unset_path(doc, path)
+                elif op == '$inc':
+                    current = get_path(doc, path)
+                    set_path(doc, path, (0 if current is MISSING else current) + value)
+                elif op == '$addToSet':
+                    current = get_path(doc, path)
+                    current = [] if current is MISSING else current
+                    for item in value.get('$each', [value]) if isinstance(value, dict) else [value]:
+                        if item not in current:
+                            current.append(item)
+                    set_path(doc, path, current)
+                elif op == '$pull':
+                    set_path(doc, path, [item for item in get_path(doc, path) or [] if item != value])
+
+    def update(self, spec, update, upsert=False, multi=False, safe=False, **kwargs):
+        from bson.objectid import ObjectId
+        docs = [doc for doc in self.docs if matches(doc, spec)]
+        for doc in docs if multi else docs[:1]:
+            self.apply(doc, update, False)
+        if not docs and upsert:
+            doc = dict((key, value) for key, value in spec.iteritems() if not key.startswith('$') and not isinstance(value, dict))
+            doc.setdefault('_id', ObjectId())
+            self.apply(doc, update, True)
+            self.docs.append(doc)
+        return {'n': len(docs) or int(upsert), 'updatedExisting': bool(docs)}
+
+    def find_and_modify(self, query, update, upsert=False, new=False, fields=None, **kwargs):
+        before = self.find_one(query)
+        self.update(query, update, upsert=upsert)
+        if new:
+            return self.find_one(query, fields)
+        return self.project(before, fields) if before is not None else None
+
+    def remove(self, spec=None, safe=False, **kwargs):
+        self.docs = [doc for doc in self.docs if not matches(doc, spec or {})]
+
+
+class FakeDatabase:
+
+    def __init__(self):
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = FakeCollection(name)
+        return self.collections[name]
+
+    def collection_names(self):
+        return self.collections.keys()
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """ Points mongoengine at a FakeDatabase for the duration of a test.
+    """
+
+    def setUp(self):
+        from mongoengine import connection
+        from triage import models
+        self.db = FakeDatabase()
+        identity = connection.get_identity()
+        self.connection = connection._connection.get(identity), connection._db.get(identity)
+        connection._connection[identity] = object()
+        connection._db[identity] = self.db
+        self.documents = [value for value in vars(models).values() if isinstance(value, type) and issubclass(value, models.Document)]
+        for document in self.documents:
+            document._collection = None
+
+    def tearDown(self):
+        from mongoengine import connection
+        identity = connection.get_identity()
+        connection._connection[identity], connection._db[identity] = self.connection
+        for document in self.documents:
+            document._collection = None
+
+    def collection(self, document):
+        return document.objects._collection
+
+
+class ReadMarkerTests(DatabaseTestCase):
+
+    def setUp(self):
+        from bson.objectid import ObjectId
+        from triage.models import Error, ReadMarker, SeenOverride
+        DatabaseTestCase.setUp(self)
+        self.user = ObjectId()
+        self.errors = self.collection(Error)
+        self.overrides = self.collection(SeenOverride)
+        self.markers = self.collection(ReadMarker)
+        self.ids = self.errors.insert([{'project': 'p', 'timelatest': t} for t in [1, 2, 3, 4, 5]])
+
+    def override(self, index, seen=True, timelatest=None):
+        self.overrides.insert({
+            'user': self.user,
+            'project': 'p',
+            'error': self.ids[index],
+            'seen': seen,
+            'timelatest': index + 1 if timelatest is None else timelatest
+        })
+
+    def marker(self):
+        doc = self.markers.find_one({'user': self.user, 'project': 'p'})
+        return doc.get('timestamp', 0) if doc else 0
+
+    def remaining(self):
+        return sorted(self.ids.index(doc['error']) for doc in self.overrides.find())
+
+    def test_moves_marker_over_seen_errors(self):
+        from triage.models import ReadMarker
+        for index in [0, 1, 3]:
+            self.override(index)
+        self.assertEqual(ReadMarker.compact(self.user, 'p'), 1)
+        self.assertEqual(self.marker(), 2)
+        self.assertEqual(self.remaining(), [3])
+
+    def test_drops_useless_overrides(self):
+        from bson.objectid import ObjectId
+        from triage.models import ReadMarker
+        self.markers.insert({'user': self.user, 'project': 'p', 'timestamp': 2})
+        # seen below the marker, recurred since, unseen above the marker
+        self.override(0)
+        self.override(3, timelatest=1)
+        self.override(4, seen=False)
+        self.overrides.insert({'user': self.user, 'project': 'p', 'error': ObjectId(), 'seen': True, 'timelatest': 1})
+        # what still counts: unseen below the marker
+        self.override(1, seen=False)
+
+        self.assertEqual(ReadMarker.compact(self.user, 'p'), 1)
+        self.assertEqual(self.marker(), 2)
+        self.assertEqual(self.remaining(), [1])
+
+    def test_marker_covers_whole_timestamps(self):
+        from triage.models import ReadMarker
+        self.errors.update({'_id': self.ids[2]}, {'$set': {'timelatest': 2}})
+        self.override(0)
+        self.override(1)
+        ReadMarker.compact(self.user, 'p')
+        # the error at 3 now shares timestamp 2 and is not seen
+        self.assertEqual(self.marker(), 1)
+        self.assertEqual(self.remaining(), [1])
+
+    def test_caps_overrides(self):
+        from triage import models
+        limit, models.MAX_OVERRIDES = models.MAX_OVERRIDES, 2
+        try:
+            for index in [1, 2, 3, 4]:
+                self.override(index)
+            self.assertEqual(models.ReadMarker.compact(self.user, 'p'), 2)
+        finally:
+            models.MAX_OVERRIDES = limit
+        self.assertEqual(self.marker(), 0)
+        self.assertEqual(self.remaining(), [3, 4])
+
+    def test_mark_many(self):
+        from triage.models import ReadMarker, User
+        user = User(id=self.user)
+        docs = list(self.errors.find({'_id': {'$in': self.ids[:3]}}, fields=['project', 'timelatest']))
+        self.assertEqual(ReadMarker.mark_many(user, docs, True), 3)
+        self.assertEqual(self.marker(), 3)
+        self.assertEqual(self.remaining(), [])
+        self.assertEqual(ReadMarker.version_of(user, 'p'), 1)
+        self.assertEqual(ReadMarker.unseen_counts(user, 'p'), {'openUnseen': 2, 'resolvedUnseen': 0})
+
+    def test_mark_compacts_now_and_then(self):
+        from triage import models
+        user = models.User(id=self.user)
+        error = models.Error(id=self.ids[0], project='p', timelatest=1)
+        original = models.random
+        try:
+            models.random = lambda: 0.5
+            models.ReadMarker.mark(user, error, True)
+            self.assertEqual(self.remaining(), [0])
+            models.random = lambda: 0.0
+            models.ReadMarker.mark(user, error, True)
+            self.assertEqual(self.remaining(), [])
+        finally:
+            models.random = original
+        self.assertEqual(self.marker(), 1)
+
+
+class ProjectCountersTests(DatabaseTestCase):
+
+    def test_reconciles_counters_created_by_increments(self):
+        from triage.models import Error, ProjectCounters
+        self.collection(Error).insert([
+            {'project': 'p', 'timelatest': 1},
+            {'project': 'p', 'timelatest': 2, 'tags': ['v1.2']},
+            {'project': 'p', 'timelatest': 3, 'hiddenby': 'someone'}
+        ])
+        ProjectCounters.add('p', {'open': 1})
+        counters = ProjectCounters.get_or_reconcile('p')
+        self.assertEqual((counters.open, counters.resolved), (2, 1))
+        self.assertEqual(counters.facets('open'), [(u'v1.2', 1)])
+
+        ProjectCounters.add('p', {'open': 1})
+        self.assertEqual(ProjectCounters.get_or_reconcile('p').open, 3)
+
+
+class ErrorBatchTests(unittest.TestCase):
+
+    def setUp(self):
+        from triage.ingest import ErrorBatch
+        self.store = FakeStore()
+        self.store.install()
+        self.dead_letters = FakeDeadLetters()
+        self.batch = ErrorBatch(100, 0, attempts=2, dead_letters=self.dead_letters)
+
+    def tearDown(self):
+        self.store.uninstall()
+
+    def add(self, message='Undefined index: user_id', count=1):
+        from triage.ingest import prepare
+        for i in xrange(count):
+            self.batch.add(prepare(error_msg(message=message)))
+
+    def test_coalesces(self):
+        self.add(count=3)
+        self.add('other')
+        self.assertEqual(self.batch.flush(), 4)
+        self.assertEqual(sorted(self.store.errors.values()), [1, 3])
+        self.assertEqual(len(self.store.instances), 4)
+        self.assertEqual(self.store.counters, {'open': 2})
+        self.assertEqual(len(self.batch), 0)
+
+    def test_keeps_what_failed(self):
+        from pymongo.errors import OperationFailure
+        from triage.ingest import FlushError
+        self.add(count=2)
+        self.store.failures['upsert'] = [OperationFailure('down')]
+        self.assertRaises(FlushError, self.batch.flush)
+        self.assertEqual(len(self.batch), 2)
+        self.assertEqual(self.store.errors, {})
+
+        # written once on the retry, not counted twice
+        self.assertEqual(self.batch.flush(), 2)
+        self.assertEqual(self.store.errors.values(), [2])
+        self.assertEqual(self.store.counters, {'open': 1})
+
+    def test_retries_counters(self):
+        from pymongo.errors import OperationFailure
+        self.add()
+        self.store.failures['counters'] = [OperationFailure('down')]
+        self.assertEqual(self.batch.flush(), 1)
+        self.assertEqual(self.store.counters, {})
+        self.add('other')
+        self.batch.flush()
+        self.assertEqual(self.store.counters, {'open': 2})
+
+    def test_dead_letters_what_keeps_failing(self):
+        from pymongo.errors import OperationFailure
+        from triage.ingest import FlushError
+        self.add('poison')
+        self.add('fine')
+        # the entries are written in no particular order, fail the poison one
+        upsert = self.store.upsert
+        def poisoned(first, latest, *args):
+            if latest['message'] == 'poison':
+                raise OperationFailure('too large')
+            return upsert(first, latest, *args)
+        self.store.upsert = poisoned
+
+        self.assertRaises(FlushError, self.batch.flush)
+        self.assertEqual(len(self.batch), 1)
+        self.assertEqual(self.batch.flush(), 0)
+        self.assertEqual(len(self.batch), 0)
+        self.assertEqual([msg['message'] for msg in self.dead_letters.msgs], ['poison'])
+        self.assertEqual(len(self.store.errors), 1)
+
+    def test_waits_out_unreachable_database(self):
+        from pymongo.errors import AutoReconnect
+        from triage.ingest import FlushError
+        self.add()
+        self.store.failures['upsert'] = [AutoReconnect('down')] * 3
+        for i in xrange(3):
+            self.assertRaises(FlushError, self.batch.flush)
+            self.assertTrue(self.batch.backoff is not None)
+        self.assertEqual(self.dead_letters.msgs, [])
+        self.assertEqual(self.batch.flush(), 1)
+        self.assertEqual(self.batch.backoff, None)
+
+    def test_isolates_failing_instances(self):
+        from pymongo.errors import OperationFailure
+        from triage.ingest import FlushError
+        self.add('a')
+        self.add('b')
+        # the bulk insert, then one of the two groups, twice
+        self.store.failures['insert'] = [OperationFailure('too large'), OperationFailure('too large'), None]
+        self.assertRaises(FlushError, self.batch.flush)
+        self.assertEqual(len(self.store.instances), 1)
+        self.assertEqual(len(self.batch), 1)
+
+        self.store.failures['insert'] = [OperationFailure('too large')] * 2
+        self.assertEqual(self.batch.flush(), 0)
+        self.assertEqual(len(self.dead_letters.msgs), 1)
+        self.assertEqual(len(self.store.errors), 2)
+
+
+class FakeSocket:
+
+    def __init__(self):
+        self.sent = []
+        self.received = []
+        self.closed = False
+
+    def send(self, data, flags=0):
+        self.sent.append(data)
+
+    def send_multipart(self, frames, flags=0):
+        self.sent.append(frames)
+
+    def recv_multipart(self, flags=0):
+        import zmq
+        if not self.received:
+            raise zmq.ZMQError()
+        return self.received.pop(0)
+
+    def setsockopt(self, option, value):
+        pass
+
+    def bind(self, uri):
+        pass
+
+    def connect(self, uri):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class FakeContext:
+
+    def __init__(self):
+        self.sockets = []
+
+    def socket(self, kind):
+        self.sockets.append(FakeSocket())
+        return self.sockets[-1]
+
+    def term(self):
+        pass
+
+
+class FakeProcess:
+
+    def __init__(self, target, args):
+        self.pid = 0
+        self.exitcode = None
+
+    def start(self):
+        pass
+
+    def is_alive(self):
+        return True
+
+
+class WorkerPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        from triage import pool
+        self.original_process = pool.Process
+        pool.Process = FakeProcess
+        self.dead_letters = FakeDeadLetters()
+        self.settings = {'ingest.dead_letters': self.dead_letters, 'ingest.max_pending': '3'}
+        self.pool = pool.WorkerPool(self.settings, 1, FakeContext())
+        self.pool.start()
+
+    def tearDown(self):
+        from triage import pool
+        pool.Process = self.original_process
+
+    def dispatch(self, count):
+        for i in xrange(count):
+            self.pool.dispatch({'hash': 'a' * 32, 'message': i})
+
+    def test_acks_release_pending(self):
+        self.dispatch(3)
+        self.pool.acks.received.append(['0', '2'])
+        self.pool.collect_acks()
+        self.assertEqual([seq for seq, data, replays in self.pool.pending[0]], [3])
+
+    def test_replays_to_replacement(self):
+        dead = self.pool.sockets[0]
+        self.dispatch(2)
+        self.pool.spawn(0)
+        self.assertTrue(dead.closed)
+        self.assertEqual([frames[0] for frames in self.pool.sockets[0].sent], ['1', '2'])
+        self.assertEqual([replays for seq, data, replays in self.pool.pending[0]], [1, 1])
+
+    def test_dead_letters_poison(self):
+        from triage.pool import MAX_REPLAYS
+        self.dispatch(1)
+        for i in xrange(MAX_REPLAYS):
+            self.pool.spawn(0)
+        self.assertEqual(self.dead_letters.msgs, [])
+        self.pool.spawn(0)
+        self.assertEqual(self.dead_letters.msgs, [{'hash': 'a' * 32, 'message': 0}])
+        self.assertEqual(len(self.pool.pending[0]), 0)
+        self.assertEqual(self.pool.sockets[0].sent, [])
+
+    def test_dead_letters_overflow(self):
+        self.dispatch(5)
+        self.assertEqual(len(self.pool.pending[0]), 3)
+        self.assertEqual([msg['message'] for msg in self.dead_letters.msgs], [3, 4])
+
+
+class JournalTests(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.path)
+
+    def write(self, count, segment_size=64):
+        from triage.journal import Journal
+        journal = Journal(self.path, segment_size)
+        for i in xrange(count):
+            journal.append({'n': i})
+        journal.sync()
+        return journal
+
+    def test_read_and_commit_across_segments(self):
+        from triage.journal import JournalReader, list_segments
+        self.write(10)
+        self.assertTrue(len(list_segments(self.path)) > 1)
+
+        reader = JournalReader(self.path)
+        msgs, position = reader.read(4)
+        self.assertEqual(msgs, [{'n': i} for i in xrange(4)])
+        reader.commit(position)
+
+        # a new reader resumes from the checkpoint
+        reader = JournalReader(self.path)
+        msgs, position = reader.read(100)
+        self.assertEqual(msgs, [{'n': i} for i in xrange(4, 10)])
+        reader.commit(position)
+        self.assertEqual(list_segments(self.path), [position[0]])
+        self.assertEqual(reader.lag(), 0)
+
+    def test_recovers_torn_record(self):
+        import os
+        from triage.journal import JournalReader, list_segments, segment_name
+        self.write(2, segment_size=1024).out.close()
+        filename = os.path.join(self.path, segment_name(list_segments(self.path)[-1]))
+        f = open(filename, 'ab')
+        f.write('\x00\x00\x00\x10\x00')
+        f.close()
+
+        self.write(1, segment_size=1024)
+        msgs, position = JournalReader(self.path).read(100)
+        self.assertEqual(msgs, [{'n': 0}, {'n': 1}, {'n': 0}])
+
+    def test_dead_letters_corrupt_record(self):
+        import os
+        import msgpack
+        from triage.journal import HEADER, JournalReader, list_segments, segment_name
+        self.write(2, segment_size=1024).out.close()
+        filename = os.path.join(self.path, segment_name(list_segments(self.path)[-1]))
+        # same length, so only the checksum gives it away
+        data = msgpack.packb({'n': 5})
+        f = open(filename, 'r+b')
+        f.seek(HEADER.size)
+        f.write(data)
+        f.close()
+
+        dead_letters = FakeDeadLetters()
+        msgs, position = JournalReader(self.path, dead_letters).read(100)
+        self.assertEqual(msgs, [{'n': 1}])
+        self.assertEqual(len(dead_letters.msgs), 1)
+        self.assertEqual(dead_letters.msgs[0]['offset'], 0)
+        self.assertEqual(dead_letters.msgs[0]['record'], data)
+
+
+class SamplerTests(unittest.TestCase):
+
+    def keep(self, sampler, timestamps, **fields):
+        return [sampler.keep(dict(fields, hash='a' * 32, timestamp=t)) for t in timestamps]
+
+    def test_keeps_first_per_window(self):
+        from triage.ingest import Sampler
+        sampler = Sampler(2, 60, 0)
+        self.assertEqual(self.keep(sampler, [0, 1, 2, 3]), [True, True, False, False])
+        self.assertEqual(self.keep(sampler, [60, 61, 62]), [True, True, False])
+
+    def test_keeps_new_commits(self):
+        from triage.ingest import Sampler
+        sampler = Sampler(1, 60, 0)
+        self.assertEqual(self.keep(sampler, [0, 1], commithash='a'), [True, False])
+        self.assertEqual(self.keep(sampler, [2, 3], commithash='b'), [True, False])
+
+    def test_reservoir(self):
+        from triage.ingest import Sampler
+        sampler = Sampler(1, 60, 1000)
+        self.assertTrue(all(self.keep(sampler, range(100))))
+
+
+class ApiErrorsTests(DatabaseTestCase):
+
+    def setUp(self):
+        from triage.models import Project
+        DatabaseTestCase.setUp(self)
+        self.config = testing.setUp(settings={
+            'ingest.dead_letters': FakeDeadLetters(),
+            'ingest.shared_payload': '',
+            'ingest.batch_size': '2'
+        })
+        self.store = FakeStore()
+        self.store.install()
+        Project(name='Project', token='project').save()
+
+    def tearDown(self):
+        self.store.uninstall()
+        testing.tearDown()
+        DatabaseTestCase.tearDown(self)
+
+    def post(self, body, content_type='application/x-ndjson', **headers):
+        from StringIO import StringIO
+        from triage.views.api import errors
+        headers = dict({'X-Triage-Token': 'project', 'Content-Type': content_type}, **headers)
+        request = testing.DummyRequest(headers=headers)
+        request.body_file = StringIO(body)
+        return request.response, errors(request)
+
+    def ndjson(self, messages):
+        import json
+        return '\n'.join(json.dumps(error_msg(message=message)) for message in messages) + '\n'
+
+    def test_ndjson(self):
+        response, result = self.post(self.ndjson(['a', 'b', 'a', 'c']) + 'not json\n')
+        self.assertEqual(result, {'success': True, 'accepted': 4, 'failed': 1})
+        self.assertEqual(sorted(self.store.errors.values()), [1, 1, 2])
+
+    def test_gzip_msgpack(self):
+        import gzip
+        import msgpack
+        from StringIO import StringIO
+        out = StringIO()
+        f = gzip.GzipFile(fileobj=out, mode='wb')
+        for message in ['a', 'b']:
+            f.write(msgpack.packb(error_msg(message=message)))
+        f.close()
+        response, result = self.post(out.getvalue(), 'application/x-msgpack', **{'Content-Encoding': 'gzip'})
+        self.assertEqual(result, {'success': True, 'accepted': 2, 'failed': 0})
+
+    def test_unknown_token(self):
+        response, result = self.post(self.ndjson(['a']), **{'X-Triage-Token': 'unknown'})
+        self.assertEqual(response.status_int, 403)
+
+    def test_record_too_large(self):
+        self.config.registry.settings['api.max_record_size'] = '100'
+        response, result = self.post(self.ndjson(['a' * 200]))
+        self.assertEqual(response.status_int, 413)
+        self.assertEqual(self.store.errors, {})
+
+    def test_unwritten_errors(self):
+        from pymongo.errors import AutoReconnect
+        self.store.failures['upsert'] = [None, AutoReconnect('down')]
+        response, result = self.post(self.ndjson(['a', 'b', 'c']))
+        self.assertEqual(response.status_int, 503)
+        self.assertEqual((result['accepted'], result['failed']), (1, 1))
+
+    def test_unwritten_instances(self):
+        from pymongo.errors import OperationFailure
+        self.store.failures['insert'] = [OperationFailure('down')] * 2
+        response, result = self.post(self.ndjson(['a', 'b']))
+        self.assertEqual(result, {'success': True, 'accepted': 2, 'failed': 0})
+        self.assertEqual(len(self.config.registry.settings['ingest.dead_letters'].msgs), 1)
+
+
+def load_client(context):
+    import os
+    import imp
+    import types
+    import zmq
+    module = imp.load_source('triage_client', os.path.join(os.path.dirname(__file__), '..', 'clients', 'python', 'client.py'))
+    # the sender thread creates its own context
+    module.zmq = types.ModuleType('zmq')
+    module.zmq.__dict__.update(vars(zmq), Context=lambda: context)
+    return module
+
+
+class BackgroundClientTests(unittest.TestCase):
+
+    def setUp(self):
+        self.context = FakeContext()
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+
+    def client(self, **kwargs):
+        # never due on its own, so the queue can be inspected
+        kwargs.setdefault('flush_interval', 60)
+        client = load_client(self.context).BackgroundClient('tcp://127.0.0.1:5001', **kwargs)
+        self.clients.append(client)
+        return client
+
+    def test_coalesces(self):
+        client = self.client()
+        for timestamp in [1, 2, 3]:
+            client.log_error(error_msg(timestamp=timestamp))
+        client.log_error(error_msg(message='other', timestamp=4))
+        pending = client.pending.values()
+        self.assertEqual([(error['count'], error['timefirst'], error['timestamp']) for error in pending], [(3, 1, 3), (1, 4, 4)])
+
+    def test_drop_oldest(self):
+        client = self.client(max_pending=2)
+        for message in ['a', 'b', 'c']:
+            client.log_error(error_msg(message=message))
+        self.assertEqual([error['message'] for error in client.pending.values()], ['b', 'c'])
+        self.assertEqual(client.dropped, 1)
+
+    def test_drop_newest(self):
+        client = self.client(max_pending=2, policy='drop-newest')
+        for message in ['a', 'b', 'c', 'a']:
+            client.log_error(error_msg(message=message))
+        self.assertEqual([(error['message'], error['count']) for error in client.pending.values()], [('a', 2), ('b', 1)])
+        self.assertEqual(client.dropped, 1)
+
+    def test_flush(self):
+        import msgpack
+        client = self.client(batch_size=2)
+        for message in ['a', 'a', 'b', 'c']:
+            client.log_error(error_msg(message=message))
+        self.assertTrue(client.flush())
+        self.assertEqual(client.sent, 3)
+
+        frames = self.context.sockets[0].sent
+        self.assertEqual(len(frames), 2)
+        unpacker = msgpack.Unpacker()
+        unpacker.feed(''.join(frames))
+        received = list(unpacker)
+        self.assertEqual([(error['message'], error['count']) for error in received], [('a', 2), ('b', 1), ('c', 1)])
+        self.assertTrue(all(error['fingerprint'].startswith('v2:') for error in received))
+
+
+class SearchTests(unittest.TestCase):
+
+    def test_parse_search(self):
+        from triage.models import parse_search
+        self.assertEqual(parse_search('a b OR c*'), [['a', 'b'], ['c*']])
+        self.assertEqual(parse_search('  Key  Error '), [['key', 'error']])
+        self.assertEqual(parse_search('or a or or'), [['a']])
+        self.assertEqual(parse_search('* **'), [])
+        self.assertEqual(parse_search(''), [])
+
+    def test_term_pattern(self):
+        from triage.models import term_pattern
+        self.assertEqual(term_pattern('key'), 'key')
+        pattern = term_pattern('ke.*')
+        self.assertEqual(pattern.pattern, '^ke\\.')
+        self.assertTrue(pattern.match('ke.y'))
+        self.assertFalse(pattern.match('key'))
+
+
+class EventHubTests(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        from triage.events import EventHub
+        self.path = tempfile.mkdtemp()
+        # nothing publishes there, events are added directly
+        self.hub = EventHub('ipc://' + self.path + '/events')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.path)
+
+    def test_wait(self):
+        self.hub.add('a', [{'hash': '1'}, {'hash': '2'}])
+        self.hub.add('b', [{'hash': '3'}])
+        self.assertEqual(self.hub.wait('a', 0, 0), (3, [{'hash': '1'}, {'hash': '2'}]))
+        self.assertEqual(self.hub.wait('a', 1, 0), (3, [{'hash': '2'}]))
+        self.assertEqual(self.hub.wait('b', 2, 0), (3, [{'hash': '3'}]))
+        self.assertEqual(self.hub.wait('a', 3, 0), (3, []))
+
+    def test_starts_from_latest(self):
+        self.hub.add('a', [{'hash': '1'}])
+        # no id yet, or one from before a restart of the hub
+        self.assertEqual(self.hub.wait('a', None, 0), (1, []))
+        self.assertEqual(self.hub.wait('a', 10, 0), (1, []))
+
+    def test_discarded(self):
+        from triage.events import KEEP
+        self.hub.add('a', [{'hash': str(i)} for i in xrange(KEEP + 2)])
+        self.assertEqual(self.hub.wait('a', 0, 0), (KEEP + 2, None))
+        self.assertEqual(self.hub.wait('a', 2, 0)[1][0], {'hash': '2'})
+
+    def test_wakes_waiters(self):
+        from threading import Timer
+        timer = Timer(0.1, self.hub.add, ['a', [{'hash': '1'}]])
+        timer.start()
+        self.assertEqual(self.hub.wait('a', 0, 5), (1, [{'hash': '1'}]))
+        timer.join()
+
+    def test_publisher(self):
+        from triage.events import Publisher
+        self.assertEqual(Publisher.shared({}), None)
+        publisher = Publisher.shared({'events.publish_uri': 'ipc://' + self.path + '/publish'})
+        self.assertTrue(publisher is Publisher.shared({'events.publish_uri': 'ipc://' + self.path + '/publish'}))
+        # never blocks, with or without subscribers
+        publisher.publish('a', [{'hash': '1'}])
+
+
+class ResponseCacheTests(DatabaseTestCase):
+
+    def setUp(self):
+        from bson import ObjectId
+        from triage.cache import ResponseCache
+        DatabaseTestCase.setUp(self)
+        self.config = testing.setUp()
+        self.renderer = testing.DummyTemplateRenderer('<ul></ul>')
+        self.config.testing_add_renderer('errors/list.html', self.renderer)
+        self.cache = ResponseCache(10)
+        self.user = testing.DummyResource(id=ObjectId(), name='user', tzoffset=0)
+        self.builds = 0
+
+    def tearDown(self):
+        testing.tearDown()
+        DatabaseTestCase.tearDown(self)
+
+    def build(self):
+        self.builds += 1
+        return {'errors': []}, {'X-Triage-Next': 'cursor'}
+
+    def respond(self, url='/', **headers):
+        from pyramid.request import Request
+        # a real request, for its conditional headers
+        request = Request.blank(url, headers=headers)
+        request.registry = self.config.registry
+        request.user = self.user
+        return self.cache.respond(request, 'project', 'errors/list.html', self.build)
+
+    def test_caches(self):
+        first = self.respond()
+        self.assertEqual(first.body, '<ul></ul>')
+        self.assertEqual(first.headers['X-Triage-Next'], 'cursor')
+        second = self.respond('/?_=123')
+        self.assertEqual((second.body, second.etag), (first.body, first.etag))
+        self.assertEqual(second.headers['X-Triage-Next'], 'cursor')
+        self.assertEqual(self.builds, 1)
+
+    def test_not_modified(self):
+        etag = self.respond().etag
+        response = self.respond(**{'If-None-Match': '"%s"' % etag})
+        self.assertEqual(response.status_int, 304)
+        self.assertEqual(self.builds, 1)
+
+    def test_etag_changes(self):
+        from triage.models import ProjectCounters, ReadMarker
+        etags = set([self.respond().etag])
+        etags.add(self.respond('/?show=open').etag)
+        ProjectCounters.bump('project')
+        etags.add(self.respond().etag)
+        ReadMarker.bump(self.user.id, 'project')
+        etags.add(self.respond().etag)
+        self.user.tzoffset = 60
+        etags.add(self.respond().etag)
+        self.assertEqual(len(etags), 5)
+        self.assertEqual(self.builds, 5)
+
+
+class MassActionTests(DatabaseTestCase):
+
+    def setUp(self):
+        from triage.models import Error, User
+        DatabaseTestCase.setUp(self)
+        self.user = User(name='user', email='user@example.com', password='x', created=0)
+        self.user.save()
+        self.collection(Error).insert([{'project': 'p', 'timelatest': i} for i in xrange(5)])
+        self.collection(Error).insert({'project': 'other', 'timelatest': 10})
+
+    def apply(self, action, after=None, size=None):
+        from triage.models import Error
+        return Error.objects(project='p').apply(action, self.user, after, size)
+
+    def test_chunks(self):
+        from triage.models import Error, ProjectCounters
+        affected, went, after = self.apply('resolve', size=2)
+        self.assertEqual((affected, went), (2, 2))
+        resolved = [doc['timelatest'] for doc in self.collection(Error).find({'hiddenby': {'$exists': True}})]
+        self.assertEqual(sorted(resolved), [3, 4])
+
+        results = []
+        while after is not None:
+            affected, went, after = self.apply('resolve', after, 2)
+            results.append((affected, went))
+        self.assertEqual(results, [(2, 2), (1, 1)])
+
+        self.assertEqual(self.collection(Error).find({'hiddenby': {'$exists': True}}).count(), 5)
+        counters = self.collection(ProjectCounters).find_one({'_id': 'p'})
+        self.assertEqual((counters['open'], counters['resolved']), (-5, 5))
+
+    def test_skips_unchanged(self):
+        self.apply('resolve')
+        self.assertEqual(self.apply('resolve'), (0, 5, None))
+        self.assertEqual(self.apply('unresolve'), (5, 5, None))
+
+    def test_chunk_size(self):
+        from triage import models
+        chunk = models.MASS_CHUNK
+        models.MASS_CHUNK = 3
+        try:
+            affected, went, after = self.apply('claim')
+        finally:
+            models.MASS_CHUNK = chunk
+        self.assertEqual((affected, went), (3, 3))
+        self.assertTrue(after is not None)
@@ -6,7 +6,7 @@ from triage.forms import UserRegisterSchema, UserFormSchema, user_form_validator
 from deform import Form, ValidationFailure
 from pyramid.security import remember, forget
 from pyramid.security import authenticated_userid
-from triage.models import User, Project
+from triage.models import User, Project, ProjectCounters
 from mongoengine.queryset import DoesNotExist
 from deform.widget import TextInputWidget
 from colander import Invalid
@@ -127,6 +127,7 @@ def admin_project_edit(request):
             values = form.validate(controls)
             project.update(values)
             project.save()
+            ProjectCounters.bump(project.token)
             default_values(schema, project)
         except ValidationFailure, e:
             form_render = e.render()
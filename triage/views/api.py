@@ -1,9 +1,23 @@
 from pyramid.view import view_config
 import base64
 import json
-from triage.models import Error, Project, ProjectVersion
+import zlib
+import msgpack
+import logging
+from mongoengine.queryset import DoesNotExist
+from triage.models import Project, ProjectVersion
+from triage.ingest import ErrorBatch, FlushError, ingest, prepare
+from pymongo.errors import PyMongoError
 from time import time
 
+CHUNK_SIZE = 64 * 1024
+MAX_RECORD_SIZE = 1024 * 1024
+
+
+class RecordTooLarge(ValueError):
+    pass
+
+
 @view_config(route_name='api_log', renderer='string')
 def log(request):
     get_params = dict(request.GET)
@@ -11,8 +25,7 @@ def log(request):
         msg = json.loads(base64.b64decode(get_params['data']))
         msg = _format_backtrace(msg)
 
-        error = Error.create_from_msg(msg)
-        error.save()
+        ingest(msg, request.registry.settings)
     except:
         return {'success': False}
 
@@ -20,6 +33,66 @@ def log(request):
 
 
 
+@view_config(route_name='api_errors', renderer='json', request_method='POST')
+def errors(request):
+    """ Bulk ingest: a gzip or deflate compressed (or plain) body of NDJSON
+    or msgpack encoded errors, decoded as it streams in and written in
+    batches. The project token is checked once for the whole request.
+    """
+    token = request.headers.get('X-Triage-Token') or request.GET.get('token')
+    try:
+        project = Project.objects.get(token=token)
+    except DoesNotExist:
+        request.response.status_int = 403
+        return {'success': False, 'reason': 'Unknown project token'}
+
+    content_type = request.headers.get('Content-Type', '').split(';')[0].strip()
+    if content_type not in _decoders:
+        request.response.status_int = 415
+        return {'success': False, 'reason': 'Unsupported content type: ' + content_type}
+
+    encoding = request.headers.get('Content-Encoding', 'identity')
+    if encoding not in _decompressors:
+        request.response.status_int = 415
+        return {'success': False, 'reason': 'Unsupported content encoding: ' + encoding}
+
+    settings = request.registry.settings
+    batch = ErrorBatch.from_settings(settings, window=0)
+    limit = int(settings.get('api.max_record_size', MAX_RECORD_SIZE))
+    persisted = failed = 0
+
+    try:
+        chunks = _read_chunks(request.body_file, _decompressors[encoding]())
+        for msg in _decoders[content_type](chunks, limit):
+            try:
+                msg['project'] = project.token
+                msg = _format_backtrace(msg)
+                batch.add(prepare(msg, settings))
+            except Exception:
+                failed += 1
+
+            if batch.due():
+                persisted += _flush(batch)
+
+        if len(batch):
+            persisted += _flush(batch)
+    except Exception, e:
+        logging.exception('Failed to ingest errors')
+        if isinstance(e, FlushError):
+            persisted += e.accepted
+            failed += e.failed
+        if isinstance(e, RecordTooLarge):
+            request.response.status_int = 413
+        elif isinstance(e, PyMongoError) or isinstance(e, FlushError):
+            # not the client's fault, it should send the batch again later
+            request.response.status_int = 503
+        else:
+            request.response.status_int = 400
+        return {'success': False, 'reason': str(e), 'accepted': persisted, 'failed': failed}
+
+    return {'success': True, 'accepted': persisted, 'failed': failed}
+
+
 @view_config(route_name='api_version', renderer='json', request_method='POST')
 def version(request):
 
@@ -41,10 +114,103 @@ def version(request):
 
 
 
+def _flush(batch):
+    """ Flushes a batch that will not be retried within the request. The
+    messages of upserted errors are accepted even if their instances are
+    not written, the FlushError raised for the rest carries both counts.
+    """
+    pending = len(batch)
+    try:
+        return batch.flush()
+    except FlushError, e:
+        unwritten = batch.settle(str(e))
+        if not unwritten:
+            return pending
+        e.accepted = pending - len(unwritten)
+        e.failed = len(unwritten)
+        raise
+
+
+def _read_chunks(body, decompressor):
+    while True:
+        data = body.read(CHUNK_SIZE)
+        if not data:
+            break
+
+        if decompressor is None:
+            yield data
+            continue
+
+        # bound the output per step so a small body cannot inflate into memory
+        chunk = decompressor.decompress(data, CHUNK_SIZE)
+        while chunk:
+            yield chunk
+            chunk = decompressor.decompress(decompressor.unconsumed_tail, CHUNK_SIZE)
+
+    if decompressor is not None:
+        tail = decompressor.flush()
+        if tail:
+            yield tail
+
+
+def _ndjson_messages(chunks, limit):
+    buffer = ''
+    for chunk in chunks:
+        lines = (buffer + chunk).split('\n')
+        buffer = lines.pop()
+        if len(buffer) > limit:
+            raise RecordTooLarge('Line longer than %d bytes' % limit)
+        for line in lines:
+            if len(line) > limit:
+                raise RecordTooLarge('Line longer than %d bytes' % limit)
+            if line.strip():
+                yield _json_message(line)
+
+    if buffer.strip():
+        yield _json_message(buffer)
+
+
+def _json_message(line):
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+
+def _msgpack_messages(chunks, limit):
+    unpacker = msgpack.Unpacker()
+    # bytes fed since the last complete message, within a chunk of the record
+    buffered = 0
+    for chunk in chunks:
+        unpacker.feed(chunk)
+        buffered += len(chunk)
+        for msg in unpacker:
+            buffered = 0
+            yield msg
+        if buffered > limit + CHUNK_SIZE:
+            raise RecordTooLarge('Record longer than %d bytes' % limit)
+
+
+_decoders = {
+    'application/x-ndjson': _ndjson_messages,
+    'application/x-msgpack': _msgpack_messages
+}
+
+_decompressors = {
+    'identity': lambda: None,
+    'gzip': lambda: zlib.decompressobj(16 + zlib.MAX_WBITS),
+    'deflate': lambda: zlib.decompressobj()
+}
+
+
 def _format_backtrace(msg):
     if ('backtrace' in msg):
         backtrace = []
         for trace in msg['backtrace']:
+            # already structured frames are kept as they are
+            if type(trace) == dict:
+                backtrace.append(trace)
+                continue
             backtrace.append({
                 'class': '',
                 'file': '',
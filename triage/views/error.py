@@ -2,120 +2,173 @@ from pyramid.view import view_config
 from pyramid.renderers import render_to_response
 from pyramid.httpexceptions import HTTPFound, HTTPNotFound
 
-from triage.models import Error, Comment, Tag, ErrorInstance, Project
+from triage.models import Error, Comment, Tag, ErrorInstance, Project, ProjectCounters, ReadMarker, Blob
+from triage.events import EventHub
+from triage.cache import ResponseCache
 from triage.util import GithubLinker
+from bson.objectid import ObjectId
 from time import time
 from os import path
 
-import logging
 
 
-def get_errors(request, fetch_recent=False):
-    project = get_selected_project(request)
+ORDER_MAP = {
+    'date': 'timelatest',
+    'firstoccurrence': 'timefirst',
+    'occurances': 'count',
+    'activity': 'activity'
+}
+
+
+def filter_errors(project, show, user, search='', tags=()):
+    if show == 'resolved':
+        errors = project.errors().resolved()
+    elif show == 'mine':
+        errors = project.errors().active().filter(claimedby=user)
+    else:
+        errors = project.errors().active()
+
+    if search:
+        errors = errors.search(search)
 
-    log = logging.getLogger(__name__)
+    if tags:
+        errors = errors.filter(tags__in=tags)
+
+    return errors
+
+
+def get_errors(request):
+    """ The requested page of errors as a dict with 'errors' and the
+    'next_cursor' and 'prev_cursor' to pass back as `after` or `before`.
+    """
+    project = get_selected_project(request)
 
     search = request.GET.get('search', '')
     show = request.GET.get('show', 'open')  # open, resolved, mine
     tags = request.GET.getall('tags')
     order_by = request.GET.get('order_by', 'date')
     direction = request.GET.get('direction', 'desc')
-    start = int(request.GET.get('start', 0))
+    after = request.GET.get('after')
+    before = request.GET.get('before')
     time_latest = int(request.GET.get('timelatest', time()))
 
-    if show not in ['open', 'resolved', 'mine']:
-        show = 'open'
+    errors = filter_errors(project, show, request.user, search, tags)
+    errors = errors.filter(timelatest__lte=time_latest)
 
-    if show == 'open':
-        errors = project.errors().active()
-    elif show == 'resolved':
-        errors = project.errors().resolved()
-    elif show == 'mine':
-        errors = project.errors().active().filter(claimedby=request.user)
+    if direction != 'asc':
+        direction = 'desc'
 
-    if search:
-        errors.search(search)
+    def fetch(after, before):
+        if search and order_by == 'relevance':
+            return errors.ranked(search, after)
+        return errors.page(ORDER_MAP.get(order_by, 'timelatest'), direction, after, before)
 
-    if tags:
-        errors.filter(tags__in=tags)
-
-    if fetch_recent:
-        return errors.filter(timelatest__gt=time_latest).count()
+    try:
+        page = fetch(after, before)
+    except ValueError:
+        # a stale or mangled cursor, start over from the first page
+        page = fetch(None, None)
+    errors, next_cursor, prev_cursor = page
 
-    errors.filter(timelatest__lte=time_latest)
+    ReadMarker.annotate(request.user, project.token, errors)
 
-    order_map = {
-        'date': 'timelatest',
-        'firstoccurrence': 'timefirst',
-        'occurances': 'count',
-        'activity': 'comments'
+    return {
+        'errors': errors,
+        'next_cursor': next_cursor,
+        'prev_cursor': prev_cursor
     }
 
-    if order_by in order_map:
-        order_by = order_map[order_by]
-    else:
-        order_by = 'timelatest'
-
-    if direction == 'desc':
-        order_by = '-' + order_by
 
-    errors.order_by(order_by)
-
-    pagedErrors = errors.skip(start).limit(20)
+@view_config(route_name='error_list', permission='authenticated', xhr=True)
+def error_list(request):
+    project = get_selected_project(request)
 
-    log.debug(errors.count())
-    log.debug(pagedErrors.count())
+    def build():
+        page = get_errors(request)
 
-    return list(pagedErrors)
+        # the rows are rendered as html, so the cursors travel in headers
+        headers = {
+            'X-Next-Cursor': page['next_cursor'] or '',
+            'X-Prev-Cursor': page['prev_cursor'] or ''
+        }
 
+        return {
+            'selected_project': project,
+            'errors': page['errors'],
+            'basename': path.basename
+        }, headers
 
-@view_config(route_name='error_list', permission='authenticated', xhr=True, renderer='errors/list.html')
-def error_list(request):
-    return {
-        'selected_project': get_selected_project(request),
-        'errors': get_errors(request),
-        'basename': path.basename
-    }
+    cache = ResponseCache.shared(request.registry.settings)
+    return cache.respond(request, project.token, 'errors/list.html', build)
 
 
-@view_config(route_name='error_list', permission='authenticated', xhr=False, renderer='error-list.html')
+@view_config(route_name='error_list', permission='authenticated', xhr=False)
 def error_page(request):
     project = get_selected_project(request)
 
-    search = request.GET.get('search', '')
-    show = request.GET.get('show', 'open')  # open, resolved, mine
-    order_by = request.GET.get('order_by', 'date')
-    direction = request.GET.get('direction', 'desc')
+    def build():
+        search = request.GET.get('search', '')
+        show = request.GET.get('show', 'open')  # open, resolved, mine
+        order_by = request.GET.get('order_by', 'date')
+        direction = request.GET.get('direction', 'desc')
+        tags = request.GET.getall('tags')
 
-    if show not in ['open', 'resolved', 'mine']:
-        show = 'open'
+        if show not in ['open', 'resolved', 'mine']:
+            show = 'open'
 
-    errors = get_errors(request)
+        page = get_errors(request)
 
-    counts = {
-        'open': project.errors().active().filter().count(),
-        'openUnseen': project.errors().active().filter(seenby__ne=request.user).count(),
-        'resolved': project.errors().resolved().filter().count(),
-        'resolvedUnseen': project.errors().resolved().filter(seenby__ne=request.user).count(),
-        'mine': project.errors().active().filter(claimedby=request.user).count()
-    }
+        counters = ProjectCounters.get_or_reconcile(project.token)
+        counts = counters.counts(request.user)
 
-    return {
-        'search': search,
-        'errors': errors,
-        'selected_project': project,
-        'available_projects': Project.objects(),
-        'show': show,
-        'order_by': order_by,
-        'direction': direction,
-        'counts': counts,
-        'basename': path.basename
-    }
+        return {
+            'search': search,
+            'errors': page['errors'],
+            'next_cursor': page['next_cursor'],
+            'selected_project': project,
+            'available_projects': Project.objects(),
+            'show': show,
+            'order_by': order_by,
+            'direction': direction,
+            'counts': counts,
+            'tags': tags,
+            # tag counts are only kept for open and resolved errors
+            'facets': counters.facets(show) if show != 'mine' else [],
+            'basename': path.basename
+        }, {}
+
+    cache = ResponseCache.shared(request.registry.settings)
+    return cache.respond(request, project.token, 'error-list.html', build)
+
+
+@view_config(route_name='error_list_events', permission='authenticated', xhr=True, renderer='json')
+def error_list_events(request):
+    """ Long-polls this process' EventHub for errors of the project written
+    after event number `since`. 'events' is null if some were missed, and
+    'retry' is how many milliseconds the client should wait to poll again.
+    """
+    project = get_selected_project(request)
+    settings = request.registry.settings
+    hub = EventHub.shared(settings)
+    if hub is None:
+        return {'hub': None, 'seq': 0, 'events': [], 'retry': None}
+
+    since = request.GET.get('since')
+    if request.GET.get('hub') != hub.id or not since:
+        since = None
+    else:
+        since = int(since)
 
+    timeout = float(settings.get('events.long_poll_timeout', 0))
+    # a client without a position only needs the current one, at once
+    seq, events = hub.wait(project.token, since, timeout if since is not None else 0)
 
-@view_config(route_name='error_list_changes', permission='authenticated', xhr=True, renderer='json')
-def error_list_changes(request):
-    return get_errors(request, True)
+    return {
+        'hub': hub.id,
+        'seq': seq,
+        'events': events,
+        'retry': 0 if timeout else int(float(settings.get('events.poll_interval', 10)) * 1000)
+    }
 
 
 @view_config(route_name='error_view', permission='authenticated')
@@ -128,10 +181,12 @@ def view(request):
     except:
         return HTTPNotFound()
 
+    # an override upsert, the error itself is not written
     error.mark_seen(request.user)
-    error.save()
 
-    instances = ErrorInstance.objects(hash=error.hash)[:10]
+    # payloads are loaded on demand by error_instances
+    instances = ErrorInstance.summaries(project.token, error.hash)
+    Blob.resolve([error])
 
     params = {
         'error': error,
@@ -149,6 +204,37 @@ def view(request):
         return render_to_response(template, params)
 
 
+@view_config(route_name='error_instances', permission='authenticated', xhr=True, renderer='errors/instances.html')
+def instances(request):
+    project = get_selected_project(request)
+
+    try:
+        error = Error.objects._collection.find_one({'_id': ObjectId(request.matchdict['id']), 'project': project.token}, fields=['hash'])
+    except:
+        error = None
+    if error is None:
+        return HTTPNotFound()
+
+    try:
+        instances, next_cursor = ErrorInstance.page(project.token, error['hash'], request.GET.get('after'))
+    except ValueError:
+        instances, next_cursor = ErrorInstance.page(project.token, error['hash'])
+
+    request.response.headers['X-Next-Cursor'] = next_cursor or ''
+
+    return {
+        'selected_project': project,
+        'instances': instances
+    }
+
+
+@view_config(route_name='error_mark_all_seen', permission='authenticated', xhr=True, renderer='json')
+def mark_all_seen(request):
+    project = get_selected_project(request)
+    ReadMarker.mark_all_seen(request.user, project.token)
+    return {'type': 'success'}
+
+
 @view_config(route_name='error_toggle_claim', permission='authenticated', xhr=True, renderer='json')
 def toggle_claim(request):
     error_id = request.matchdict['id']
@@ -199,9 +285,9 @@ def tag_add(request):
         if tag in error.tags:
             return {'type': 'failure'}
 
-        error.tags.append(tag)
+        error.add_tag(tag)
         error.save()
-        Tag.create(tag).save()
+        Tag.create(tag)
         return {'type': 'success'}
     except:
         return {'type': 'failure'}
@@ -219,7 +305,7 @@ def tag_remove(request):
         if tag not in error.tags:
             return {'type': 'failure'}
 
-        error.tags.remove(tag)
+        error.remove_tag(tag)
         error.save()
         Tag.removeOne(tag)
         return {'type': 'success'}
@@ -240,44 +326,55 @@ def comment_add(request):
             content=request.POST.get('comment').strip(),
             created=int(time())
         ))
+        error.activity = len(error.comments)
         error.save()
         return {'type': 'success'}
     except:
         return {'type': 'failure'}
 
 
-@view_config(route_name='error_mass', permission='authenticated', xhr=True, renderer='json')
+@view_config(route_name='error_mass', permission='authenticated', xhr=True, renderer='json', request_method='POST')
 def mass(request):
-    error_ids = request.matchdict['ids'].split(',')
+    """ Applies a mass action to the posted `ids`, or with `all` set to the
+    errors matching the posted list filter, MASS_CHUNK at a time. Then the
+    client posts again with the returned `cursor` until it is null, the
+    first response also carries the `total` to report progress against.
+    """
     action = request.matchdict['action']
     project = get_selected_project(request)
 
     try:
-        for error_id in error_ids:
-            error = Error.objects(project=project.token, id=error_id).get()
-
-            if action == 'claim':
-                error.claim(request.user)
-            elif action == 'unclaim':
-                error.remove_claim()
-            elif action == 'resolve':
-                error.resolve(request.user)
-            elif action == 'unresolve':
-                error.unresolve()
-            elif action == 'markseen':
-                error.mark_seen(request.user)
-            elif action == 'markunseen':
-                error.mark_unseen(request.user)
-            else:
-                raise Exception('Unknown action: ' + action)
-
-            error.save()
+        if request.POST.get('all'):
+            errors = filter_errors(
+                project,
+                request.POST.get('show', 'open'),
+                request.user,
+                request.POST.get('search', ''),
+                request.POST.getall('tags')
+            )
+            errors = errors.filter(timelatest__lte=int(request.POST.get('timelatest', time())))
+
+            cursor = request.POST.get('cursor')
+            total = errors.count() if not cursor else None
+            affected, processed, cursor = errors.apply(action, request.user, cursor)
+        else:
+            ids = [ObjectId(id) for id in request.POST.getall('ids')]
+            errors = project.errors().filter(id__in=ids)
+            total = len(ids)
+            affected, processed, cursor = errors.apply(action, request.user, size=max(total, 1))
+            cursor = None
 
-        return {'type': 'success'}
+        return {
+            'type': 'success',
+            'affected': affected,
+            'processed': processed,
+            'total': total,
+            'cursor': cursor
+        }
     except Exception, e:
         return {
             'type': 'failure',
-            'reason': e
+            'reason': str(e)
         }
 
 